@@ -28,6 +28,9 @@
 #include "utils/s2n_safety.h"
 #include <sys/stat.h>
 #include <sys/mman.h>
+#include <sys/un.h>
+#include <stddef.h>
+#include <time.h>
 uint8_t ticket_key_name[16] = "2016.07.26.15\0";
 
 uint8_t default_ticket_key[32] = {0x07, 0x77, 0x09, 0x36, 0x2c, 0x2e, 0x32, 0xdf, 0x0d, 0xdc,
@@ -57,6 +60,16 @@ static uint8_t unsafe_verify_host_fn(const char *host_name, size_t host_name_len
     return 1;
 }
 
+bool print_timestamps = false;
+
+/* Nanoseconds on the clock the test harness uses for its own timestamps */
+uint64_t monotonic_time_ns(void)
+{
+    struct timespec now = { 0 };
+    clock_gettime(CLOCK_MONOTONIC, &now);
+    return (uint64_t) now.tv_sec * 1000000000 + now.tv_nsec;
+}
+
 int write_array_to_file(const char *path, uint8_t *data, size_t length) {
     GUARD_EXIT_NULL(path);
     GUARD_EXIT_NULL(data);
@@ -483,3 +496,75 @@ uint8_t unsafe_verify_host(const char *host_name, size_t host_name_len, void *da
 
     return (uint8_t) (strcasecmp(host_name, verify_data->trusted_host) == 0);
 }
+
+static int unix_socket_address(const char *path, struct sockaddr_un *addr, socklen_t *addr_len)
+{
+    size_t path_len = strlen(path);
+    if (path_len == 0 || path_len >= sizeof(addr->sun_path)) {
+        errno = ENAMETOOLONG;
+        return -1;
+    }
+
+    memset(addr, 0, sizeof(*addr));
+    addr->sun_family = AF_UNIX;
+    memcpy(addr->sun_path, path, path_len);
+    *addr_len = offsetof(struct sockaddr_un, sun_path) + path_len + 1;
+
+    /* Abstract names start with a NUL byte, and aren't NUL terminated */
+    if (path[0] == '@') {
+        addr->sun_path[0] = '\0';
+        *addr_len -= 1;
+    }
+
+    return 0;
+}
+
+int unix_socket_listen(const char *path)
+{
+    struct sockaddr_un addr;
+    socklen_t addr_len;
+    if (unix_socket_address(path, &addr, &addr_len) < 0) {
+        return -1;
+    }
+
+    if (path[0] != '@') {
+        unlink(path);
+    }
+
+    int fd = socket(AF_UNIX, SOCK_STREAM, 0);
+    if (fd < 0) {
+        return -1;
+    }
+
+    if (bind(fd, (struct sockaddr *) &addr, addr_len) < 0 || listen(fd, 1) < 0) {
+        int saved_errno = errno;
+        close(fd);
+        errno = saved_errno;
+        return -1;
+    }
+
+    return fd;
+}
+
+int unix_socket_connect(const char *path)
+{
+    struct sockaddr_un addr;
+    socklen_t addr_len;
+    if (unix_socket_address(path, &addr, &addr_len) < 0) {
+        return -1;
+    }
+
+    int fd = socket(AF_UNIX, SOCK_STREAM, 0);
+    if (fd < 0) {
+        return -1;
+    }
+
+    if (connect(fd, (struct sockaddr *) &addr, addr_len) < 0) {
+        int saved_errno = errno;
+        close(fd);
+        errno = saved_errno;
+        return -1;
+    }
+
+    return fd;
+}
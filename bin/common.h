@@ -16,6 +16,7 @@
 #pragma once
 
 #include <stdint.h>
+#include <sys/socket.h>
 #include "api/s2n.h"
 
 #define GUARD_EXIT_NULL(x)                                 \
@@ -85,6 +86,10 @@ int early_data_recv(struct s2n_connection *conn);
 int early_data_send(struct s2n_connection *conn, uint8_t *data, uint32_t len);
 int print_connection_info(struct s2n_connection *conn);
 int https(struct s2n_connection *conn, uint32_t bench);
+
+/* Set by --timestamps, to print when the first byte of application data is sent and received */
+extern bool print_timestamps;
+uint64_t monotonic_time_ns(void);
 int key_log_callback(void *ctx, struct s2n_connection *conn, uint8_t *logline, size_t len);
 
 int cache_store_callback(struct s2n_connection *conn, void *ctx, uint64_t ttl, const void *key, uint64_t key_size, const void *value, uint64_t value_size);
@@ -126,3 +131,22 @@ int s2n_setup_external_psk_list(struct s2n_connection *conn, char *psk_optarg_li
 uint8_t unsafe_verify_host(const char *host_name, size_t host_name_len, void *data);
 int s2n_setup_server_connection(struct s2n_connection *conn, int fd, struct s2n_config *config, struct conn_settings settings);
 int s2n_set_common_server_config(int max_early_data, struct s2n_config *config, struct conn_settings conn_settings, const char *cipher_prefs, const char *session_ticket_key_file_path);
+
+/**
+ * Creates a Unix domain socket listening on path
+ *
+ * A path starting with '@' names a socket in the abstract namespace, which
+ * has no file on disk. Otherwise any stale socket file at path is removed first.
+ *
+ * @param path Path or abstract name of the socket
+ * @return The listening socket, or -1 with errno set
+ */
+int unix_socket_listen(const char *path);
+
+/**
+ * Connects a Unix domain socket to path
+ *
+ * @param path Path or abstract name of the socket, as passed to unix_socket_listen
+ * @return The connected socket, or -1 with errno set
+ */
+int unix_socket_connect(const char *path);
@@ -19,6 +19,7 @@
 
 #include <unistd.h>
 #include <errno.h>
+#include <inttypes.h>
 
 #include "api/s2n.h"
 #include <openssl/rsa.h>
@@ -235,8 +236,11 @@ int negotiate(struct s2n_connection *conn, int fd)
             fprintf(stderr, "Failed to negotiate: '%s'. %s\n",
                     s2n_strerror(s2n_errno, "EN"),
                     s2n_strerror_debug(s2n_errno, "EN"));
+            /* Getting the alert resets s2n_errno, which callers may still report */
+            int negotiate_errno = s2n_errno;
             fprintf(stderr, "Alert: %d\n",
                     s2n_connection_get_alert(conn));
+            s2n_errno = negotiate_errno;
             S2N_ERROR_PRESERVE_ERRNO();
         }
 
@@ -266,6 +270,8 @@ int echo(struct s2n_connection *conn, int sockfd, bool *stop_echo)
     /* Act as a simple proxy between stdin and the SSL connection */
     int p = 0;
     s2n_blocked_status blocked;
+    bool first_byte_sent = false;
+    bool first_byte_received = false;
     do {
         /* echo will send and receive Application Data back and forth between
          * client and server, until stop_echo is true. */
@@ -290,6 +296,12 @@ int echo(struct s2n_connection *conn, int sockfd, bool *stop_echo)
                     exit(1);
                 }
 
+                if (print_timestamps && !first_byte_received) {
+                    fprintf(stdout, "First byte received at %" PRIu64 " ns\n", monotonic_time_ns());
+                    fflush(stdout);
+                    first_byte_received = true;
+                }
+
                 char *buf_ptr = buffer;
                 do {
                     bytes_written = write(STDOUT_FILENO, buf_ptr, bytes_read);
@@ -329,6 +341,12 @@ int echo(struct s2n_connection *conn, int sockfd, bool *stop_echo)
                     }
                     bytes_available -= bytes_read;
 
+                    /* The time is printed once the data is sent, so printing it doesn't delay the data */
+                    uint64_t send_time = 0;
+                    if (print_timestamps && !first_byte_sent) {
+                        send_time = monotonic_time_ns();
+                    }
+
                     /* We may not be able to write all the data we read in one shot, so
                      * keep sending until we have cleared our buffer. */
                     char *buf_ptr = buffer;
@@ -352,6 +370,11 @@ int echo(struct s2n_connection *conn, int sockfd, bool *stop_echo)
                         }
                     } while (bytes_read > 0);
 
+                    if (send_time) {
+                        fprintf(stdout, "First byte sent at %" PRIu64 " ns\n", send_time);
+                        fflush(stdout);
+                        first_byte_sent = true;
+                    }
                 } while (bytes_available || blocked);
 
             }
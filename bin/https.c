@@ -16,8 +16,10 @@
 #include <stdlib.h>
 #include <string.h>
 #include <stdio.h>
+#include <inttypes.h>
 
 #include "api/s2n.h"
+#include "common.h"
 #include "error/s2n_errno.h"
 #include "stuffer/s2n_stuffer.h"
 #include "utils/s2n_safety.h"
@@ -41,6 +43,13 @@ static int flush(uint32_t left, uint8_t *buffer, struct s2n_connection *conn, s2
     uint32_t i = 0;
     while (i < left) {
         int out = s2n_send(conn, &buffer[i], left - i, blocked_status);
+        if (out < 0 && s2n_error_get_type(s2n_errno) == S2N_ERR_T_BLOCKED) {
+            /* In non-blocking mode, wait until the socket can take more data */
+            int fd = 0;
+            POSIX_GUARD(s2n_connection_get_write_fd(conn, &fd));
+            POSIX_GUARD(wait_for_event(fd, *blocked_status));
+            continue;
+        }
         if (out < 0) {
             fprintf(stderr, "Error writing to connection: '%s'\n", s2n_strerror(s2n_errno, "EN"));
             s2n_print_stacktrace(stdout);
@@ -60,15 +69,27 @@ static int flush(uint32_t left, uint8_t *buffer, struct s2n_connection *conn, s2
 
 /* In bench mode, we send some binary output */
 int bench_handler(struct s2n_connection *conn, uint32_t bench) {
-    HEADERS(bench);
-    fprintf(stdout, "Sending %u bytes...\n", bench);
-
     uint8_t big_buff[65536] = { 0 };
     uint32_t len = sizeof(big_buff);
-    uint32_t bytes_remaining = bench;
 
+    /* The headers go in the same records as the start of the body, as a server's
+     * response would, so the first records are sized the way the connection prefers */
+    int headers_len = snprintf((char *) big_buff, len, "HTTP/1.1 200 OK\r\nContent-Length: %u\r\n\r\n", bench);
+    POSIX_ENSURE_GT(headers_len, 0);
+    fprintf(stdout, "Sending %u bytes...\n", bench);
+
+    uint64_t send_time = monotonic_time_ns();
+    uint32_t bytes_remaining = bench + headers_len;
+    uint32_t buffer_remaining = bytes_remaining < len ? bytes_remaining : len;
+    POSIX_GUARD(flush(buffer_remaining, big_buff, conn, &blocked));
+    bytes_remaining -= buffer_remaining;
+    if (print_timestamps) {
+        fprintf(stdout, "First byte sent at %" PRIu64 " ns\n", send_time);
+    }
+
+    memset(big_buff, 0, headers_len);
     while (bytes_remaining) {
-        uint32_t buffer_remaining = bytes_remaining < len ? bytes_remaining : len;
+        buffer_remaining = bytes_remaining < len ? bytes_remaining : len;
         POSIX_GUARD(flush(buffer_remaining, big_buff, conn, &blocked));
         bytes_remaining -= buffer_remaining;
     }
@@ -20,6 +20,7 @@
 #include <unistd.h>
 #include <getopt.h>
 #include <fcntl.h>
+#include <time.h>
 
 #ifndef S2N_INTERN_LIBCRYPTO
 #include <openssl/crypto.h>
@@ -34,6 +35,11 @@
 
 #define OPT_TICKET_IN 1000
 #define OPT_TICKET_OUT 1001
+#define OPT_UNIX_SOCKET 1002
+#define OPT_BATCH 1003
+#define OPT_TIMESTAMPS 1004
+
+#define BATCH_RESULT_MARKER "Batch result: "
 
 void usage()
 {
@@ -79,6 +85,17 @@ void usage()
     fprintf(stderr, "    Path to a file where the session ticket can be stored.\n");
     fprintf(stderr, "  --ticket-in [file path]\n");
     fprintf(stderr, "    Path to session ticket file to resume connection.\n");
+    fprintf(stderr, "  --unix-socket [path]\n");
+    fprintf(stderr, "    Connect to a Unix domain socket at path, or over TCP if nothing listens there. A path starting with '@' is in the abstract namespace.\n");
+    fprintf(stderr, "  --batch [file path]\n");
+    fprintf(stderr, "    Make one connection for each line of the file, instead of one connection (or one per --reconnect).\n"
+                    "    Each line is a whitespace-separated list of: id=<label>, cipher=<version_string>, name=<server name>,\n"
+                    "    ticket-in=<file path>, ticket-out=<file path>, and resume to resume the previous line's session.\n"
+                    "    Options not given on a line are taken from the command line. A line starting with '#' is ignored.\n"
+                    "    After each connection, a line starting with \"" BATCH_RESULT_MARKER "\" describes it as a JSON object.\n"
+                    "    A failed handshake is reported and the next line is tried; s2nc exits with 1 if any handshake failed.\n");
+    fprintf(stderr, "  --timestamps\n");
+    fprintf(stderr, "    Print when the first byte of application data is sent and received, in nanoseconds on the monotonic clock.\n");
     fprintf(stderr, "  -D,--dynamic\n");
     fprintf(stderr, "    Set dynamic record resize threshold\n");
     fprintf(stderr, "  -t,--timeout\n");
@@ -122,6 +139,153 @@ static int test_session_ticket_cb(struct s2n_connection *conn, void *ctx, struct
     return S2N_SUCCESS;
 }
 
+struct batch_spec {
+    const char *id;
+    const char *cipher_prefs;
+    const char *server_name;
+    char *ticket_in;
+    const char *ticket_out;
+    bool resume;
+};
+
+/* Parses a --batch file into one spec per connection. The specs point into contents, which must outlive them. */
+static struct batch_spec *load_batch_specs(char *contents, size_t *spec_count)
+{
+    struct batch_spec *specs = NULL;
+    size_t count = 0;
+    char *line_state = NULL;
+
+    for (char *line = strtok_r(contents, "\n", &line_state); line != NULL; line = strtok_r(NULL, "\n", &line_state)) {
+        char *field_state = NULL;
+        char *field = strtok_r(line, " \t\r", &field_state);
+        if (field == NULL || field[0] == '#') {
+            continue;
+        }
+
+        specs = realloc(specs, (count + 1) * sizeof(struct batch_spec));
+        GUARD_EXIT_NULL(specs);
+        struct batch_spec *spec = &specs[count++];
+        memset(spec, 0, sizeof(struct batch_spec));
+
+        for (; field != NULL; field = strtok_r(NULL, " \t\r", &field_state)) {
+            char *value = strchr(field, '=');
+            if (value != NULL) {
+                *value++ = '\0';
+            }
+
+            if (strcmp(field, "resume") == 0 && value == NULL) {
+                spec->resume = true;
+            } else if (value == NULL) {
+                fprintf(stderr, "Invalid batch field '%s' on connection %zu\n", field, count - 1);
+                exit(1);
+            } else if (strcmp(field, "id") == 0) {
+                spec->id = value;
+            } else if (strcmp(field, "cipher") == 0) {
+                spec->cipher_prefs = value;
+            } else if (strcmp(field, "name") == 0) {
+                spec->server_name = value;
+            } else if (strcmp(field, "ticket-in") == 0) {
+                spec->ticket_in = value;
+            } else if (strcmp(field, "ticket-out") == 0) {
+                spec->ticket_out = value;
+            } else {
+                fprintf(stderr, "Unknown batch field '%s' on connection %zu\n", field, count - 1);
+                exit(1);
+            }
+        }
+    }
+
+    if (count == 0) {
+        fprintf(stderr, "Batch file has no connections\n");
+        exit(1);
+    }
+
+    *spec_count = count;
+    return specs;
+}
+
+/* Reads from the connection until the server sends a session ticket. Unlike echo, this doesn't depend on stdin
+ * staying open, which batch mode has no use for. Application data received meanwhile is written to stdout. */
+static int wait_for_session_ticket(struct s2n_connection *conn, int sockfd, bool *session_ticket_recv)
+{
+    char buffer[1024];
+    s2n_blocked_status blocked;
+
+    while (!*session_ticket_recv) {
+        ssize_t bytes_read = s2n_recv(conn, buffer, sizeof(buffer), &blocked);
+        if (bytes_read > 0) {
+            fwrite(buffer, 1, bytes_read, stdout);
+        } else if (bytes_read == 0) {
+            fprintf(stderr, "Connection closed before a session ticket was received\n");
+            return S2N_FAILURE;
+        } else if (s2n_error_get_type(s2n_errno) != S2N_ERR_T_BLOCKED) {
+            return S2N_FAILURE;
+        } else if (*session_ticket_recv) {
+            /* The s2n_recv call which blocked received the ticket, so there is nothing left to wait for */
+            break;
+        } else if (wait_for_event(sockfd, blocked) != S2N_SUCCESS) {
+            return S2N_FAILURE;
+        }
+    }
+
+    return S2N_SUCCESS;
+}
+
+static void print_json_string(const char *str)
+{
+    putchar('"');
+    for (; str != NULL && *str != '\0'; str++) {
+        if (*str == '"' || *str == '\\') {
+            putchar('\\');
+            putchar(*str);
+        } else if ((unsigned char)*str < 0x20) {
+            printf("\\u%04x", (unsigned char)*str);
+        } else {
+            putchar(*str);
+        }
+    }
+    putchar('"');
+}
+
+/* Prints one line describing a connection made for a --batch spec. The connection is NULL if it failed. */
+static void print_batch_result(size_t index, const char *id, const char *server_name, struct s2n_connection *conn,
+    long handshake_us)
+{
+    printf(BATCH_RESULT_MARKER "{\"index\": %zu, \"id\": ", index);
+    if (id) {
+        print_json_string(id);
+    } else {
+        printf("\"%zu\"", index);
+    }
+    printf(", \"server_name\": ");
+    print_json_string(server_name);
+
+    if (conn == NULL) {
+        printf(", \"status\": \"failed\", \"error\": ");
+        print_json_string(s2n_strerror(s2n_errno, "EN"));
+        printf("}\n");
+        fflush(stdout);
+        return;
+    }
+
+    const char *early_data = "NOT REQUESTED";
+    s2n_early_data_status_t early_data_status = S2N_EARLY_DATA_STATUS_NOT_REQUESTED;
+    GUARD_EXIT(s2n_connection_get_early_data_status(conn, &early_data_status), "Error getting early data status");
+    switch (early_data_status) {
+        case S2N_EARLY_DATA_STATUS_OK: early_data = "IN PROGRESS"; break;
+        case S2N_EARLY_DATA_STATUS_NOT_REQUESTED: early_data = "NOT REQUESTED"; break;
+        case S2N_EARLY_DATA_STATUS_REJECTED: early_data = "REJECTED"; break;
+        case S2N_EARLY_DATA_STATUS_END: early_data = "ACCEPTED"; break;
+    }
+
+    printf(", \"status\": \"ok\", \"protocol\": %d, \"cipher\": ", s2n_connection_get_actual_protocol_version(conn));
+    print_json_string(s2n_connection_get_cipher(conn));
+    printf(", \"resumed\": %s, \"early_data\": ", s2n_connection_is_session_resumed(conn) ? "true" : "false");
+    print_json_string(early_data);
+    printf(", \"handshake_us\": %ld}\n", handshake_us);
+    fflush(stdout);
+}
+
 static void setup_s2n_config(struct s2n_config *config, const char *cipher_prefs, s2n_status_request_type type,
     struct verify_data *unsafe_verify_data, const char *host, const char *alpn_protocols, uint16_t mfl_value) {
 
@@ -262,10 +426,16 @@ int main(int argc, char *const *argv)
     int use_corked_io = 0;
     uint8_t non_blocking = 0;
     const char *key_log_path = NULL;
+    const char *unix_socket_path = NULL;
     FILE *key_log_file = NULL;
     char *psk_optarg_list[S2N_MAX_PSK_LIST_LENGTH];
     size_t psk_list_len = 0;
     char *early_data = NULL;
+    const char *batch_path = NULL;
+    char *batch_contents = NULL;
+    struct batch_spec *batch_specs = NULL;
+    size_t batch_count = 0;
+    size_t batch_failures = 0;
 
     static struct option long_options[] = {
         {"alpn", required_argument, 0, 'a'},
@@ -284,6 +454,9 @@ int main(int argc, char *const *argv)
         {"reconnect", no_argument, 0, 'r'},
         {"ticket-out", required_argument, 0, OPT_TICKET_OUT},
         {"ticket-in", required_argument, 0, OPT_TICKET_IN},
+        {"unix-socket", required_argument, 0, OPT_UNIX_SOCKET},
+        {"batch", required_argument, 0, OPT_BATCH},
+        {"timestamps", no_argument, 0, OPT_TIMESTAMPS},
         {"no-session-ticket", no_argument, 0, 'T'},
         {"dynamic", required_argument, 0, 'D'},
         {"timeout", required_argument, 0, 't'},
@@ -356,6 +529,15 @@ int main(int argc, char *const *argv)
         case OPT_TICKET_IN:
             ticket_in = optarg;
             break;
+        case OPT_UNIX_SOCKET:
+            unix_socket_path = optarg;
+            break;
+        case OPT_BATCH:
+            batch_path = optarg;
+            break;
+        case OPT_TIMESTAMPS:
+            print_timestamps = true;
+            break;
         case 'T':
             session_ticket = 0;
             break;
@@ -413,6 +595,20 @@ int main(int argc, char *const *argv)
         server_name = host;
     }
 
+    /* Batch specs override these for each connection */
+    const char *default_cipher_prefs = cipher_prefs;
+    const char *default_server_name = server_name;
+    char *default_ticket_in = ticket_in;
+    const char *default_ticket_out = ticket_out;
+
+    if (batch_path) {
+        batch_contents = load_file_to_cstring(batch_path);
+        GUARD_EXIT_NULL(batch_contents);
+        batch_specs = load_batch_specs(batch_contents, &batch_count);
+        /* One connection per spec, instead of --reconnect's */
+        reconnect = (int) batch_count - 1;
+    }
+
     memset(&hints, 0, sizeof(hints));
 
     hints.ai_family = AF_UNSPEC;
@@ -447,9 +643,37 @@ int main(int argc, char *const *argv)
         exit(1);
     }
 
+    struct s2n_config *config = NULL;
+    const char *config_cipher_prefs = NULL;
     do {
+        /* With --batch, reconnect counts down the specs left after this one */
+        size_t batch_index = batch_count - 1 - reconnect;
+        struct batch_spec *spec = NULL;
+        if (batch_specs) {
+            spec = &batch_specs[batch_index];
+            cipher_prefs = spec->cipher_prefs ? spec->cipher_prefs : default_cipher_prefs;
+            server_name = spec->server_name ? spec->server_name : default_server_name;
+            ticket_in = spec->ticket_in ? spec->ticket_in : default_ticket_in;
+            ticket_out = spec->ticket_out ? spec->ticket_out : default_ticket_out;
+
+            /* Only resume the previous connection's session when asked to */
+            if (!spec->resume) {
+                session_state_length = 0;
+            }
+        }
+
         int connected = 0;
-        for (ai = ai_list; ai != NULL; ai = ai->ai_next) {
+        if (unix_socket_path) {
+            /* Servers which don't listen on the Unix socket are reached over TCP instead */
+            if ((sockfd = unix_socket_connect(unix_socket_path)) != -1) {
+                connected = 1;
+            } else if (errno != ENOENT && errno != ECONNREFUSED) {
+                fprintf(stderr, "Failed to connect to %s: %s\n", unix_socket_path, strerror(errno));
+                exit(1);
+            }
+        }
+
+        for (ai = ai_list; !connected && ai != NULL; ai = ai->ai_next) {
             if ((sockfd = socket(ai->ai_family, ai->ai_socktype, ai->ai_protocol)) == -1) {
                 continue;
             }
@@ -477,47 +701,58 @@ int main(int argc, char *const *argv)
             }
         }
 
-        struct s2n_config *config = s2n_config_new();
-        setup_s2n_config(config, cipher_prefs, type, &unsafe_verify_data, host, alpn_protocols, mfl_value);
+        /* A new config loads the system trust store, which takes longer than a handshake, so the config
+         * is only replaced when the cipher preferences change */
+        if (config == NULL || strcmp(cipher_prefs, config_cipher_prefs) != 0) {
+            if (config) {
+                GUARD_EXIT(s2n_config_free(config), "Error freeing configuration");
+            }
+            config = s2n_config_new();
+            setup_s2n_config(config, cipher_prefs, type, &unsafe_verify_data, host, alpn_protocols, mfl_value);
 
-        if (client_cert_input != client_key_input) {
-            print_s2n_error("Client cert/key pair must be given.");
-        }
+            if (client_cert_input != client_key_input) {
+                print_s2n_error("Client cert/key pair must be given.");
+            }
 
-        if (client_cert_input) {
-            struct s2n_cert_chain_and_key *chain_and_key = s2n_cert_chain_and_key_new();
-            GUARD_EXIT(s2n_cert_chain_and_key_load_pem(chain_and_key, client_cert, client_key), "Error getting certificate/key");
-            GUARD_EXIT(s2n_config_add_cert_chain_and_key_to_store(config, chain_and_key), "Error setting certificate/key");
-        }
+            if (client_cert_input) {
+                struct s2n_cert_chain_and_key *chain_and_key = s2n_cert_chain_and_key_new();
+                GUARD_EXIT(s2n_cert_chain_and_key_load_pem(chain_and_key, client_cert, client_key), "Error getting certificate/key");
+                GUARD_EXIT(s2n_config_add_cert_chain_and_key_to_store(config, chain_and_key), "Error setting certificate/key");
+            }
 
-        if (ca_file || ca_dir) {
-            GUARD_EXIT(s2n_config_wipe_trust_store(config), "Error wiping trust store");
-            if (s2n_config_set_verification_ca_location(config, ca_file, ca_dir) < 0) {
-                print_s2n_error("Error setting CA file for trust store.");
+            if (ca_file || ca_dir) {
+                GUARD_EXIT(s2n_config_wipe_trust_store(config), "Error wiping trust store");
+                if (s2n_config_set_verification_ca_location(config, ca_file, ca_dir) < 0) {
+                    print_s2n_error("Error setting CA file for trust store.");
+                }
+            }
+            else if (insecure) {
+                GUARD_EXIT(s2n_config_disable_x509_verification(config), "Error disabling X.509 validation");
             }
-        }
-        else if (insecure) {
-            GUARD_EXIT(s2n_config_disable_x509_verification(config), "Error disabling X.509 validation");
-        }
 
-        if (session_ticket) {
-            GUARD_EXIT(s2n_config_set_session_tickets_onoff(config, 1), "Error enabling session tickets");
-            GUARD_EXIT(s2n_config_set_session_ticket_cb(config, test_session_ticket_cb, &session_ticket_recv), "Error setting session ticket callback");
-            session_ticket_recv = 0;
-        }
+            if (session_ticket) {
+                GUARD_EXIT(s2n_config_set_session_tickets_onoff(config, 1), "Error enabling session tickets");
+                GUARD_EXIT(s2n_config_set_session_ticket_cb(config, test_session_ticket_cb, &session_ticket_recv), "Error setting session ticket callback");
+            }
+
+            if (key_log_path) {
+                if (key_log_file == NULL) {
+                    key_log_file = fopen(key_log_path, "a");
+                    GUARD_EXIT(key_log_file == NULL ? S2N_FAILURE : S2N_SUCCESS, "Failed to open key log file");
+                }
+                GUARD_EXIT(
+                    s2n_config_set_key_log_cb(
+                        config,
+                        key_log_callback,
+                        (void *)key_log_file
+                    ),
+                    "Failed to set key log callback"
+                );
+            }
 
-        if (key_log_path) {
-            key_log_file = fopen(key_log_path, "a");
-            GUARD_EXIT(key_log_file == NULL ? S2N_FAILURE : S2N_SUCCESS, "Failed to open key log file");
-            GUARD_EXIT(
-                s2n_config_set_key_log_cb(
-                    config,
-                    key_log_callback,
-                    (void *)key_log_file
-                ),
-                "Failed to set key log callback"
-            );
+            config_cipher_prefs = cipher_prefs;
         }
+        session_ticket_recv = 0;
 
         struct s2n_connection *conn = s2n_connection_new(S2N_CLIENT);
 
@@ -567,21 +802,45 @@ int main(int argc, char *const *argv)
         }
 
         /* See echo.c */
+        struct timespec handshake_start = { 0 }, handshake_end = { 0 };
+        clock_gettime(CLOCK_MONOTONIC, &handshake_start);
         if (negotiate(conn, sockfd) != 0) {
-            /* Error is printed in negotiate */
-            S2N_ERROR_PRESERVE_ERRNO();
+            if (!batch_specs) {
+                /* Error is printed in negotiate */
+                S2N_ERROR_PRESERVE_ERRNO();
+            }
+
+            /* Report the failure and carry on with the next spec */
+            print_batch_result(batch_index, spec->id, server_name, NULL, 0);
+            batch_failures++;
+            GUARD_EXIT(s2n_connection_free(conn), "Error freeing connection");
+            close(sockfd);
+            reconnect--;
+            continue;
         }
 
+        clock_gettime(CLOCK_MONOTONIC, &handshake_end);
+        long handshake_us = (handshake_end.tv_sec - handshake_start.tv_sec) * 1000000
+                + (handshake_end.tv_nsec - handshake_start.tv_nsec) / 1000;
+
         printf("Connected to %s:%s\n", host, port);
 
-        /* Save session state from connection if reconnect is enabled. */
-        if (reconnect > 0 || ticket_out) {
+        /* Save session state from connection if reconnect is enabled, or the next batch spec resumes it. */
+        bool save_session = reconnect > 0 || ticket_out;
+        if (batch_specs) {
+            save_session = ticket_out || (reconnect > 0 && batch_specs[batch_index + 1].resume);
+        }
+        if (save_session) {
             if (conn->actual_protocol_version >= S2N_TLS13) {
                 if (!session_ticket) {
                     print_s2n_error("s2nc can only reconnect in TLS1.3 with session tickets.");
                     exit(1);
                 }
-                GUARD_EXIT(echo(conn, sockfd, &session_ticket_recv), "Error calling echo");
+                if (batch_specs) {
+                    GUARD_EXIT(wait_for_session_ticket(conn, sockfd, &session_ticket_recv), "Error waiting for session ticket");
+                } else {
+                    GUARD_EXIT(echo(conn, sockfd, &session_ticket_recv), "Error calling echo");
+                }
             } else {
                 if (!session_ticket && s2n_connection_get_session_id_length(conn) <= 0) {
                     print_s2n_error("Endpoint sent empty session id so cannot resume session");
@@ -601,6 +860,10 @@ int main(int argc, char *const *argv)
             }
         }
 
+        if (batch_specs) {
+            print_batch_result(batch_index, spec->id, server_name, conn, handshake_us);
+        }
+
         if (dyn_rec_threshold > 0 && dyn_rec_timeout > 0) {
             s2n_connection_set_dynamic_record_threshold(conn, dyn_rec_threshold, dyn_rec_timeout);
         }
@@ -627,13 +890,15 @@ int main(int argc, char *const *argv)
 
         GUARD_EXIT(s2n_connection_free(conn), "Error freeing connection");
 
-        GUARD_EXIT(s2n_config_free(config), "Error freeing configuration");
-
         close(sockfd);
         reconnect--;
 
     } while (reconnect >= 0);
 
+    if (config) {
+        GUARD_EXIT(s2n_config_free(config), "Error freeing configuration");
+    }
+
     if (key_log_file) {
         fclose(key_log_file);
     }
@@ -642,6 +907,8 @@ int main(int argc, char *const *argv)
 
     free(early_data);
     free(session_state);
+    free(batch_specs);
+    free(batch_contents);
     freeaddrinfo(ai_list);
-    return 0;
+    return batch_failures ? 1 : 0;
 }
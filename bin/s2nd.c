@@ -16,7 +16,9 @@
 #include <sys/socket.h>
 #include <sys/stat.h>
 #include <sys/mman.h>
+#include <sys/wait.h>
 #include <netdb.h>
+#include <poll.h>
 #include <signal.h>
 #include <unistd.h>
 #include <fcntl.h>
@@ -149,6 +151,12 @@ void usage()
     fprintf(stderr, "  --parallelize\n");
     fprintf(stderr, "    Create a new Connection handler thread for each new connection. Useful for tests with lots of connections.\n");
     fprintf(stderr, "    Warning: this option isn't compatible with TLS Resumption, since each thread gets its own Session cache.\n");
+    fprintf(stderr, "  --print-connection-closed\n");
+    fprintf(stderr, "    Print \"Connection closed\" after each connection, so a harness which reuses the server can tell where the\n");
+    fprintf(stderr, "    output of each connection ends. It isn't printed with --parallelize.\n");
+    fprintf(stderr, "  -X,--max-conns [count]\n");
+    fprintf(stderr, "    Exit after count connections, or after one connection if count isn't given. With --parallelize, s2nd exits once\n");
+    fprintf(stderr, "    the handlers of every connection have finished, so its resource usage includes theirs.\n");
     fprintf(stderr, "  --prefer-low-latency\n");
     fprintf(stderr, "    Prefer low latency by clamping maximum outgoing record size at 1500.\n");
     fprintf(stderr, "  --prefer-throughput\n");
@@ -167,6 +175,8 @@ void usage()
     fprintf(stderr, "  -d,--ca-dir [directory path]\n");
     fprintf(stderr, "    Directory containing hashed trusted certs. If neither -t or -d are specified. System defaults will be used.");
     fprintf(stderr, "    This option is only used if mutual auth is enabled.\n");
+    fprintf(stderr, "  --unix-socket [path]\n");
+    fprintf(stderr, "    Also accept connections on a Unix domain socket at path. A path starting with '@' is in the abstract namespace.\n");
     fprintf(stderr, "  -i,--insecure\n");
     fprintf(stderr, "    Turns off certification validation altogether.\n");
     fprintf(stderr, "  --stk-file\n");
@@ -181,6 +191,8 @@ void usage()
     fprintf(stderr, "    Run s2nd in a simple https server mode.\n");
     fprintf(stderr, "  -b --https-bench <bytes>\n");
     fprintf(stderr, "    Send number of bytes in https server mode to test throughput.\n");
+    fprintf(stderr, "  --timestamps\n");
+    fprintf(stderr, "    Print when the first byte of application data is sent and received, in nanoseconds on the monotonic clock.\n");
     fprintf(stderr, "  -L --key-log <path>\n");
     fprintf(stderr, "    Enable NSS key logging into the provided path\n");
     fprintf(stderr, "  -P --psk <psk-identity,psk-secret,psk-hmac-alg> \n"
@@ -239,6 +251,43 @@ int handle_connection(int fd, struct s2n_config *config, struct conn_settings se
     return 0;
 }
 
+/* Accepts the next connection on either the TCP socket or, if there is one, the Unix socket */
+/* Reaps connection handlers as soon as they finish, so an idle parallel s2nd doesn't collect zombies. They're
+ * reaped rather than ignored, so that the resource usage of s2nd includes theirs. */
+static void reap_handlers(int signum)
+{
+    int saved_errno = errno;
+    while (waitpid(-1, NULL, WNOHANG) > 0) {
+    }
+    errno = saved_errno;
+}
+
+static int accept_connection(int sockfd, int unix_sockfd)
+{
+    int listener = sockfd;
+    if (unix_sockfd != -1) {
+        struct pollfd listeners[2] = {
+            { .fd = sockfd, .events = POLLIN },
+            { .fd = unix_sockfd, .events = POLLIN },
+        };
+        while (poll(listeners, 2, -1) < 0) {
+            if (errno != EINTR) {
+                return -1;
+            }
+        }
+
+        if (listeners[1].revents & POLLIN) {
+            listener = unix_sockfd;
+        }
+    }
+
+    /* With --parallelize, accept() is interrupted whenever a handler finishes */
+    int fd;
+    while ((fd = accept(listener, NULL, NULL)) < 0 && errno == EINTR) {
+    }
+    return fd;
+}
+
 int main(int argc, char *const *argv)
 {
     struct addrinfo hints, *ai;
@@ -253,6 +302,7 @@ int main(int argc, char *const *argv)
     const char *cipher_prefs = "default";
     const char *alpn = NULL;
     const char *key_log_path = NULL;
+    const char *unix_socket_path = NULL;
 
     /* The certificates provided by the user. If there are none provided, we will use the hardcoded default cert.
      * The associated private key for each cert will be at the same index in private_keys. If the user mixes up the
@@ -266,6 +316,7 @@ int main(int argc, char *const *argv)
     struct conn_settings conn_settings = { 0 };
     int fips_mode = 0;
     int parallelize = 0;
+    int print_connection_closed = 0;
     int non_blocking = 0;
     long int bytes = 0;
     conn_settings.session_ticket = 1;
@@ -285,6 +336,7 @@ int main(int argc, char *const *argv)
         {"negotiate", no_argument, NULL, 'n'},
         {"ocsp", required_argument, NULL, 'o'},
         {"parallelize", no_argument, &parallelize, 1},
+        {"print-connection-closed", no_argument, &print_connection_closed, 1},
         {"prefer-throughput", no_argument, NULL, 'p'},
         {"cert", required_argument, NULL, 'r'},
         {"self-service-blinding", no_argument, NULL, 's'},
@@ -303,6 +355,8 @@ int main(int argc, char *const *argv)
         {"key-log", required_argument, 0, 'L'},
         {"psk", required_argument, 0, 'P'},
         {"max-early-data", required_argument, 0, 'E'},
+        {"unix-socket", required_argument, 0, 'U'},
+        {"timestamps", no_argument, 0, 'M'},
         /* Per getopt(3) the last element of the array has to be filled with all zeros */
         { 0 },
     };
@@ -419,6 +473,12 @@ int main(int argc, char *const *argv)
         case 'E':
             max_early_data = atoi(optarg);
             break;
+        case 'M':
+            print_timestamps = true;
+            break;
+        case 'U':
+            unix_socket_path = optarg;
+            break;
         case '?':
         default:
             fprintf(stdout, "getopt_long returned: %d", c);
@@ -491,6 +551,12 @@ int main(int argc, char *const *argv)
         exit(1);
     }
 
+    int unix_sockfd = -1;
+    if (unix_socket_path && (unix_sockfd = unix_socket_listen(unix_socket_path)) == -1) {
+        fprintf(stderr, "unix socket error: %s\n", strerror(errno));
+        exit(1);
+    }
+
     if (fips_mode) {
 #ifndef S2N_INTERN_LIBCRYPTO
 #if defined(OPENSSL_FIPS) || defined(OPENSSL_IS_AWSLC)
@@ -511,6 +577,9 @@ int main(int argc, char *const *argv)
     GUARD_EXIT(s2n_init(), "Error running s2n_init()");
 
     printf("Listening on %s:%s\n", host, port);
+    if (unix_socket_path) {
+        printf("Listening on %s\n", unix_socket_path);
+    }
 
     struct s2n_config *config = s2n_config_new();
     if (!config) {
@@ -566,10 +635,8 @@ int main(int argc, char *const *argv)
     if (parallelize) {
         struct sigaction sa;
 
-        sa.sa_handler = SIG_IGN;
-#if defined(SA_NOCLDWAIT)
-        sa.sa_flags = SA_NOCLDWAIT;
-#endif
+        sa.sa_handler = reap_handlers;
+        sa.sa_flags = SA_NOCLDSTOP;
         sigemptyset(&sa.sa_mask);
         sigaction(SIGCHLD, &sa, NULL);
     }
@@ -595,7 +662,7 @@ int main(int argc, char *const *argv)
     }
 
     int fd;
-    while ((fd = accept(sockfd, ai->ai_addr, &ai->ai_addrlen)) > 0) {
+    while ((fd = accept_connection(sockfd, unix_sockfd)) > 0) {
 
         if (non_blocking) {
             int flags = fcntl(sockfd, F_GETFL, 0);
@@ -612,6 +679,11 @@ int main(int argc, char *const *argv)
                 exit(rc);
             }
 
+            /* Lets a harness reusing this server tell where each connection's output ends. */
+            if (print_connection_closed) {
+                printf("Connection closed\n");
+            }
+
             /* If max_conns was set, then exit after it is reached. Otherwise
              * unlimited connections are allow, so ignore the variable. */
             if (conn_settings.max_conns > 0) {
@@ -636,6 +708,14 @@ int main(int argc, char *const *argv)
             } else {
                 /* This is the parent Acceptor Thread, continue listening for new connections */
                 close(fd);
+
+                /* After max_conns connections, wait for the handlers to finish, then exit. reap_handlers may
+                 * reap them first, which ends the wait with ECHILD. */
+                if (conn_settings.max_conns > 0 && conn_settings.max_conns-- == 1) {
+                    while (wait(NULL) > 0 || errno == EINTR) {
+                    }
+                    break;
+                }
                 continue;
             }
         }
@@ -0,0 +1,233 @@
+import json
+import math
+import os
+import platform
+import time
+
+
+# The version of the JSON written by BenchmarkReport. Baselines with another
+# version can't be compared.
+REPORT_VERSION = 1
+
+# The percentiles reported for every metric
+PERCENTILES = (50, 90, 99)
+
+
+def percentile(samples, pct):
+    """
+    Return the pct'th percentile of samples, interpolating linearly between the
+    two closest ranks.
+    """
+    if not samples:
+        return None
+
+    ordered = sorted(samples)
+    rank = (len(ordered) - 1) * pct / 100.0
+    lower = int(math.floor(rank))
+    upper = int(math.ceil(rank))
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (rank - lower)
+
+
+def summarize(samples):
+    """
+    Return the statistics of samples which go into the report: the count, min,
+    max, mean, standard deviation and each of PERCENTILES.
+    """
+    count = len(samples)
+    mean = sum(samples) / count
+    summary = {
+        "count": count,
+        "min": min(samples),
+        "max": max(samples),
+        "mean": mean,
+        "stdev": math.sqrt(sum((sample - mean) ** 2 for sample in samples) / count),
+    }
+    for pct in PERCENTILES:
+        summary["p{}".format(pct)] = percentile(samples, pct)
+    return summary
+
+
+class Histogram(object):
+    """
+    A histogram in the style of HdrHistogram: small values each have their own bucket,
+    and larger values share buckets whose width doubles with each power of two, so
+    every value is counted to within significant_figures. Values are rounded to whole
+    units first.
+    """
+
+    def __init__(self, samples, significant_figures=3):
+        self.significant_figures = significant_figures
+        # Values below 2^unit_magnitude are counted exactly
+        self.unit_magnitude = int(
+            math.ceil(math.log2(2 * 10 ** significant_figures)))
+        self.counts = {}
+        for sample in samples:
+            self.add(sample)
+
+    def bucket(self, value):
+        """
+        Return the lowest value and the width of the bucket which counts value.
+        """
+        value = max(0, int(round(value)))
+        shift = max(0, value.bit_length() - self.unit_magnitude)
+        return (value >> shift) << shift, 1 << shift
+
+    def add(self, value):
+        lowest, _ = self.bucket(value)
+        self.counts[lowest] = self.counts.get(lowest, 0) + 1
+
+    def as_dict(self):
+        """
+        Return the histogram as the buckets which counted any values, in order, each
+        with its lowest value, the lowest value of the next bucket and its count.
+        """
+        buckets = []
+        for lowest in sorted(self.counts):
+            _, width = self.bucket(lowest)
+            buckets.append({"from": lowest, "to": lowest + width,
+                            "count": self.counts[lowest]})
+        return {"significant_figures": self.significant_figures, "buckets": buckets}
+
+
+class BenchmarkRecorder(object):
+    """
+    Records the metrics measured by one benchmark as user properties of its test.
+    """
+
+    def __init__(self, node, samples):
+        self.node = node
+        # How many samples of each metric the benchmark should take
+        self.samples = samples
+
+    def record(self, metric, samples, unit, higher_is_better=True, histogram=False):
+        """
+        Record the samples of one metric. With histogram, the report also has their
+        distribution (see Histogram), for metrics like latencies whose tail matters
+        as much as their median.
+        """
+        callspec = getattr(self.node, "callspec", None)
+        params = {name: value.__name__ if isinstance(value, type) else str(value)
+                  for name, value in (callspec.params.items() if callspec else [])}
+        self.node.user_properties.append(("benchmark", {
+            "metric": metric,
+            "unit": unit,
+            "higher_is_better": higher_is_better,
+            "samples": list(samples),
+            "histogram": histogram,
+            "params": params,
+        }))
+
+
+class Regression(object):
+    """
+    A metric whose median is worse than the baseline's by more than the threshold.
+    """
+
+    def __init__(self, test, metric, unit, baseline, current):
+        self.test = test
+        self.metric = metric
+        self.unit = unit
+        self.baseline = baseline
+        self.current = current
+
+    @property
+    def change(self):
+        return (self.current - self.baseline) / self.baseline
+
+    def __str__(self):
+        return "{} {}: {:.6g} {} -> {:.6g} {} ({:+.1%})".format(
+            self.test, self.metric, self.baseline, self.unit, self.current, self.unit, self.change)
+
+
+class BenchmarkReport(object):
+    """
+    The metrics recorded by the benchmarks in this run, keyed by test id then
+    metric name. Each metric keeps its raw samples as well as their summary, so
+    later runs can be compared with any statistic.
+
+    Benchmarks record metrics as user properties of the test (see the benchmark
+    fixture), so they reach the xdist controller along with the test reports.
+    """
+
+    def __init__(self):
+        self.tests = {}
+
+    def add_report(self, report):
+        if report.when != "call" or not report.passed:
+            return
+
+        for name, value in report.user_properties:
+            if name == "benchmark":
+                test = self.tests.setdefault(
+                    report.nodeid, {"params": value["params"], "metrics": {}})
+                metric = dict(value)
+                del metric["params"]
+                metric.update(summarize(metric["samples"]))
+                if metric.pop("histogram", False):
+                    metric["histogram"] = Histogram(metric["samples"]).as_dict()
+                test["metrics"][metric.pop("metric")] = metric
+
+    def __len__(self):
+        return len(self.tests)
+
+    def as_dict(self):
+        return {
+            "version": REPORT_VERSION,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "machine": {
+                "platform": platform.platform(),
+                "processor": platform.machine(),
+                "cpus": os.cpu_count(),
+            },
+            "tests": self.tests,
+        }
+
+    def write(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(self.as_dict(), f, indent=2, sort_keys=True)
+            f.write("\n")
+
+    def compare(self, baseline_path, threshold):
+        """
+        Return a Regression for each metric whose median is worse than in the report
+        at baseline_path by more than threshold, a fraction of the baseline. Metrics
+        which aren't in the baseline are not compared.
+        """
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        if baseline.get("version") != REPORT_VERSION:
+            raise ValueError("{} is version {} of the benchmark report, not {}".format(
+                baseline_path, baseline.get("version"), REPORT_VERSION))
+
+        regressions = []
+        for test, results in sorted(self.tests.items()):
+            baseline_test = baseline["tests"].get(test, {})
+            baseline_metrics = baseline_test.get("metrics", {})
+            for name, metric in sorted(results["metrics"].items()):
+                if name not in baseline_metrics or not baseline_metrics[name]["p50"]:
+                    continue
+
+                before = baseline_metrics[name]["p50"]
+                after = metric["p50"]
+                if metric["higher_is_better"]:
+                    regressed = after < before * (1 - threshold)
+                else:
+                    regressed = after > before * (1 + threshold)
+                if regressed:
+                    regressions.append(Regression(
+                        test, name, metric["unit"], before, after))
+        return regressions
+
+    def format_table(self):
+        """
+        Return a line for each metric, with its median and spread.
+        """
+        lines = []
+        for test, results in sorted(self.tests.items()):
+            for name, metric in sorted(results["metrics"].items()):
+                lines.append("{} {}: p50 {:.6g} {}, p90 {:.6g}, p99 {:.6g} ({} samples)".format(
+                    test, name, metric["p50"], metric["unit"], metric["p90"], metric["p99"], metric["count"]))
+        return lines
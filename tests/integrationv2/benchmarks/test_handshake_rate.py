@@ -0,0 +1,133 @@
+import copy
+import pytest
+
+from configuration import available_ports
+from common import ProviderOptions, Certificates, Cipher, Protocols, BatchConnection
+from fixtures import managed_process, benchmark
+from providers import Provider, S2N
+from utils import invalid_test_parameters, get_parameter_name
+
+
+# Benchmarks measure the library, not whether it still behaves the same
+pytestmark = pytest.mark.no_result_cache
+
+# Each client makes this many connections from one s2nc process (see
+# BatchConnection), so starting the process is a small part of the time
+HANDSHAKES_PER_CLIENT = 20
+
+# How many clients connect at the same time
+CONCURRENCY = [1, 8]
+
+CERTIFICATES = [
+    Certificates.RSA_2048_SHA256,
+    Certificates.RSA_3072_SHA256,
+    Certificates.RSA_4096_SHA256,
+    Certificates.ECDSA_256,
+    Certificates.ECDSA_384,
+]
+
+# Security policies which negotiate AES-GCM with ECDHE for either kind of
+# certificate, rather than every cipher s2n supports, so the handshakes use the
+# ciphers and key exchanges a server would
+TLS12_POLICY = Cipher("20190214_gcm", Protocols.TLS10, False, False, s2n=True)
+TLS13_POLICY = Cipher("default_tls13", Protocols.TLS10, False, False, s2n=True)
+
+
+@pytest.mark.uncollect_if(func=invalid_test_parameters)
+@pytest.mark.parametrize("certificate", CERTIFICATES, ids=get_parameter_name)
+@pytest.mark.parametrize("protocol", [Protocols.TLS13, Protocols.TLS12], ids=get_parameter_name)
+@pytest.mark.parametrize("provider", [S2N], ids=get_parameter_name)
+@pytest.mark.parametrize("resumed", [False, True], ids=["full", "resumed"])
+@pytest.mark.parametrize("clients", CONCURRENCY, ids=get_parameter_name)
+def test_s2n_server_handshake_rate(managed_process, benchmark, tmp_path, certificate, protocol, provider, resumed,
+                                   clients):
+    """
+    Measures how many handshakes s2nd completes per second with clients connecting at
+    once, how long each one takes the client, and how much CPU s2nd spends per handshake.
+
+    s2nd handles each connection in its own process (--parallelize), so it uses every
+    CPU. It exits after the last connection, once its handlers have finished, so its
+    resource usage includes theirs.
+
+    Resumed handshakes all resume one session, from a ticket saved by a full handshake
+    before the clients start, so every measured handshake is resumed.
+    """
+    rates = []
+    latencies = []
+    server_cpu = []
+    for _ in range(benchmark.samples):
+        port = next(available_ports)
+
+        client_options = ProviderOptions(
+            mode=Provider.ClientMode,
+            port=port,
+            cipher=TLS13_POLICY if protocol is Protocols.TLS13 else TLS12_POLICY,
+            insecure=True,
+            use_session_ticket=resumed,
+            protocol=protocol)
+
+        handshakes = clients * HANDSHAKES_PER_CLIENT
+        server_options = copy.copy(client_options)
+        server_options.mode = Provider.ServerMode
+        server_options.key = certificate.key
+        server_options.cert = certificate.cert
+        server_options.reconnects_before_exit = handshakes
+        # Only negotiate, so s2nd closes each connection as soon as the handshake is done
+        server_options.extra_flags = ["--parallelize", "--negotiate"]
+
+        connection = {}
+        if resumed:
+            # s2nd only sends TLS1.3 session tickets along with application data, so the
+            # ticket comes from another s2nd which sends a response. Every s2nd encrypts
+            # tickets with the same default key, so the measured s2nd can decrypt it.
+            ticket_server_options = copy.copy(server_options)
+            ticket_server_options.port = next(available_ports)
+            ticket_server_options.reconnects_before_exit = 1
+            ticket_server_options.extra_flags = [
+                "--https-server", "--https-bench", "1"]
+            ticket_server = managed_process(
+                S2N, ticket_server_options, timeout=30)
+
+            # Not in batch mode, so s2nc reads the response before it hangs up
+            ticket = str(tmp_path / "ticket-{}.pem".format(port))
+            full_options = copy.copy(client_options)
+            full_options.port = ticket_server_options.port
+            full_options.extra_flags = ["--ticket-out", ticket]
+            full = managed_process(provider, full_options,
+                                   timeout=30, send_marker=[])
+            for results in full.get_results():
+                results.assert_success()
+            for results in ticket_server.get_results():
+                results.assert_success()
+            connection["ticket_in"] = ticket
+
+        server = managed_process(S2N, server_options, timeout=300)
+
+        client_options.batch = [BatchConnection(id=str(i), **connection)
+                                for i in range(HANDSHAKES_PER_CLIENT)]
+        # Keep each client's stdin open, so it doesn't stop early
+        client_processes = [managed_process(provider, client_options, timeout=300, send_marker=[])
+                            for _ in range(clients)]
+
+        for client in client_processes:
+            for results in client.get_results():
+                results.assert_success()
+                for connection_results in results.split_batch():
+                    assert connection_results.batch_result["status"] == "ok"
+                    assert connection_results.batch_result["resumed"] == resumed
+                    latencies.append(
+                        connection_results.batch_result["handshake_us"] / 1000.0)
+
+        start = min(client.timestamps.spawn for client in client_processes)
+        end = max(client.timestamps.exit for client in client_processes)
+        rates.append(handshakes / (end - start))
+
+        for results in server.get_results():
+            results.assert_success()
+            server_cpu.append(results.resource_usage.cpu * 1000.0 / handshakes)
+
+    benchmark.record("handshake_rate", rates, "handshakes/s")
+    benchmark.record("handshake_latency", latencies, "ms",
+                     higher_is_better=False)
+    benchmark.record("server_cpu_per_handshake", server_cpu, "ms",
+                     higher_is_better=False)
@@ -0,0 +1,123 @@
+import copy
+import pytest
+import time
+
+from configuration import available_ports
+from common import ProviderOptions, Ciphers, Certificates, Protocols
+from fixtures import managed_process, benchmark
+from providers import Provider, S2N, OpenSSL, GnuTLS
+from utils import invalid_test_parameters, get_parameter_name
+
+
+# Benchmarks measure the library, not whether it still behaves the same
+pytestmark = pytest.mark.no_result_cache
+
+# The number of bytes s2nd sends on each connection. Enough that the socket buffers
+# hold a small fraction of it, so the time to send it is the time for the client
+# to receive it.
+BYTES_PER_CONNECTION = 64 * 1024 * 1024
+
+CIPHERS = [
+    Ciphers.AES128_GCM_SHA256,
+    Ciphers.AES256_GCM_SHA384,
+    Ciphers.CHACHA20_POLY1305_SHA256,
+    Ciphers.ECDHE_RSA_AES128_GCM_SHA256,
+    Ciphers.ECDHE_RSA_AES256_GCM_SHA384,
+    Ciphers.ECDHE_RSA_CHACHA20_POLY1305,
+]
+
+# The maximum fragment length the client asks for, which limits the size of the
+# records s2nd sends. None leaves the records up to s2nd.
+RECORD_SIZES = [None, 4096, 1024]
+
+# How s2nd sizes its records: full records, or records which fit in one TCP segment
+MODES = ["--prefer-throughput", "--prefer-low-latency"]
+
+
+def max_fragment_length_flags(provider, record_size):
+    if record_size is None:
+        return []
+    if provider is S2N:
+        return ["--mfl", str(record_size)]
+    if provider is OpenSSL:
+        return ["-maxfraglen", str(record_size)]
+    return None
+
+
+def invalid_throughput_parameters(*args, **kwargs):
+    # Only some clients can ask for a record size
+    if max_fragment_length_flags(kwargs.get('provider'), kwargs.get('record_size')) is None:
+        return True
+
+    return invalid_test_parameters(*args, **kwargs)
+
+
+@pytest.mark.uncollect_if(func=invalid_throughput_parameters)
+@pytest.mark.parametrize("cipher", CIPHERS, ids=get_parameter_name)
+@pytest.mark.parametrize("provider", [S2N, OpenSSL, GnuTLS], ids=get_parameter_name)
+@pytest.mark.parametrize("other_provider", [S2N], ids=get_parameter_name)
+@pytest.mark.parametrize("protocol", [Protocols.TLS13, Protocols.TLS12], ids=get_parameter_name)
+@pytest.mark.parametrize("record_size", RECORD_SIZES, ids=get_parameter_name)
+@pytest.mark.parametrize("mode", MODES, ids=get_parameter_name)
+def test_s2n_server_throughput(managed_process, benchmark, cipher, provider, other_provider, protocol,
+                               record_size, mode):
+    """
+    Measures how fast s2nd sends application data to each client, in MB/s.
+
+    Each sample is one connection to the same s2nd, which sends BYTES_PER_CONNECTION
+    bytes as soon as the handshake completes (--https-bench). The time is taken from
+    s2nd's output, between starting to send and having sent the last byte, so it
+    doesn't include the handshake or the client starting and exiting.
+    """
+    port = next(available_ports)
+
+    client_options = ProviderOptions(
+        mode=Provider.ClientMode,
+        port=port,
+        cipher=cipher,
+        insecure=True,
+        protocol=protocol,
+        extra_flags=max_fragment_length_flags(provider, record_size),
+        debug=False)
+
+    server_options = copy.copy(client_options)
+    server_options.mode = Provider.ServerMode
+    server_options.key = Certificates.RSA_2048_SHA256.key
+    server_options.cert = Certificates.RSA_2048_SHA256.cert
+    server_options.reconnects_before_exit = benchmark.samples
+    server_options.extra_flags = ["--https-server", "--https-bench", str(BYTES_PER_CONNECTION),
+                                  "--enable-mfl", mode]
+
+    server = managed_process(
+        S2N, server_options, timeout=30 + 30 * benchmark.samples)
+
+    samples = []
+    for _ in range(benchmark.samples):
+        stdout_length = server.output_lengths()["stdout"]
+        sending = server.watch_for("Sending", start=stdout_length)
+        done = server.watch_for(
+            "Done. Closing connection.", start=stdout_length)
+        # Each watch resolves on the event loop as soon as its marker is read, so
+        # the times aren't delayed by this thread
+        times = {}
+        for watch in [sending, done]:
+            watch.add_done_callback(
+                lambda watch: times.setdefault(watch, time.monotonic()))
+
+        # Keep the client's stdin open until it exits. Closing it would end the
+        # connection before all the data arrives.
+        client = managed_process(
+            provider, client_options, timeout=30, send_marker=[])
+        for results in client.get_results():
+            results.assert_success()
+
+        done.result(timeout=5)
+        elapsed = times[done] - times[sending]
+        samples.append(BYTES_PER_CONNECTION / elapsed / 1e6)
+
+    for results in server.get_results():
+        results.assert_success()
+        closed = results.stdout.count(b"Done. Closing connection.")
+        assert closed == benchmark.samples
+
+    benchmark.record("throughput", samples, "MB/s")
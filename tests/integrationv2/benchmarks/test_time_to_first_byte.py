@@ -0,0 +1,128 @@
+import copy
+import pytest
+import re
+
+from configuration import available_ports
+from common import ProviderOptions, Certificates, Cipher, Protocols, data_bytes
+from fixtures import managed_process, benchmark, loopback_mtu
+from providers import Provider, S2N
+from utils import to_bytes
+
+
+# Benchmarks measure the library, not whether it still behaves the same
+pytestmark = pytest.mark.no_result_cache
+
+# s2nc and s2nd print these with --timestamps, in nanoseconds on the monotonic clock
+FIRST_BYTE_SENT = re.compile(rb"First byte sent at (\d+) ns")
+FIRST_BYTE_RECEIVED = re.compile(rb"First byte received at (\d+) ns")
+
+# The application data sent on each connection, in one write. Larger than the
+# largest record, so the first record is as large as the sender makes it.
+BYTES_PER_CONNECTION = 64 * 1024
+
+# Each sample is the time to first byte of one connection, so the histograms
+# have this many times --benchmark-samples connections
+CONNECTIONS_PER_SAMPLE = 20
+
+# Both peers are s2n, so a cipher is chosen with a security policy which
+# negotiates it. Keyed by the cipher each policy negotiates.
+CIPHERS = {
+    "TLS_AES_128_GCM_SHA256": "default_tls13",
+    "TLS_AES_256_GCM_SHA384": "20190801",
+    "ECDHE-RSA-AES128-GCM-SHA256": "20190214_gcm",
+}
+
+# The maximum fragment length the client asks for, which limits the size of
+# every record. None leaves the records up to the sender.
+RECORD_SIZES = [None, 4096, 1024]
+
+# The loopback's MTU. 1500 splits large records across several TCP segments, as
+# most networks would.
+MTUS = [65536, 1500]
+
+# How the sender sizes its records. s2nd sends --https-bench with
+# --prefer-low-latency or --prefer-throughput; s2nc sends its input with a
+# --dynamic record threshold, so the first DYNAMIC_THRESHOLD bytes go in records
+# which fit in one TCP segment and the rest in full records.
+MODES = ["--prefer-low-latency", "--prefer-throughput", "--dynamic"]
+DYNAMIC_THRESHOLD = 16 * 1024
+
+
+def first_byte_times(pattern, results):
+    return [int(time) for time in pattern.findall(results.stdout)]
+
+
+@pytest.mark.parametrize("cipher", CIPHERS)
+@pytest.mark.parametrize("record_size", RECORD_SIZES, ids=lambda record_size: "record-size-{}".format(record_size))
+@pytest.mark.parametrize("mtu", MTUS, ids=lambda mtu: "mtu-{}".format(mtu))
+@pytest.mark.parametrize("mode", MODES)
+def test_s2n_time_to_first_byte(managed_process, benchmark, loopback_mtu, cipher, record_size, mtu, mode):
+    """
+    Measures how long the first byte of application data takes to reach the peer, in
+    microseconds, from when the sender starts to send it. The distribution is recorded
+    as a histogram, to tune the record sizes with.
+
+    Both peers print the time of the first byte on the same clock (--timestamps), so
+    the time doesn't include the processes starting or the handshake. Each connection
+    is new, so the data is sent with the initial TCP congestion window. s2nd sends as
+    soon as its handshake is done, when s2nc may still be finishing its own, so on a
+    busy machine the low end of the histogram shows the record sizes best.
+    """
+    loopback_mtu(mtu)
+
+    port = next(available_ports)
+    connections = benchmark.samples * CONNECTIONS_PER_SAMPLE
+    mfl_flags = [] if record_size is None else ["--mfl", str(record_size)]
+
+    client_options = ProviderOptions(
+        mode=Provider.ClientMode,
+        port=port,
+        cipher=Cipher(CIPHERS[cipher], Protocols.TLS10, False, False, s2n=True),
+        insecure=True,
+        extra_flags=["--timestamps"] + mfl_flags)
+
+    server_options = copy.copy(client_options)
+    server_options.mode = Provider.ServerMode
+    server_options.key = Certificates.RSA_2048_SHA256.key
+    server_options.cert = Certificates.RSA_2048_SHA256.cert
+    server_options.reconnects_before_exit = connections
+    server_options.extra_flags = ["--timestamps", "--enable-mfl"]
+
+    if mode == "--dynamic":
+        client_options.data_to_send = data_bytes(BYTES_PER_CONNECTION)
+        client_options.extra_flags = client_options.extra_flags + [
+            "--dynamic", str(DYNAMIC_THRESHOLD), "--timeout", "1"]
+        client_marker, server_marker = FIRST_BYTE_SENT, FIRST_BYTE_RECEIVED
+    else:
+        server_options.extra_flags = server_options.extra_flags + [
+            "--https-server", "--https-bench", str(BYTES_PER_CONNECTION), mode]
+        client_marker, server_marker = FIRST_BYTE_RECEIVED, FIRST_BYTE_SENT
+
+    # Keep s2nd's stdin open, so it keeps echoing what s2nc sends
+    server = managed_process(
+        S2N, server_options, timeout=30 + connections, send_marker=[])
+
+    client_times = []
+    for _ in range(connections):
+        # Without input, keep s2nc's stdin open until it has all of s2nd's data
+        client = managed_process(S2N, client_options, timeout=10,
+                                 send_marker=None if client_options.data_to_send else [])
+        for results in client.get_results():
+            results.assert_success()
+            negotiated = "Cipher negotiated: {}".format(cipher)
+            assert to_bytes(negotiated) in results.stdout
+            client_times.extend(first_byte_times(client_marker, results))
+
+    for results in server.get_results():
+        results.assert_success()
+        server_times = first_byte_times(server_marker, results)
+
+    assert len(client_times) == len(server_times) == connections
+    if mode == "--dynamic":
+        sent, received = client_times, server_times
+    else:
+        sent, received = server_times, client_times
+    samples = [(end - start) / 1000.0 for start, end in zip(sent, received)]
+
+    benchmark.record("time_to_first_byte", samples, "us",
+                     higher_is_better=False, histogram=True)
@@ -0,0 +1,73 @@
+from global_flags import get_flag, S2N_FIPS_MODE, S2N_PROVIDER_VERSION
+
+
+_tables = {}
+
+
+def _protocol_key(protocol):
+    # Protocols compare by value but aren't hashable
+    return protocol.value if protocol is not None else None
+
+
+class CapabilityTable(object):
+    """
+    What each provider supports, for one libcrypto.
+
+    Deselecting tests asks every provider about every combination of protocol,
+    cipher, curve, certificate and signature, and the answers only depend on the
+    provider and the libcrypto. Each answer is computed the first time it's asked
+    for, then looked up in a dict.
+
+    Certificates, curves and signatures are keyed by identity, so the table keeps
+    a reference to each one it has seen. They are module level constants, so that
+    costs nothing.
+    """
+
+    def __init__(self, libcrypto=None):
+        self.libcrypto = libcrypto
+        self._protocols = {}
+        self._ciphers = {}
+        self._signatures = {}
+
+    def supports_protocol(self, provider, protocol, with_cert=None):
+        key = (provider, _protocol_key(protocol), with_cert)
+        try:
+            return self._protocols[key]
+        except KeyError:
+            supported = provider.supports_protocol(
+                protocol, with_cert=with_cert)
+            self._protocols[key] = supported
+            return supported
+
+    def supports_cipher(self, provider, cipher, with_curve=None):
+        key = (provider, cipher, with_curve)
+        try:
+            return self._ciphers[key]
+        except KeyError:
+            supported = provider.supports_cipher(cipher, with_curve=with_curve)
+            self._ciphers[key] = supported
+            return supported
+
+    def supports_signature(self, provider, signature):
+        key = (provider, signature)
+        try:
+            return self._signatures[key]
+        except KeyError:
+            supported = provider.supports_signature(signature)
+            self._signatures[key] = supported
+            return supported
+
+    def __len__(self):
+        return len(self._protocols) + len(self._ciphers) + len(self._signatures)
+
+
+def get_capabilities():
+    """
+    The CapabilityTable for the libcrypto under test. The table lasts for the whole
+    session, unless the provider version or FIPS mode flags change.
+    """
+    libcrypto = (get_flag(S2N_PROVIDER_VERSION), get_flag(S2N_FIPS_MODE))
+    table = _tables.get(libcrypto)
+    if table is None:
+        table = _tables[libcrypto] = CapabilityTable(libcrypto)
+    return table
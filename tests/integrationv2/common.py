@@ -1,33 +1,118 @@
+import atexit
+import collections
+import errno
+import fcntl
+import functools
 import os
+import mmap
 import re
+import shutil
+import socket
 import subprocess
+import sys
 import string
+import tempfile
 import threading
 import itertools
+import json
 
 
 from constants import TEST_CERT_DIRECTORY
 from global_flags import get_flag, S2N_NO_PQ, S2N_FIPS_MODE
 
 
+# Every payload repeats these bytes
+_DATA_PATTERN = bytes(range(128, 255))
+
+# Payloads up to this size are kept in memory by data_bytes
+DATA_BYTES_CACHE_LIMIT = 1024 * 1024
+
+# Payloads larger than this are written to data_file in chunks
+_DATA_FILE_CHUNK = len(_DATA_PATTERN) * 8192
+
+_data_files = {}
+_data_views = {}
+_data_lock = threading.Lock()
+_data_directory = None
+
+
 def data_bytes(n_bytes):
     """
     Generate bytes to send over the TLS connection.
     These bytes purposefully fall outside of the ascii range
     to prevent triggering "connected commands" present in
     some SSL clients.
+
+    Payloads are built by repeating a fixed pattern, and small ones are cached,
+    so calling this for every parametrization is cheap. The result is immutable
+    and shared between callers.
+    """
+    if n_bytes <= DATA_BYTES_CACHE_LIMIT:
+        return _cached_data_bytes(n_bytes)
+    return _build_data_bytes(n_bytes)
+
+
+def _build_data_bytes(n_bytes):
+    repeats, remainder = divmod(n_bytes, len(_DATA_PATTERN))
+    return _DATA_PATTERN * repeats + _DATA_PATTERN[:remainder]
+
+
+@functools.lru_cache(maxsize=128)
+def _cached_data_bytes(n_bytes):
+    return _build_data_bytes(n_bytes)
+
+
+def data_file(n_bytes):
     """
-    byte_array = [0] * n_bytes
-    allowed = [i for i in range(128, 255)]
+    Return the path of a file containing data_bytes(n_bytes). Each size is only
+    written once per worker, a chunk at a time, so payloads much larger than
+    memory can be used. An open file can be passed as data_to_send, and is
+    copied to the process with sendfile().
+    """
+    global _data_directory
+
+    with _data_lock:
+        path = _data_files.get(n_bytes)
+        if path is not None:
+            return path
 
-    j = 0
-    for i in range(n_bytes):
-        byte_array[i] = allowed[j]
-        j += 1
-        if j > 126:
-            j = 0
+        if _data_directory is None:
+            _data_directory = tempfile.mkdtemp(prefix="s2n-integ-data-")
+            atexit.register(shutil.rmtree, _data_directory, True)
 
-    return bytes(byte_array)
+        path = os.path.join(_data_directory, "data-{}".format(n_bytes))
+        # Each chunk is a whole number of patterns, so chunks join seamlessly
+        chunk = _build_data_bytes(min(n_bytes, _DATA_FILE_CHUNK))
+        with open(path, "wb") as f:
+            remaining = n_bytes
+            while remaining > len(chunk):
+                f.write(chunk)
+                remaining -= len(chunk)
+            f.write(chunk[:remaining])
+
+        _data_files[n_bytes] = path
+        return path
+
+
+def data_view(n_bytes):
+    """
+    Return a read-only memoryview of data_bytes(n_bytes), backed by an mmap of
+    data_file(n_bytes). The pages are shared by every caller, and the view can be
+    sent to a process without copying it.
+    """
+    path = data_file(n_bytes)
+
+    with _data_lock:
+        view = _data_views.get(n_bytes)
+        if view is None:
+            if n_bytes == 0:
+                view = memoryview(b"")
+            else:
+                with open(path, "rb") as f:
+                    view = memoryview(
+                        mmap.mmap(f.fileno(), n_bytes, access=mmap.ACCESS_READ))
+            _data_views[n_bytes] = view
+        return view
 
 
 def pq_enabled():
@@ -37,32 +122,59 @@ def pq_enabled():
     return not (get_flag(S2N_NO_PQ, False) or get_flag(S2N_FIPS_MODE, False))
 
 
+# Number of ports each AvailablePorts keeps reserved. Tests don't return their
+# ports, so the oldest reservation is recycled once this many are held.
+PORTS_HELD = 64
+
+
 class AvailablePorts(object):
     """
-    This iterator will atomically return the next number.
+    This iterator will atomically return the next free port.
     This is useful when running multiple tests in parallel
     that all need unique port numbers.
+
+    A port is reserved across every xdist worker (and every concurrent test run
+    by the same user) by holding an flock on a lock file named after it, so
+    reservations are dropped by the kernel if a worker dies. Before a port is
+    handed out it is probed with bind(), which skips ports that are in use or in
+    TIME_WAIT, including those used by other users' tests. Reservations are
+    recycled through a free list.
     """
 
-    def __init__(self, low=8000, high=30000):
-        worker_count = int(os.getenv('PYTEST_XDIST_WORKER_COUNT'))
-        chunk_size = int((high - low) / worker_count)
+    def __init__(self, low=8000, high=30000, lock_dir=None, held=PORTS_HELD):
+        worker_count = int(os.getenv('PYTEST_XDIST_WORKER_COUNT') or 1)
+        chunk_size = int((high - low) / max(worker_count, 1))
 
-        # If xdist is being used, parse the workerid from the envvar. This can
-        # be used to allocate unique ports to each worker.
+        # If xdist is being used, parse the workerid from the envvar. Each
+        # worker starts in its own part of the range, so workers rarely compete
+        # for the same lock files.
         worker = os.getenv('PYTEST_XDIST_WORKER')
         worker_id = 0
         if worker is not None:
-            worker_id = re.findall('gw(\d+)', worker)
+            worker_id = re.findall(r'gw(\d+)', worker)
             if len(worker_id) != 0:
                 worker_id = int(worker_id[0])
+            else:
+                worker_id = 0
 
-        # This is a naive way to allocate ports, but it allows us to cut
-        # the run time in half without workers colliding.
-        worker_offset = (worker_id * chunk_size)
+        worker_offset = (worker_id * chunk_size) % (high - low)
         base_range = range(low + worker_offset, high)
         wrap_range = range(low, low + worker_offset)
-        self.ports = iter(itertools.chain(base_range, wrap_range))
+        self.ports = itertools.cycle(itertools.chain(base_range, wrap_range))
+        self.low = low
+        self.high = high
+        self.range_size = high - low
+
+        # Lock files created by another user wouldn't be writable, so each user
+        # has their own directory
+        self.lock_dir = lock_dir or os.path.join(
+            tempfile.gettempdir(), "s2n-integ-ports-{}".format(os.getuid()))
+        os.makedirs(self.lock_dir, exist_ok=True)
+
+        # Reserved ports, oldest first, mapped to their lock file descriptors
+        self.held_limit = held
+        self.held = collections.OrderedDict()
+        self.free = collections.deque()
 
         self.lock = threading.Lock()
 
@@ -71,7 +183,87 @@ class AvailablePorts(object):
 
     def __next__(self):
         with self.lock:
-            return next(self.ports)
+            # Ports on the free list were handed out before, so they are only
+            # retried once per pass through the range.
+            for _ in range(len(self.free)):
+                port = self.free.popleft()
+                if self._reserve(port):
+                    return port
+
+            for _ in range(self.range_size):
+                port = next(self.ports)
+                if self._reserve(port):
+                    return port
+
+        raise RuntimeError(
+            "No free ports between {} and {}".format(self.low, self.high))
+
+    def release(self, port):
+        """
+        Return a port, so it can be handed out again.
+        """
+        with self.lock:
+            self._release(port)
+
+    def _release(self, port):
+        fd = self.held.pop(port, None)
+        if fd is not None:
+            os.close(fd)
+            self.free.append(port)
+
+    def _reserve(self, port):
+        if port in self.held:
+            return False
+
+        lock_path = os.path.join(self.lock_dir, "{}.lock".format(port))
+        try:
+            fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+        except OSError:
+            # The lock file can't be opened, so the port can't be reserved
+            return False
+
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            # Another worker has reserved this port
+            os.close(fd)
+            return False
+
+        if not self._probe(port):
+            os.close(fd)
+            return False
+
+        self.held[port] = fd
+        while len(self.held) > self.held_limit:
+            self._release(next(iter(self.held)))
+
+        return True
+
+    @staticmethod
+    def _probe(port):
+        """
+        Check that nothing is bound to the port. SO_REUSEADDR isn't set, so a
+        connection in TIME_WAIT also fails the probe.
+        """
+        families = [socket.AF_INET]
+        if socket.has_ipv6:
+            families.append(socket.AF_INET6)
+
+        for family in families:
+            try:
+                with socket.socket(family, socket.SOCK_STREAM) as sock:
+                    if family == socket.AF_INET6:
+                        sock.setsockopt(socket.IPPROTO_IPV6,
+                                        socket.IPV6_V6ONLY, 1)
+                    host = "::" if family == socket.AF_INET6 else "0.0.0.0"
+                    sock.bind((host, port))
+            except OSError as ex:
+                # IPv6 may be compiled in, but disabled
+                if ex.errno in (errno.EAFNOSUPPORT, errno.EADDRNOTAVAIL):
+                    continue
+                return False
+
+        return True
 
 
 class TimeoutException(subprocess.SubprocessError):
@@ -403,17 +595,90 @@ class Signatures(object):
         sig_digest='SHA256')
 
 
+class ResourceUsage(object):
+    """
+    Resources used by a process, as reported by os.wait4 when it was reaped.
+    """
+
+    def __init__(self, user_cpu, system_cpu, max_rss, voluntary_context_switches,
+                 involuntary_context_switches):
+        # CPU time in seconds
+        self.user_cpu = user_cpu
+        self.system_cpu = system_cpu
+
+        # Peak resident set size in bytes. Linux carries the peak over from the
+        # forked test runner into the exec'd program, so compare this between runs
+        # rather than reading it as the program's own footprint.
+        self.max_rss = max_rss
+
+        self.voluntary_context_switches = voluntary_context_switches
+        self.involuntary_context_switches = involuntary_context_switches
+
+    @classmethod
+    def from_rusage(cls, rusage):
+        # Linux reports ru_maxrss in kilobytes
+        return cls(rusage.ru_utime, rusage.ru_stime, rusage.ru_maxrss * 1024,
+                   rusage.ru_nvcsw, rusage.ru_nivcsw)
+
+    @property
+    def cpu(self):
+        return self.user_cpu + self.system_cpu
+
+    def as_dict(self):
+        return dict(vars(self))
+
+    def __str__(self):
+        return "user {:.3f}s, sys {:.3f}s, max rss {} KiB, ctx switches {}/{}".format(
+            self.user_cpu, self.system_cpu, self.max_rss // 1024,
+            self.voluntary_context_switches, self.involuntary_context_switches)
+
+
+class ProcessTimestamps(object):
+    """
+    When a process reached each stage of its life, in time.monotonic() seconds.
+    A stage the process never reached is None.
+    """
+
+    def __init__(self, spawn=None, ready=None, first_byte=None, exit=None):
+        self.spawn = spawn
+        self.ready = ready
+        self.first_byte = first_byte
+        self.exit = exit
+
+    @staticmethod
+    def _since(start, end):
+        if start is None or end is None:
+            return None
+        return end - start
+
+    @property
+    def startup_latency(self):
+        """Seconds from launching the process until it was ready for testing"""
+        return self._since(self.spawn, self.ready)
+
+    @property
+    def time_to_first_byte(self):
+        """Seconds from launching the process until it first wrote any output"""
+        return self._since(self.spawn, self.first_byte)
+
+    @property
+    def lifetime(self):
+        """Seconds from launching the process until it exited"""
+        return self._since(self.spawn, self.exit)
+
+    def as_dict(self):
+        return dict(vars(self))
+
+
 class Results(object):
     """
     An instance of this object will be returned to the test by a managed_process'
     get_results() method.
-    """
-
-    # Byte array containing the standard output of the process
-    stdout = None
 
-    # Byte array containing the standard error of the process
-    stderr = None
+    stdout and stderr may be given as bytes, or as an output capture from a
+    ManagedProcess. A capture is only copied into bytes the first time the
+    attribute is read; stdout_view() and stderr_view() avoid the copy entirely.
+    """
 
     # Exit code of the process
     exit_code = None
@@ -421,13 +686,56 @@ class Results(object):
     # Any exception thrown while running the process
     exception = None
 
-    def __init__(self, stdout, stderr, exit_code, exception, expect_stderr=False, expect_nonzero_exit=False):
-        self.stdout = stdout
-        self.stderr = stderr
+    # ResourceUsage of the process, if it was reaped by a ManagedProcess
+    resource_usage = None
+
+    # ProcessTimestamps of the process, if it was run by a ManagedProcess
+    timestamps = None
+
+    def __init__(self, stdout, stderr, exit_code, exception, expect_stderr=False, expect_nonzero_exit=False,
+                 resource_usage=None, timestamps=None):
+        self._stdout = stdout
+        self._stderr = stderr
         self.exit_code = exit_code
         self.exception = exception
         self.expect_stderr = expect_stderr
         self.expect_nonzero_exit = expect_nonzero_exit
+        self.resource_usage = resource_usage
+        self.timestamps = timestamps
+
+    @staticmethod
+    def _materialize(output):
+        if output is None or isinstance(output, bytes):
+            return output
+        return output.getvalue()
+
+    @staticmethod
+    def _view(output):
+        if output is None:
+            return None
+        if isinstance(output, bytes):
+            return memoryview(output)
+        return output.view()
+
+    @property
+    def stdout(self):
+        """Byte array containing the standard output of the process"""
+        self._stdout = self._materialize(self._stdout)
+        return self._stdout
+
+    @property
+    def stderr(self):
+        """Byte array containing the standard error of the process"""
+        self._stderr = self._materialize(self._stderr)
+        return self._stderr
+
+    def stdout_view(self):
+        """Read-only memoryview of the standard output, without copying it"""
+        return self._view(self._stdout)
+
+    def stderr_view(self):
+        """Read-only memoryview of the standard error, without copying it"""
+        return self._view(self._stderr)
 
     def __str__(self):
         return "Stdout: {}\nStderr: {}\nExit code: {}\nException: {}".format(self.stdout, self.stderr, self.exit_code, self.exception)
@@ -442,6 +750,107 @@ class Results(object):
     def output_streams(self):
         return {self.stdout, self.stderr}
 
+    def split_batch(self):
+        """
+        Split the results of a client run with ProviderOptions.batch into one Results
+        per connection, in the order they were listed.
+
+        Each connection's stdout is the output since the previous connection's
+        result line, up to and including its own. The result line is parsed into
+        the batch_result dict, e.g. {"id": "resume-1", "status": "ok",
+        "resumed": true, ...}. stderr can't be split by connection, so a failed
+        connection's stderr is its error message, and exit_code is 1.
+
+        A client that stopped early has fewer results than connections.
+        """
+        results = []
+        start = 0
+        stdout = self.stdout or b""
+        while True:
+            marker = stdout.find(BATCH_RESULT_MARKER, start)
+            if marker < 0:
+                break
+            end = stdout.find(b"\n", marker)
+            end = len(stdout) if end < 0 else end + 1
+
+            batch_result = json.loads(
+                stdout[marker + len(BATCH_RESULT_MARKER):end].decode("utf-8"))
+            failed = batch_result["status"] != "ok"
+            error = batch_result.get("error", "").encode("utf-8")
+            connection_results = Results(stdout[start:end],
+                                         error,
+                                         1 if failed else 0,
+                                         self.exception,
+                                         expect_stderr=self.expect_stderr,
+                                         expect_nonzero_exit=self.expect_nonzero_exit)
+            connection_results.batch_result = batch_result
+            results.append(connection_results)
+            start = end
+
+        return results
+
+
+class Transports(object):
+    """
+    How a client reaches a server. Every provider can use TCP. Providers which
+    support another transport use it when it's requested, and TCP otherwise.
+    """
+    TCP = "tcp"
+
+    # Unix domain sockets skip the loopback TCP stack, so there is no TIME_WAIT
+    # and no kernel TCP behaviour (Nagle, segmentation) in the measurements.
+    UNIX = "unix"
+
+
+# s2nc --batch prints this before the JSON result of each connection
+BATCH_RESULT_MARKER = b"Batch result: "
+
+
+class BatchConnection(object):
+    """
+    One of the connections a client makes in batch mode, see ProviderOptions.batch.
+    Anything left as None is taken from the client's ProviderOptions.
+    """
+
+    def __init__(self, id=None, cipher=None, server_name=None, resume=False, ticket_in=None, ticket_out=None):
+        # Label for the connection's results. Defaults to its index.
+        self.id = id
+
+        # A Cipher, or the name of a security policy
+        self.cipher = cipher
+
+        # SNI server name
+        self.server_name = server_name
+
+        # Resume the session of the previous connection in the batch
+        self.resume = resume
+
+        # Paths to read the session ticket from, or write it to
+        self.ticket_in = ticket_in
+        self.ticket_out = ticket_out
+
+    def to_line(self):
+        fields = []
+        if self.id is not None:
+            fields.append("id={}".format(self.id))
+        if self.cipher is not None:
+            fields.append("cipher={}".format(
+                getattr(self.cipher, "name", self.cipher)))
+        if self.server_name is not None:
+            fields.append("name={}".format(self.server_name))
+        if self.ticket_in is not None:
+            fields.append("ticket-in={}".format(self.ticket_in))
+        if self.ticket_out is not None:
+            fields.append("ticket-out={}".format(self.ticket_out))
+        if self.resume:
+            fields.append("resume")
+
+        for field in fields:
+            if any(c.isspace() for c in field):
+                raise ValueError(
+                    "Batch fields can't contain whitespace: {}".format(field))
+        return " ".join(fields)
+
 
 class ProviderOptions(object):
     def __init__(
@@ -469,7 +878,11 @@ class ProviderOptions(object):
             enable_client_ocsp=False,
             ocsp_response=None,
             signature_algorithm=None,
-            record_size=None
+            record_size=None,
+            transport=Transports.TCP,
+            batch=None,
+            debug=True,
+            mark_closed_connections=False
     ):
 
         # Client or server
@@ -543,3 +956,41 @@ class ProviderOptions(object):
         self.signature_algorithm = signature_algorithm
 
         self.record_size = record_size
+
+        # One of Transports. Providers which only speak TCP ignore it.
+        self.transport = transport
+
+        # A list of BatchConnection: the client makes each connection in turn from
+        # one process, instead of one process per connection. Split the client's
+        # Results with Results.split_batch().
+        self.batch = batch
+
+        # Boolean whether the provider logs each record and state change, which is
+        # captured in case of failure. Benchmarks turn it off, so they don't measure
+        # how fast the provider can print.
+        self.debug = debug
+
+        # Boolean whether a server marks the end of each connection in its output,
+        # so the ServerPool can reuse it. Servers which always do ignore it.
+        self.mark_closed_connections = mark_closed_connections
+
+    @property
+    def unix_socket(self):
+        """
+        The Unix socket used with Transports.UNIX. It's named after the port, so the
+        client and server agree on it without any setup, and reserving the port
+        reserves the name. On Linux it's in the abstract namespace, so there is no
+        socket file to clean up.
+        """
+        name = "s2n-integ-{}".format(self.port)
+        if sys.platform.startswith("linux"):
+            return "@" + name
+        return os.path.join(tempfile.gettempdir(), name + ".sock")
+
+    @property
+    def batch_file(self):
+        """
+        The file listing the connections of a batch client, one per line. Like
+        unix_socket, it's named after the port.
+        """
+        return os.path.join(tempfile.gettempdir(), "s2n-integ-{}.batch".format(self.port))
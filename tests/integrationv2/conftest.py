@@ -1,5 +1,21 @@
+import os
 import pytest
-from global_flags import set_flag, S2N_PROVIDER_VERSION, S2N_FIPS_MODE, S2N_NO_PQ
+import subprocess
+
+from benchmark_report import BenchmarkReport
+from durations import DurationDatabase, DEFAULT_MAX_WORKERS, cpu_time
+from event_log import close_event_log, open_event_log, set_current_test
+from global_flags import get_flag, set_flag, S2N_PROVIDER_VERSION, S2N_FIPS_MODE, S2N_NO_PQ, \
+    S2N_LOG_PROCESS_OUTPUT, S2N_CGROUP_ROOT, S2N_COVERAGE_STRENGTH, S2N_TEST_IMPACT, S2N_DURATION_DB, \
+    S2N_RESULT_CACHE, S2N_BENCHMARK_REPORT
+from impact import changed_files, select_tests
+from parametrization import generate_valid_parameters, was_generated
+from result_cache import ResultCache
+
+
+# The benchmarks take much longer than the tests, and shouldn't share the machine
+# with them, so they're only collected when their directory is given, see README.md
+collect_ignore = ["benchmarks"]
 
 
 def pytest_addoption(parser):
@@ -9,6 +25,69 @@ def pytest_addoption(parser):
                      default=False, type=int, help="S2N is running in FIPS mode")
     parser.addoption("--no-pq", action="store", dest="no-pq",
                      default=False, type=int, help="Turn off PQ support")
+    parser.addoption("--event-log-dir", action="store", dest="event-log-dir",
+                     default=None, type=str, help="Write a JSON Lines log of process events to this directory")
+    parser.addoption("--log-process-output", action="store_true", dest="log-process-output",
+                     default=False, help="Print and log the output of every process, not only for failed tests")
+    parser.addoption("--cgroup-root", action="store", dest="cgroup-root", default=None, type=str,
+                     help="A writable cgroup v2 directory, used to kill every child of a process at teardown")
+    parser.addoption("--coverage-strength", action="store", dest="coverage-strength", default=0, type=int,
+                     help="Only run enough parameter combinations to cover every combination of this many "
+                          "parameters, e.g. 2 for pairwise. 0 runs every valid combination")
+    parser.addoption("--changed-since", action="store", dest="changed-since", default=None, type=str,
+                     help="Only run the tests affected by files changed since this git revision, see impact.py")
+    parser.addoption("--duration-db", action="store", dest="duration-db", default=None, type=str,
+                     help="A SQLite database of test durations, used to start the longest tests first")
+    parser.addoption("--auto-workers", action="store_true", dest="auto-workers", default=False,
+                     help="Choose the number of xdist workers from the CPU count and the CPU usage of the tests "
+                          "in --duration-db. Without recorded durations, -n is used")
+    parser.addoption("--max-workers", action="store", dest="max-workers", default=DEFAULT_MAX_WORKERS, type=int,
+                     help="The most xdist workers --auto-workers starts")
+    parser.addoption("--result-cache", action="store", dest="result-cache", default=None, type=str,
+                     help="A SQLite database of passing tests. Tests whose inputs haven't changed since they "
+                          "passed are not run again")
+    parser.addoption("--no-result-cache", action="store_true", dest="no-result-cache", default=False,
+                     help="Run every test, even with --result-cache. Results are still recorded")
+    parser.addoption("--benchmark-json", action="store", dest="benchmark-json", default=None, type=str,
+                     help="Write the metrics recorded by the benchmarks to this JSON file")
+    parser.addoption("--benchmark-baseline", action="store", dest="benchmark-baseline", default=None, type=str,
+                     help="A JSON file written by --benchmark-json. The run fails if a benchmark's median is "
+                          "worse than in this file by more than --benchmark-threshold")
+    parser.addoption("--benchmark-threshold", action="store", dest="benchmark-threshold", default=0.1,
+                     type=float, help="The fraction of the baseline by which a benchmark may regress")
+    parser.addoption("--benchmark-samples", action="store", dest="benchmark-samples", default=5, type=int,
+                     help="The number of times each benchmark measures each metric")
+
+
+def _is_xdist_worker(config):
+    return hasattr(config, 'workerinput')
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_cmdline_main(config):
+    """
+    pytest hook that sets the number of xdist workers for --auto-workers, before
+    xdist reads it.
+    """
+    duration_db = config.getoption('duration-db', None)
+    if config.getoption('auto-workers', False) and duration_db and not _is_xdist_worker(config):
+        durations = DurationDatabase(duration_db)
+        workers = durations.worker_count(
+            max_workers=config.getoption('max-workers'))
+        if workers is not None:
+            config.option.numprocesses = workers
+
+
+@pytest.hookimpl(optionalhook=True)
+def pytest_xdist_auto_num_workers(config):
+    """
+    xdist hook for "-n auto", with versions of xdist which have it.
+    """
+    duration_db = config.getoption('duration-db', None)
+    if duration_db:
+        return DurationDatabase(duration_db).worker_count(
+            max_workers=config.getoption('max-workers'))
+    return None
 
 
 def pytest_configure(config):
@@ -19,6 +98,9 @@ def pytest_configure(config):
     config.addinivalue_line(
         "markers", "uncollect_if(*, func): function to unselect tests from parametrization"
     )
+    config.addinivalue_line(
+        "markers", "no_result_cache: always run the test, because its result depends on more than its inputs"
+    )
 
     no_pq = config.getoption('no-pq', 0)
     fips_mode = config.getoption('fips-mode', 0)
@@ -28,17 +110,193 @@ def pytest_configure(config):
         set_flag(S2N_FIPS_MODE, True)
 
     set_flag(S2N_PROVIDER_VERSION, config.getoption('provider-version', None))
+    set_flag(S2N_LOG_PROCESS_OUTPUT,
+             config.getoption('log-process-output', False))
+    set_flag(S2N_CGROUP_ROOT, config.getoption('cgroup-root', None))
+    set_flag(S2N_COVERAGE_STRENGTH, config.getoption('coverage-strength', 0))
+
+    changed_since = config.getoption('changed-since', None)
+    if changed_since:
+        try:
+            files = changed_files(changed_since)
+        except (OSError, subprocess.CalledProcessError) as e:
+            raise pytest.UsageError("Can't list the files changed since {}: {}".format(
+                changed_since, getattr(e, 'output', None) or e))
+        set_flag(S2N_TEST_IMPACT, select_tests(files))
+
+    duration_db = config.getoption('duration-db', None)
+    if duration_db:
+        set_flag(S2N_DURATION_DB, DurationDatabase(duration_db))
+
+    result_cache = config.getoption('result-cache', None)
+    if result_cache:
+        set_flag(S2N_RESULT_CACHE, ResultCache(result_cache))
+
+    event_log_dir = config.getoption('event-log-dir', None)
+    if event_log_dir:
+        open_event_log(event_log_dir)
+
+    set_flag(S2N_BENCHMARK_REPORT, BenchmarkReport())
+
+
+def pytest_unconfigure(config):
+    close_event_log()
+
+
+def pytest_sessionfinish(session):
+    """
+    Record this run's test durations. With xdist, only the controller does.
+    """
+    durations = get_flag(S2N_DURATION_DB)
+    if durations is not None and not _is_xdist_worker(session.config):
+        durations.flush()
+
+    # Each worker records the results of the tests it ran
+    result_cache = get_flag(S2N_RESULT_CACHE)
+    if result_cache is not None:
+        result_cache.flush()
+
+    # The controller gets every worker's reports, so it writes the benchmark report
+    benchmarks = get_flag(S2N_BENCHMARK_REPORT)
+    if benchmarks is None or _is_xdist_worker(session.config):
+        return
+
+    benchmark_json = session.config.getoption('benchmark-json', None)
+    if benchmark_json:
+        benchmarks.write(benchmark_json)
+
+    baseline = session.config.getoption('benchmark-baseline', None)
+    if baseline:
+        global _benchmark_regressions
+        _benchmark_regressions = benchmarks.compare(
+            baseline, session.config.getoption('benchmark-threshold'))
+        if _benchmark_regressions and session.exitstatus == pytest.ExitCode.OK:
+            session.exitstatus = pytest.ExitCode.TESTS_FAILED
+
+
+_cached_results = 0
+_benchmark_regressions = []
+
+
+def pytest_runtest_logreport(report):
+    global _cached_results
+
+    durations = get_flag(S2N_DURATION_DB)
+    if durations is not None:
+        durations.add_report(report)
+
+    if report.when == "call" and ("result_cache", "hit") in report.user_properties:
+        _cached_results += 1
+
+    benchmarks = get_flag(S2N_BENCHMARK_REPORT)
+    if benchmarks is not None:
+        benchmarks.add_report(report)
+
+
+def pytest_terminal_summary(terminalreporter):
+    if _cached_results:
+        terminalreporter.write_line(
+            "{} passed in an earlier run with the same inputs, and were not run again "
+            "(--no-result-cache runs them)".format(_cached_results))
+
+    benchmarks = get_flag(S2N_BENCHMARK_REPORT)
+    if benchmarks:
+        terminalreporter.write_sep("=", "benchmarks")
+        for line in benchmarks.format_table():
+            terminalreporter.write_line(line)
+
+    if _benchmark_regressions:
+        title = "{} benchmark regressions".format(len(_benchmark_regressions))
+        terminalreporter.write_sep("=", title, red=True)
+        for regression in _benchmark_regressions:
+            terminalreporter.write_line(str(regression))
+
+
+def _uses_result_cache(item):
+    return get_flag(S2N_RESULT_CACHE) is not None and item.get_closest_marker('no_result_cache') is None
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_pyfunc_call(pyfuncitem):
+    """
+    pytest hook that passes a test without calling it, if it passed in an earlier run
+    with the same inputs. Fixtures are still set up, but they are cheap: the test
+    function starts the processes.
+    """
+    if not _uses_result_cache(pyfuncitem) or pyfuncitem.config.getoption('no-result-cache', False):
+        return None
+
+    if get_flag(S2N_RESULT_CACHE).passed_before(pyfuncitem.nodeid, pyfuncitem.module.__file__):
+        pyfuncitem.result_cache_hit = True
+        pyfuncitem.user_properties.append(("result_cache", "hit"))
+        return True
+
+    return None
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_runtest_setup(item):
+    item.cpu_time_start = cpu_time()
+
+
+def pytest_runtest_logstart(nodeid, location):
+    set_current_test(nodeid)
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_makereport(item, call):
+    """
+    pytest hook that stores the report of each test phase on the test item, so
+    fixtures can tell whether the test failed.
+    """
+    outcome = yield
+    report = outcome.get_result()
+    setattr(item, "rep_" + report.when, report)
+
+    # The CPU time used by the whole test, including the processes it ran, goes
+    # with the last report. xdist sends it to the controller along with the report.
+    if report.when == "teardown" and hasattr(item, "cpu_time_start"):
+        report.cpu_time = cpu_time() - item.cpu_time_start
+
+    if report.when == "teardown" and _uses_result_cache(item) and not getattr(item, "result_cache_hit", False):
+        passed = all(getattr(item, "rep_" + when, None) is not None and getattr(item, "rep_" + when).passed
+                     for when in ("setup", "call", "teardown"))
+        get_flag(S2N_RESULT_CACHE).record(
+            item.nodeid, item.module.__file__, getattr(item, "result_cache_commands", []), passed)
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_generate_tests(metafunc):
+    """
+    pytest hook that parametrizes tests marked with uncollect_if with only the
+    combinations of parameters that make sense.
+    """
+    generate_valid_parameters(metafunc)
 
 
 def pytest_collection_modifyitems(config, items):
     """
     pytest hook to modify the test arguments to call the uncollect function.
+
+    Tests parametrized by pytest_generate_tests only have valid parameters, so
+    they aren't checked again.
+
+    With --changed-since, tests which aren't affected by the changed files are
+    deselected too.
     """
+    impact = get_flag(S2N_TEST_IMPACT)
     removed = []
     kept = []
     for item in items:
+        if impact is not None:
+            module = os.path.basename(item.nodeid.split("::")[0])
+            callspec = getattr(item, 'callspec', None)
+            if not impact.selects(module, callspec.params if callspec else {}):
+                removed.append(item)
+                continue
+
         m = item.get_closest_marker('uncollect_if')
-        if m:
+        if m and not was_generated(getattr(item, 'function', None)):
             func = m.kwargs['func']
             if func(**item.callspec.params):
                 removed.append(item)
@@ -47,3 +305,9 @@ def pytest_collection_modifyitems(config, items):
     if removed:
         config.hook.pytest_deselected(items=removed)
         items[:] = kept
+
+    # xdist hands tests out in the order the workers collected them, so starting
+    # with the longest ones keeps long tests from running last on a single worker
+    durations = get_flag(S2N_DURATION_DB)
+    if durations is not None and _is_xdist_worker(config):
+        items[:] = durations.longest_first(items)
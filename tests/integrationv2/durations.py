@@ -0,0 +1,158 @@
+import math
+import os
+import resource
+import sqlite3
+import time
+
+
+# How much each new run counts towards a test's recorded duration. Older runs
+# still count, so one slow run on a busy machine doesn't reorder everything.
+DURATION_WEIGHT = 0.3
+
+# Workers mostly wait on processes and sockets, so there can be more of them than
+# CPUs. This caps how many workers each CPU gets, however idle the tests are.
+MAX_WORKERS_PER_CPU = 4
+
+# Lowest CPU utilization assumed for a test when sizing the workers
+MIN_UTILIZATION = 1.0 / MAX_WORKERS_PER_CPU
+
+# Each worker runs its own servers and clients and holds its own ports, so the
+# number of workers is capped however many CPUs there are
+DEFAULT_MAX_WORKERS = 2
+
+
+def cpu_time():
+    """
+    CPU time used by this process and every child it has reaped, in seconds.
+    """
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return self_usage.ru_utime + self_usage.ru_stime + child_usage.ru_utime + child_usage.ru_stime
+
+
+class Timing(object):
+    def __init__(self, duration, cpu, runs=1):
+        # Wall clock seconds, including setup and teardown
+        self.duration = duration
+
+        # CPU seconds used by the worker and the processes it ran
+        self.cpu = cpu
+
+        self.runs = runs
+
+
+class DurationDatabase(object):
+    """
+    A SQLite database of how long each test took in previous runs, used to start
+    the longest tests first and to choose the number of xdist workers.
+
+    Only the controller writes to the database, once the session is finished. Workers
+    read it while collecting, so they all see the same durations and order the tests
+    the same way, which xdist requires.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._timings = None
+        self._pending = {}
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS durations ("
+            "nodeid TEXT PRIMARY KEY, duration REAL NOT NULL, cpu REAL NOT NULL, "
+            "runs INTEGER NOT NULL, updated REAL NOT NULL)")
+        return connection
+
+    @property
+    def timings(self):
+        """
+        A dict of each recorded test's node ID to its Timing.
+        """
+        if self._timings is None:
+            if not os.path.exists(self.path):
+                self._timings = {}
+            else:
+                connection = self._connect()
+                try:
+                    self._timings = {
+                        nodeid: Timing(duration, cpu, runs)
+                        for nodeid, duration, cpu, runs in connection.execute(
+                            "SELECT nodeid, duration, cpu, runs FROM durations")
+                    }
+                finally:
+                    connection.close()
+        return self._timings
+
+    def add_report(self, report):
+        """
+        Add the duration and CPU time of a test phase's report to this run's timings.
+        """
+        timing = self._pending.setdefault(report.nodeid, Timing(0.0, 0.0))
+        timing.duration += report.duration
+        timing.cpu += getattr(report, 'cpu_time', 0.0)
+
+    def flush(self):
+        """
+        Record this run's timings.
+        """
+        if self._pending:
+            self.record(self._pending)
+            self._pending = {}
+
+    def record(self, timings):
+        """
+        Merge this run's Timings into the database.
+        """
+        previous = self.timings
+        now = time.time()
+
+        rows = []
+        for nodeid, timing in timings.items():
+            old = previous.get(nodeid)
+            if old is not None:
+                timing = Timing(
+                    old.duration +
+                    DURATION_WEIGHT * (timing.duration - old.duration),
+                    old.cpu + DURATION_WEIGHT * (timing.cpu - old.cpu),
+                    old.runs + 1)
+            previous[nodeid] = timing
+            rows.append((nodeid, timing.duration, timing.cpu, timing.runs, now))
+
+        connection = self._connect()
+        try:
+            with connection:
+                connection.executemany(
+                    "INSERT OR REPLACE INTO durations VALUES (?, ?, ?, ?, ?)", rows)
+        finally:
+            connection.close()
+
+    def longest_first(self, items):
+        """
+        Sort items by their recorded duration, longest first. Tests without a
+        recorded duration are assumed to take the average time. The sort is stable,
+        so tests with the same duration keep their order.
+        """
+        timings = self.timings
+        if not timings:
+            return items
+
+        durations = [timing.duration for timing in timings.values()]
+        average = sum(durations) / len(durations)
+        return sorted(items, key=lambda item: -getattr(timings.get(item.nodeid), 'duration', average))
+
+    def worker_count(self, cpus=None, max_workers=DEFAULT_MAX_WORKERS):
+        """
+        How many xdist workers keep the CPUs busy, up to max_workers: a test which
+        used its CPU for a third of its duration leaves room for three workers per
+        CPU. Without any recorded tests, None.
+        """
+        cpus = cpus or os.cpu_count() or 1
+        timings = self.timings
+        duration = sum(timing.duration for timing in timings.values())
+        if duration <= 0:
+            return None
+
+        utilization = sum(timing.cpu for timing in timings.values()) / duration
+        utilization = min(1.0, max(MIN_UTILIZATION, utilization))
+        return max(1, min(max_workers, math.ceil(cpus / utilization)))
@@ -0,0 +1,83 @@
+import json
+import os
+import threading
+import time
+
+
+# Bytes of events buffered in memory before they are written to the log file
+EVENT_LOG_BUFFER_SIZE = 1024 * 1024
+
+_event_log = None
+_current_test = None
+
+
+class EventLog(object):
+    """
+    A JSON Lines file of events, such as process launches, marker hits and exits.
+
+    Each xdist worker writes its own file, so no locking is needed between workers.
+    Events are buffered and only written when the buffer fills or the log is
+    closed, so logging costs little more than encoding the event.
+    """
+
+    def __init__(self, path, buffer_size=EVENT_LOG_BUFFER_SIZE):
+        self.path = path
+        self._file = open(path, 'a', buffering=buffer_size, encoding='utf-8')
+        self._lock = threading.Lock()
+
+    def write(self, event, **fields):
+        record = {'time': time.time(), 'event': event, 'test': _current_test}
+        record.update(fields)
+        line = json.dumps(record, default=str, separators=(',', ':'))
+
+        with self._lock:
+            if self._file is not None:
+                self._file.write(line + '\n')
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def open_event_log(directory):
+    """
+    Start logging events to a file in directory, named after the xdist worker.
+    """
+    global _event_log
+
+    os.makedirs(directory, exist_ok=True)
+    worker = os.getenv('PYTEST_XDIST_WORKER', 'main')
+    path = os.path.join(directory, 'events-{}.jsonl'.format(worker))
+    _event_log = EventLog(path)
+    return _event_log
+
+
+def close_event_log():
+    global _event_log
+
+    if _event_log is not None:
+        _event_log.close()
+        _event_log = None
+
+
+def event_log_enabled():
+    return _event_log is not None
+
+
+def set_current_test(nodeid):
+    """
+    Events are tagged with the test which was running when they were logged.
+    """
+    global _current_test
+    _current_test = nodeid
+
+
+def log_event(event, **fields):
+    """
+    Log an event, if an event log is open. Values which aren't JSON types are
+    logged as strings.
+    """
+    if _event_log is not None:
+        _event_log.write(event, **fields)
@@ -4,13 +4,23 @@ import subprocess
 import threading
 import time
 
-from processes import ManagedProcess
-from providers import Provider
+from benchmark_report import BenchmarkRecorder
+from capabilities import get_capabilities
+from event_log import log_event
+from global_flags import get_flag, S2N_LOG_PROCESS_OUTPUT
+from packet_capture import LoopbackCapture, TcpdumpCapture
+from processes import ManagedProcess, format_output, terminate_all
+from python_ssl import PythonSSLPeer
+from record_trace import RecordTraceCapture, decryption_supported
+from result_cache import record_command
+from providers import Provider, Tcpdump
+from server_pool import ServerPool
 from common import ProviderOptions, Protocols
+from configuration import available_ports
 
 
 @pytest.fixture
-def managed_process():
+def managed_process(request):
     """
     Generic process manager. This could be used to launch any process as a background
     task and cleanup when finished.
@@ -18,6 +28,16 @@ def managed_process():
     The reason a fixture is used, instead of creating a ManagedProcess() directly
     from the test, is to control the life of the process. Using the fixture
     allows cleanup after a test, even if a failure occurred.
+
+    The time each process took to become ready is recorded as a property of the
+    test, so it is included in junit reports.
+
+    Any process still running when the test ends is terminated, along with its
+    children. Every process gets SIGTERM at once, then SIGKILL after a short grace
+    period, so one hung peer doesn't stall the worker until its timeout.
+
+    The output of the processes is only printed if the test failed, or if
+    --log-process-output was given.
     """
     processes = []
 
@@ -33,39 +53,153 @@ def managed_process():
             expect_stderr = provider.expect_stderr
         if send_with_newline is None:
             send_with_newline = provider.send_with_newline
-        p = ManagedProcess(
-            cmd_line,
-            provider.set_provider_ready,
-            wait_for_marker=provider.ready_to_test_marker,
-            send_marker_list=provider.ready_to_send_input_marker,
-            close_marker=close_marker,
-            data_source=options.data_to_send,
-            timeout=timeout,
-            env_overrides=options.env_overrides,
-            expect_stderr=expect_stderr,
-            kill_marker=kill_marker,
-            send_with_newline=send_with_newline
-        )
-
-        processes.append(p)
-        with p.ready_condition:
-            p.start()
-            with provider._provider_ready_condition:
-                # Don't continue processing until the provider has indicated it is ready.
-                provider._provider_ready_condition.wait_for(
-                    provider.is_provider_ready, timeout)
+
+        if provider.in_process:
+            p = PythonSSLPeer(
+                provider,
+                send_marker_list=provider.ready_to_send_input_marker,
+                close_marker=close_marker,
+                data_source=options.data_to_send,
+                timeout=timeout,
+                kill_marker=kill_marker,
+                send_with_newline=send_with_newline
+            )
+        else:
+            p = ManagedProcess(
+                cmd_line,
+                provider.set_provider_ready,
+                wait_for_marker=provider.ready_to_test_marker,
+                send_marker_list=provider.ready_to_send_input_marker,
+                close_marker=close_marker,
+                data_source=options.data_to_send,
+                timeout=timeout,
+                env_overrides=options.env_overrides,
+                expect_stderr=expect_stderr,
+                kill_marker=kill_marker,
+                send_with_newline=send_with_newline
+            )
+
+        processes.append((provider, p))
+        record_command(request.node, cmd_line, options.env_overrides)
+        p.start()
+
+        # Don't continue processing until the process has indicated it is ready.
+        # Clients are ready as soon as they are configured, so they don't wait.
+        if not provider.is_provider_ready():
+            p.wait_ready(timeout)
+
         return p
 
     try:
         yield _fn
     except Exception as e:
-        # The ManagedProcess already prints information to stdout, so there
-        # is nothing to capture here.
+        # The output of each process is printed below, so there is nothing to
+        # capture here.
         pass
     finally:
+        show_output = (_test_failed(request) or
+                       get_flag(S2N_LOG_PROCESS_OUTPUT, False))
+
         # Whether the processes succeeded or not, clean then up.
-        for p in processes:
-            p.join()
+        terminate_all([p for provider, p in processes])
+
+        for provider, p in processes:
+            if show_output:
+                output = p.format_output()
+                pid = p.proc.pid if p.proc else None
+                log_event('output', pid=pid, output=output)
+                print(output)
+
+            if p.startup_latency is not None:
+                request.node.user_properties.append((
+                    "{}.{}.startup_latency".format(
+                        type(provider).__name__, provider.options.mode),
+                    round(p.startup_latency, 6)))
+
+
+def _test_failed(request):
+    """
+    Whether the setup or call phase of the test requesting a fixture failed.
+    """
+    return any(getattr(request.node, "rep_" + when, None) is not None and
+               getattr(request.node, "rep_" + when).failed for when in ("setup", "call"))
+
+
+@pytest.fixture(scope='session')
+def capabilities():
+    """
+    The table of what each provider supports with the libcrypto under test, the
+    same one used to deselect tests. e.g.:
+
+        if not capabilities.supports_cipher(OpenSSL, cipher, with_curve=curve):
+            pytest.skip(...)
+    """
+    return get_capabilities()
+
+
+@pytest.fixture
+def benchmark(request):
+    """
+    Records the metrics measured by a benchmark, which are written to --benchmark-json
+    and compared with --benchmark-baseline. Each metric is measured benchmark.samples
+    times, e.g.:
+
+        benchmark.record("throughput", [measure() for _ in range(benchmark.samples)], "MB/s")
+    """
+    return BenchmarkRecorder(request.node, request.config.getoption('benchmark-samples', 5))
+
+
+@pytest.fixture(scope='session')
+def server_pool():
+    """
+    The pool of long-lived servers shared by every test in this worker.
+    """
+    pool = ServerPool()
+    yield pool
+    pool.shutdown()
+
+
+@pytest.fixture
+def pooled_server(request, server_pool, managed_process):
+    """
+    Start a server, or reuse an idle server from the pool with the same configuration.
+
+    The fixture chooses the port: the port the server listens on is written to
+    options.port, and clients must be configured with it.
+
+    Servers which can't be reused (e.g. a test writes to their stdin) are launched
+    with managed_process instead. Either way, get_results() only returns the output
+    of this test's connection.
+    """
+    leases = []
+
+    def _fn(provider_class: Provider, options: ProviderOptions, timeout=5):
+        if not ServerPool.supports(provider_class, options):
+            options.port = str(next(available_ports))
+            return managed_process(provider_class, options, timeout=timeout)
+
+        lease = server_pool.lease(provider_class, options, timeout)
+        options.port = lease.port
+        leases.append(lease)
+        record_command(request.node, lease.get_cmd_line(),
+                       options.env_overrides)
+        return lease
+
+    try:
+        yield _fn
+    finally:
+        show_output = (_test_failed(request) or
+                       get_flag(S2N_LOG_PROCESS_OUTPUT, False))
+
+        for lease in leases:
+            lease.release()
+
+            if show_output:
+                output = format_output(
+                    lease.get_cmd_line(), next(lease.get_results()))
+                log_event('output', pid=lease.server.process.proc.pid,
+                          output=output)
+                print(output)
 
 
 def _swap_mtu(device, new_mtu):
@@ -107,3 +241,85 @@ def custom_mtu():
     original_mtu = _swap_mtu('lo', 1500)
     yield
     _swap_mtu('lo', original_mtu)
+
+
+@pytest.fixture
+def loopback_mtu():
+    """
+    Sets the loopback's MTU for one test, and resets it when the test ends.
+    For tests parametrized by MTU, unlike custom_mtu:
+
+        loopback_mtu(1500)
+    """
+    if os.geteuid() != 0:
+        pytest.skip("Test needs root privileges to modify lo MTU")
+
+    original_mtu = []
+
+    def set_mtu(mtu):
+        previous_mtu = _swap_mtu('lo', mtu)
+        if not original_mtu:
+            original_mtu.append(previous_mtu)
+
+    yield set_mtu
+
+    if original_mtu:
+        _swap_mtu('lo', original_mtu[0])
+
+
+@pytest.fixture
+def packet_capture(managed_process):
+    """
+    Captures the connections to a port on the loopback, from before they are made
+    until the capture is stopped, for tests which check how the data was sent:
+
+        capture = packet_capture(port)
+        ... start the server and client, and wait for them to finish ...
+        trace = capture.stop()
+        trace.record_sizes(CLIENT)
+
+    As root the capture is an AF_PACKET socket. Otherwise tcpdump captures the
+    packets, which it can only do if it has been given the capabilities.
+    """
+    captures = []
+
+    def _fn(port, timeout=30, keep_payloads=False):
+        if os.geteuid() == 0:
+            capture = LoopbackCapture(port, keep_payloads)
+        else:
+            options = ProviderOptions(mode=Provider.ClientMode, port=port)
+            process = managed_process(Tcpdump, options, timeout=timeout)
+            capture = TcpdumpCapture(process, port, keep_payloads)
+        captures.append(capture)
+        return capture
+
+    yield _fn
+
+    for capture in captures:
+        capture.close()
+
+
+@pytest.fixture
+def record_trace(packet_capture, tmp_path):
+    """
+    Captures the connections to a port and decrypts their records with the secrets the
+    peers write to a key log, to see the flights, round trips and bytes of each phase
+    of their handshakes:
+
+        capture = record_trace(port)
+        client_options.extra_flags = ["--key-log", capture.key_log]
+        ... start the server and client, and wait for them to finish ...
+        connections = capture.stop()
+        assert connections[0].round_trips == 1, connections[0].format_summary()
+
+    Records are decrypted with the cryptography package, so the test is skipped
+    without it.
+    """
+    if not decryption_supported():
+        pytest.skip("Decrypting records needs the cryptography package")
+
+    def _fn(port):
+        key_log = str(tmp_path / "key-log-{}".format(port))
+        return RecordTraceCapture(packet_capture(port, keep_payloads=True), key_log)
+
+    return _fn
@@ -12,6 +12,29 @@ S2N_FIPS_MODE = 's2n_fips_mode'
 # (set from the S2N_LIBCRYPTO env var, which is how the original integration test works)
 S2N_PROVIDER_VERSION = 's2n_provider_version'
 
+# If the full output of every process should be logged, not only of failed processes
+S2N_LOG_PROCESS_OUTPUT = 's2n_log_process_output'
+
+# A cgroup v2 directory in which each managed process gets its own cgroup
+S2N_CGROUP_ROOT = 's2n_cgroup_root'
+
+# If set, only run enough parameter combinations to cover every combination of
+# this many parameters (2 for pairwise). Otherwise every valid combination runs.
+S2N_COVERAGE_STRENGTH = 's2n_coverage_strength'
+
+# If set, the ImpactSelection of tests affected by the changed files. Otherwise
+# every test runs.
+S2N_TEST_IMPACT = 's2n_test_impact'
+
+# If set, the DurationDatabase recording how long each test takes
+S2N_DURATION_DB = 's2n_duration_db'
+
+# If set, the ResultCache of tests which passed and what their results depend on
+S2N_RESULT_CACHE = 's2n_result_cache'
+
+# If set, the BenchmarkReport collecting the metrics recorded by the benchmarks
+S2N_BENCHMARK_REPORT = 's2n_benchmark_report'
+
 _flags = {}
 
 
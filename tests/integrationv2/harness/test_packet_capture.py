@@ -0,0 +1,232 @@
+import pytest
+import struct
+
+from packet_capture import PcapReader, PacketTrace, Segment, _Stream, _tcp_segment, \
+    LINKTYPE_ETHERNET, LINKTYPE_RAW, TCP_SYN, HANDSHAKE, APPLICATION_DATA, CLIENT, SERVER
+
+
+CLIENT_PORT = 50000
+SERVER_PORT = 8443
+
+_TCP_ACK = 0x10
+_TCP_PSH = 0x08
+# The flags of the segments which carry data
+_TCP_DATA = _TCP_ACK | _TCP_PSH
+
+
+def _pcap_header(byte_order, linktype, magic=0xa1b2c3d4):
+    return struct.pack(byte_order + "IHHiIII", magic, 2, 4, 0, 0, 65535, linktype)
+
+
+def _pcap_record(byte_order, seconds, fraction, frame, original_length=None):
+    if original_length is None:
+        original_length = len(frame)
+    return struct.pack(byte_order + "IIII", seconds, fraction, len(frame), original_length) + frame
+
+
+def _tcp(src_port, dst_port, seq, flags, payload=b""):
+    # A 20 byte header, with a data offset of 5 words
+    return struct.pack("!HHIIBBHHH", src_port, dst_port, seq, 1, 5 << 4, flags, 65535, 0, 0) + payload
+
+
+def _ipv4(tcp, protocol=6):
+    return struct.pack("!BBHHHBBH4s4s", 0x45, 0, 20 + len(tcp), 0, 0, 64, protocol, 0,
+                       bytes([127, 0, 0, 1]), bytes([127, 0, 0, 1])) + tcp
+
+
+def _ethernet(packet, ethertype=0x0800):
+    return bytes(12) + struct.pack("!H", ethertype) + packet
+
+
+def _record(content_type, body):
+    return struct.pack("!BHH", content_type, 0x0303, len(body)) + body
+
+
+def _segment(seq, payload, flags=_TCP_DATA, length=None, time=0.0):
+    if length is None:
+        length = len(payload)
+    return Segment(time, CLIENT, seq, flags, payload, length)
+
+
+def _records(stream):
+    return [(record.content_type, record.length, record.payload) for record in stream.records]
+
+
+@pytest.mark.parametrize("byte_order", ["<", ">"], ids=["little_endian", "big_endian"])
+def test_pcap_reader_byte_order(byte_order):
+    frames = [b"first", b"second frame"]
+    pcap = (_pcap_header(byte_order, LINKTYPE_ETHERNET) +
+            _pcap_record(byte_order, 10, 500000, frames[0]) +
+            _pcap_record(byte_order, 11, 250000, frames[1]))
+
+    reader = PcapReader()
+    assert reader.feed(pcap) == [(10.5, frames[0]), (11.25, frames[1])]
+    assert reader.linktype == LINKTYPE_ETHERNET
+
+
+def test_pcap_reader_nanoseconds():
+    pcap = _pcap_header("<", LINKTYPE_RAW, magic=0xa1b23c4d) + \
+        _pcap_record("<", 1, 500000000, b"frame")
+
+    reader = PcapReader()
+    assert reader.feed(pcap) == [(1.5, b"frame")]
+    assert reader.linktype == LINKTYPE_RAW
+
+
+def test_pcap_reader_partial_chunks():
+    frames = [b"first", b"second frame"]
+    pcap = (_pcap_header("<", LINKTYPE_ETHERNET) +
+            _pcap_record("<", 1, 0, frames[0]) +
+            _pcap_record("<", 2, 0, frames[1]))
+
+    # Each packet is returned by the chunk which completes it
+    reader = PcapReader()
+    packets = []
+    for offset in range(len(pcap)):
+        packets.append(reader.feed(pcap[offset:offset + 1]))
+    assert [packet for chunk in packets for packet in chunk] == [
+        (1.0, frames[0]), (2.0, frames[1])]
+    assert packets[-1] == [(2.0, frames[1])]
+    assert sum(1 for chunk in packets if chunk) == 2
+
+
+def test_pcap_reader_rejects_other_files():
+    with pytest.raises(ValueError):
+        PcapReader().feed(bytes(24))
+
+
+def test_tcp_segment_ethernet():
+    payload = _record(HANDSHAKE, b"hello")
+    tcp = _tcp(CLIENT_PORT, SERVER_PORT, 1000, _TCP_ACK, payload)
+
+    header, segment_payload, length = _tcp_segment(
+        LINKTYPE_ETHERNET, _ethernet(_ipv4(tcp)))
+    assert header[:20] == tcp[:20]
+    assert segment_payload == payload
+    assert length == len(payload)
+
+
+def test_tcp_segment_truncated_frame():
+    payload = _record(APPLICATION_DATA, bytes(100))
+    tcp = _tcp(CLIENT_PORT, SERVER_PORT, 1000, _TCP_ACK, payload)
+    frame = _ethernet(_ipv4(tcp))
+
+    # The capture kept 40 bytes of the payload, but the IP header still gives its length
+    _, segment_payload, length = _tcp_segment(
+        LINKTYPE_ETHERNET, frame[:14 + 20 + 20 + 40])
+    assert segment_payload == payload[:40]
+    assert length == len(payload)
+
+
+def test_tcp_segment_ignores_other_protocols():
+    udp = _ipv4(bytes(16), protocol=17)
+    arp = _ethernet(bytes(28), ethertype=0x0806)
+    assert _tcp_segment(LINKTYPE_ETHERNET, _ethernet(udp)) is None
+    assert _tcp_segment(LINKTYPE_ETHERNET, arp) is None
+
+
+def test_stream_syn():
+    stream = _Stream(CLIENT, keep_payloads=True)
+    stream.add(_segment(999, b"", flags=TCP_SYN))
+
+    # The SYN takes one sequence number, so the data starts after it
+    record = _record(HANDSHAKE, b"client_hello")
+    stream.add(_segment(1000, record))
+    assert _records(stream) == [(HANDSHAKE, 12, b"client_hello")]
+    assert stream.parsing
+
+
+def test_stream_records_across_segments():
+    data = _record(HANDSHAKE, b"first") + _record(APPLICATION_DATA, b"second")
+    stream = _Stream(CLIENT, keep_payloads=False)
+    stream.add(_segment(1000, data[:3], time=1.0))
+    stream.add(_segment(1003, data[3:12], time=2.0))
+    stream.add(_segment(1012, data[12:], time=3.0))
+
+    assert _records(stream) == [
+        (HANDSHAKE, 5, None), (APPLICATION_DATA, 6, None)]
+    # A record's time is when the segment which completed it was captured
+    assert [record.time for record in stream.records] == [2.0, 3.0]
+
+
+def test_stream_retransmit():
+    data = _record(HANDSHAKE, b"first") + _record(HANDSHAKE, b"second")
+    stream = _Stream(CLIENT, keep_payloads=True)
+    stream.add(_segment(1000, data[:10]))
+    # A whole segment sent again, then one which repeats some bytes before new ones
+    stream.add(_segment(1000, data[:10]))
+    stream.add(_segment(1005, data[5:]))
+    stream.add(_segment(1005, data[5:]))
+
+    assert _records(stream) == [
+        (HANDSHAKE, 5, b"first"), (HANDSHAKE, 6, b"second")]
+    assert stream.parsing
+
+
+def test_stream_early_segment():
+    data = _record(HANDSHAKE, b"first") + _record(HANDSHAKE, b"second")
+    stream = _Stream(CLIENT, keep_payloads=True)
+    stream.add(_segment(1000, data[:4]))
+    stream.add(_segment(1010, data[10:]))
+    assert stream.records == []
+
+    # The missing bytes release the segment which arrived before them
+    stream.add(_segment(1004, data[4:10]))
+    assert _records(stream) == [
+        (HANDSHAKE, 5, b"first"), (HANDSHAKE, 6, b"second")]
+    assert stream.parsing
+
+
+def test_stream_sequence_wraps():
+    data = _record(HANDSHAKE, b"wrapped")
+    stream = _Stream(CLIENT, keep_payloads=True)
+    stream.add(_segment(0xfffffffe, data[:2]))
+    stream.add(_segment(0, data[2:]))
+    assert _records(stream) == [(HANDSHAKE, 7, b"wrapped")]
+
+
+def test_stream_truncated_segment():
+    first = _record(HANDSHAKE, b"first")
+    second = _record(APPLICATION_DATA, bytes(100))
+    stream = _Stream(CLIENT, keep_payloads=True)
+    stream.add(_segment(1000, first))
+    stream.add(_segment(1000 + len(first), second[:40], length=len(second)))
+    third = _record(HANDSHAKE, b"third")
+    stream.add(_segment(1000 + len(first) + len(second), third))
+
+    # Nothing after the truncated segment is parsed
+    assert _records(stream) == [(HANDSHAKE, 5, b"first")]
+    assert not stream.parsing
+
+
+def test_stream_not_tls():
+    stream = _Stream(CLIENT, keep_payloads=True)
+    stream.add(_segment(1000, b"GET / HTTP/1.1\r\n\r\n"))
+    stream.add(_segment(1018, _record(HANDSHAKE, b"first")))
+
+    assert stream.records == []
+    assert not stream.parsing
+
+
+def test_packet_trace_connections():
+    trace = PacketTrace(SERVER_PORT, keep_payloads=True)
+    frames = [
+        (1.0, _tcp(CLIENT_PORT, SERVER_PORT, 99, TCP_SYN)),
+        (1.1, _tcp(SERVER_PORT, CLIENT_PORT, 499, TCP_SYN | _TCP_ACK)),
+        (1.2, _tcp(CLIENT_PORT, SERVER_PORT, 100, _TCP_DATA,
+                   _record(HANDSHAKE, b"hello"))),
+        (1.3, _tcp(SERVER_PORT, CLIENT_PORT, 500, _TCP_DATA,
+                   _record(HANDSHAKE, b"hi"))),
+        # Another port's connection isn't traced
+        (1.4, _tcp(CLIENT_PORT, SERVER_PORT + 1, 100, _TCP_DATA,
+                   _record(HANDSHAKE, b"other"))),
+    ]
+    for time, tcp in frames:
+        trace.add_frame(time, LINKTYPE_ETHERNET, _ethernet(_ipv4(tcp)))
+
+    assert len(trace.segments) == 4
+    assert trace.segment_sizes() == [10, 7]
+    assert [(record.sender, record.payload) for record in trace.records] == [
+        (CLIENT, b"hello"), (SERVER, b"hi")]
+    assert len(trace.connections) == 1
+    assert trace.complete
@@ -0,0 +1,127 @@
+import itertools
+import pytest
+
+from parametrization import covering_combinations, valid_combinations
+
+
+ARGNAMES = ["protocol", "cipher", "curve", "certificate"]
+VALUES = [
+    ["tls12", "tls13"],
+    ["aes128", "aes256", "chacha20", "cbc"],
+    ["p256", "p384", "x25519"],
+    ["rsa", "ecdsa", "rsa_pss"],
+]
+
+
+def _check(*requires):
+    def _register(check):
+        check.requires = requires
+        return check
+    return _register
+
+
+# Like the checks of invalid_test_parameters, these are called with only the
+# parameters chosen so far
+@_check("protocol", "cipher")
+def _cbc_not_in_tls13(protocol, cipher, **kwargs):
+    return protocol == "tls13" and cipher == "cbc"
+
+
+@_check("protocol", "certificate")
+def _rsa_pss_needs_tls13(protocol, certificate, **kwargs):
+    return protocol == "tls12" and certificate == "rsa_pss"
+
+
+@_check("cipher", "curve", "certificate")
+def _chacha20_not_with_ecdsa_p384(cipher, curve, certificate, **kwargs):
+    return cipher == "chacha20" and curve == "p384" and certificate == "ecdsa"
+
+
+def invalid(**kwargs):
+    return any(check(**kwargs) for check in invalid.constraints)
+
+
+invalid.constraints = [
+    _cbc_not_in_tls13, _rsa_pss_needs_tls13, _chacha20_not_with_ecdsa_p384]
+
+
+def _is_valid(combination):
+    values = [VALUES[i][index] for i, index in enumerate(combination)]
+    return not invalid(**dict(zip(ARGNAMES, values)))
+
+
+def _product():
+    return list(itertools.product(*[range(len(values)) for values in VALUES]))
+
+
+def _tuples(combination, strength):
+    return {(positions, tuple(combination[i] for i in positions))
+            for positions in itertools.combinations(range(len(combination)), strength)}
+
+
+def test_valid_combinations():
+    combinations = list(valid_combinations(invalid, ARGNAMES, VALUES))
+    # Every valid combination, in the order of the full product
+    assert combinations == [
+        combination for combination in _product() if _is_valid(combination)]
+    assert len(combinations) < len(_product())
+
+
+def test_valid_combinations_without_constraints():
+    # A function without constraints is one check, of the whole combination
+    def _uncollect(**kwargs):
+        return invalid(**kwargs)
+
+    assert list(valid_combinations(_uncollect, ARGNAMES, VALUES)) == list(
+        valid_combinations(invalid, ARGNAMES, VALUES))
+    assert list(valid_combinations(None, ARGNAMES, VALUES)) == _product()
+
+
+def test_valid_combinations_prunes_prefixes():
+    calls = []
+
+    @_check("protocol", "cipher")
+    def _counted(protocol, cipher, **kwargs):
+        calls.append(kwargs)
+        return _cbc_not_in_tls13(protocol, cipher)
+
+    def _uncollect(**kwargs):
+        return False
+    _uncollect.constraints = [_counted]
+
+    combinations = list(valid_combinations(_uncollect, ARGNAMES, VALUES))
+    # The check runs once for each protocol and cipher, before the later parameters
+    # are chosen
+    assert len(calls) == len(VALUES[0]) * len(VALUES[1])
+    assert all(kwargs == {} for kwargs in calls)
+    assert len(combinations) == 7 * len(VALUES[2]) * len(VALUES[3])
+
+
+@pytest.mark.parametrize("strength", [2, 3])
+def test_covering_combinations(strength):
+    valid = list(valid_combinations(invalid, ARGNAMES, VALUES))
+    chosen = covering_combinations(valid, strength)
+
+    # Only valid combinations, in their original order
+    assert all(_is_valid(combination) for combination in chosen)
+    assert chosen == [
+        combination for combination in valid if combination in chosen]
+    assert len(chosen) < len(valid)
+
+    # Every tuple of values which appears in a valid combination is covered
+    needed = set().union(*(_tuples(combination, strength)
+                         for combination in valid))
+    covered = set().union(*(_tuples(combination, strength)
+                          for combination in chosen))
+    assert covered == needed
+
+    # The same combinations are chosen every time
+    assert covering_combinations(valid, strength) == chosen
+
+
+def test_covering_combinations_every_combination():
+    valid = list(valid_combinations(invalid, ARGNAMES, VALUES))
+    # Off, or at least as many parameters as there are, keeps every combination
+    assert covering_combinations(valid, 0) == valid
+    assert covering_combinations(valid, len(ARGNAMES)) == valid
+    assert covering_combinations([], 2) == []
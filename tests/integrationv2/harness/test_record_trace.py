@@ -0,0 +1,256 @@
+import pytest
+import struct
+
+from packet_capture import TlsRecord, HANDSHAKE, APPLICATION_DATA, CHANGE_CIPHER_SPEC, CLIENT, SERVER
+from record_trace import ConnectionTrace, HandshakeMessage, KeyLog, TraceRecord, _RecordKey, CIPHER_SUITES, TLS12, \
+    PLAINTEXT, EARLY_DATA, HANDSHAKE_KEYS, APPLICATION_KEYS, decryption_supported, hkdf_expand_label, \
+    tls12_prf
+
+
+needs_decryption = pytest.mark.skipif(not decryption_supported(),
+                                      reason="Decrypting records needs the cryptography package")
+
+# The server's handshake traffic secret and keys from the simple 1-RTT handshake in
+# RFC 8448, section 3, which uses TLS_AES_128_GCM_SHA256
+RFC8448_HANDSHAKE_SECRET = bytes.fromhex(
+    "1dc826e93606aa6fdc0aadc12f741b01046aa6b99f691ed221a9f0ca043fbeac")
+RFC8448_TRANSCRIPT_HASH = bytes.fromhex(
+    "860c06edc07858ee8e78f0e7428c58edd6b43f2ca3e6e95f02ed063cf0e1cad8")
+RFC8448_SERVER_SECRET = bytes.fromhex(
+    "b67b7d690cc16c4e75e54213cb2d37b4e9c912bcded9105d42befd59d391ad38")
+RFC8448_SERVER_KEY = bytes.fromhex("3fce516009c21727d0f2e4e86ee403bc")
+RFC8448_SERVER_IV = bytes.fromhex("5d313eb2671276ee13000b30")
+
+# RFC 5246 has no test vectors for its PRF. This is the SHA-256 vector posted to the
+# TLS working group's mailing list, which other implementations test against.
+PRF_SECRET = bytes.fromhex("9bbe436ba940f017b17652849a71db35")
+PRF_SEED = bytes.fromhex("a0ba9f936cda311827a6f796ffd5198c")
+PRF_OUTPUT = bytes.fromhex(
+    "e3f229ba727be17b8d122620557cd453c2aab21d07c3d495329b52d4e61edb5a"
+    "6b301791e90d35c9c9a46b4e14baf9af0fa022f7077def17abfd3797c0564bab"
+    "4fbc91666e9def9b97fce34f796789baa48082d122ee42c5a72e5a5110fff701"
+    "87347b66")
+
+TLS_AES_128_GCM_SHA256 = 0x1301
+TLS_ECDHE_RSA_WITH_AES_128_GCM_SHA256 = 0xc02f
+TLS_ECDHE_RSA_WITH_CHACHA20_POLY1305_SHA256 = 0xcca8
+
+_AEAD_TAG_SIZE = 16
+
+
+def test_hkdf_expand_label():
+    assert hkdf_expand_label("sha256", RFC8448_HANDSHAKE_SECRET, b"s hs traffic",
+                             RFC8448_TRANSCRIPT_HASH, 32) == RFC8448_SERVER_SECRET
+    assert hkdf_expand_label("sha256", RFC8448_SERVER_SECRET,
+                             b"key", b"", 16) == RFC8448_SERVER_KEY
+    assert hkdf_expand_label("sha256", RFC8448_SERVER_SECRET,
+                             b"iv", b"", 12) == RFC8448_SERVER_IV
+
+
+def test_tls12_prf():
+    assert tls12_prf("sha256", PRF_SECRET, b"test label",
+                     PRF_SEED, 100) == PRF_OUTPUT
+    # Shorter outputs are a prefix of longer ones
+    assert tls12_prf("sha256", PRF_SECRET, b"test label",
+                     PRF_SEED, 20) == PRF_OUTPUT[:20]
+
+
+def _nonce(iv, seq):
+    return bytes(a ^ b for a, b in zip(iv, bytes(4) + struct.pack("!Q", seq)))
+
+
+def _tls13_record(key, iv, seq, content_type, content, padding=0):
+    inner = content + bytes([content_type]) + bytes(padding)
+    length = len(inner) + _AEAD_TAG_SIZE
+    header = struct.pack("!BHH", APPLICATION_DATA, TLS12, length)
+    payload = CIPHER_SUITES[TLS_AES_128_GCM_SHA256].aead(key).encrypt(
+        _nonce(iv, seq), inner, header)
+    return TlsRecord(0.0, SERVER, APPLICATION_DATA, TLS12, length, payload)
+
+
+def _rfc8448_key():
+    return _RecordKey.from_tls13_secret(CIPHER_SUITES[TLS_AES_128_GCM_SHA256],
+                                        HANDSHAKE_KEYS, RFC8448_SERVER_SECRET)
+
+
+@needs_decryption
+def test_decrypt_tls13():
+    key = _rfc8448_key()
+    assert (key.iv, key.seq) == (RFC8448_SERVER_IV, 0)
+
+    first = _tls13_record(RFC8448_SERVER_KEY, RFC8448_SERVER_IV,
+                          0, HANDSHAKE, b"encrypted_extensions")
+    second = _tls13_record(RFC8448_SERVER_KEY, RFC8448_SERVER_IV,
+                           1, APPLICATION_DATA, b"data\x00", padding=10)
+    assert key.decrypt_tls13(first) == (HANDSHAKE, b"encrypted_extensions")
+    # The padding is removed, but not zeros in the content before the content type
+    assert key.decrypt_tls13(second) == (APPLICATION_DATA, b"data\x00")
+    assert key.seq == 2
+
+
+@needs_decryption
+def test_decrypt_tls13_other_key():
+    key = _rfc8448_key()
+    record = _tls13_record(bytes(16), RFC8448_SERVER_IV,
+                           0, HANDSHAKE, b"finished")
+    assert key.decrypt_tls13(record) is None
+    # Only the records a key decrypts use up its sequence numbers
+    assert key.seq == 0
+
+
+@needs_decryption
+def test_decrypt_tls13_only_padding():
+    key = _rfc8448_key()
+    length = 8 + _AEAD_TAG_SIZE
+    header = struct.pack("!BHH", APPLICATION_DATA, TLS12, length)
+    payload = CIPHER_SUITES[TLS_AES_128_GCM_SHA256].aead(RFC8448_SERVER_KEY).encrypt(
+        _nonce(RFC8448_SERVER_IV, 0), bytes(8), header)
+
+    record = TlsRecord(0.0, SERVER, APPLICATION_DATA, TLS12, length, payload)
+    assert key.decrypt_tls13(record) is None
+
+
+@needs_decryption
+def test_decrypt_tls12_aes_gcm():
+    suite = CIPHER_SUITES[TLS_ECDHE_RSA_WITH_AES_128_GCM_SHA256]
+    write_key, implicit_iv = bytes(range(16)), bytes.fromhex("01020304")
+    key = _RecordKey(suite, APPLICATION_KEYS, write_key, implicit_iv)
+
+    records = []
+    for seq, content in enumerate([b"first record", b"second record"]):
+        # Records start with the rest of the nonce, which the sender chooses
+        explicit_nonce = struct.pack("!Q", 1000 + seq)
+        additional_data = struct.pack(
+            "!QBHH", seq, HANDSHAKE, TLS12, len(content))
+        payload = explicit_nonce + suite.aead(write_key).encrypt(
+            implicit_iv + explicit_nonce, content, additional_data)
+        records.append(TlsRecord(0.0, CLIENT, HANDSHAKE,
+                       TLS12, len(payload), payload))
+
+    assert key.decrypt_tls12(records[0]) == (HANDSHAKE, b"first record")
+    assert key.decrypt_tls12(records[1]) == (HANDSHAKE, b"second record")
+
+    # A record can't be decrypted with the wrong sequence number
+    key.seq = 0
+    assert key.decrypt_tls12(records[1]) is None
+
+
+@needs_decryption
+def test_decrypt_tls12_chacha20_poly1305():
+    suite = CIPHER_SUITES[TLS_ECDHE_RSA_WITH_CHACHA20_POLY1305_SHA256]
+    write_key, iv = bytes(range(32)), bytes(range(12))
+    key = _RecordKey(suite, APPLICATION_KEYS, write_key, iv)
+
+    additional_data = struct.pack("!QBHH", 0, APPLICATION_DATA, TLS12, 5)
+    payload = suite.aead(write_key).encrypt(
+        _nonce(iv, 0), b"hello", additional_data)
+    record = TlsRecord(0.0, CLIENT, APPLICATION_DATA,
+                       TLS12, len(payload), payload)
+    assert key.decrypt_tls12(record) == (APPLICATION_DATA, b"hello")
+    assert key.seq == 1
+
+
+def _trace(records):
+    """
+    A ConnectionTrace of records given as (sender, phase, content_type, messages),
+    one second apart
+    """
+    trace = ConnectionTrace([], KeyLog())
+    for time, (sender, phase, content_type, messages) in enumerate(records):
+        record = TraceRecord(time, sender, content_type, 100, phase, 50)
+        record.messages = messages
+        trace.records.append(record)
+        trace.messages.extend(HandshakeMessage(time, sender, name, 0)
+                              for name in messages)
+    return trace
+
+
+_CLIENT_HELLO = (CLIENT, PLAINTEXT, HANDSHAKE, ["client_hello"])
+_SERVER_HELLO = (SERVER, PLAINTEXT, HANDSHAKE, ["server_hello"])
+_CLIENT_APPLICATION_DATA = (CLIENT, APPLICATION_KEYS, APPLICATION_DATA, [])
+_TLS13_CLIENT_FINISHED = (CLIENT, HANDSHAKE_KEYS, HANDSHAKE, ["finished"])
+_TLS13_SERVER_FLIGHT = (SERVER, HANDSHAKE_KEYS, HANDSHAKE,
+                        ["encrypted_extensions", "certificate", "certificate_verify", "finished"])
+
+TLS13_FULL = [_CLIENT_HELLO, _SERVER_HELLO, _TLS13_SERVER_FLIGHT,
+              _TLS13_CLIENT_FINISHED, _CLIENT_APPLICATION_DATA]
+
+TLS13_HELLO_RETRY = [
+    _CLIENT_HELLO,
+    (SERVER, PLAINTEXT, HANDSHAKE, ["hello_retry_request"]),
+    _CLIENT_HELLO,
+    _SERVER_HELLO,
+    _TLS13_SERVER_FLIGHT,
+    _TLS13_CLIENT_FINISHED,
+    _CLIENT_APPLICATION_DATA,
+]
+
+TLS13_RESUMED = [
+    _CLIENT_HELLO,
+    _SERVER_HELLO,
+    (SERVER, HANDSHAKE_KEYS, HANDSHAKE, ["encrypted_extensions", "finished"]),
+    _TLS13_CLIENT_FINISHED,
+    _CLIENT_APPLICATION_DATA,
+]
+
+TLS13_EARLY_DATA = [
+    _CLIENT_HELLO,
+    (CLIENT, EARLY_DATA, APPLICATION_DATA, []),
+    _SERVER_HELLO,
+    (SERVER, HANDSHAKE_KEYS, HANDSHAKE, ["encrypted_extensions", "finished"]),
+    (CLIENT, EARLY_DATA, HANDSHAKE, ["end_of_early_data"]),
+    _TLS13_CLIENT_FINISHED,
+]
+
+# The server couldn't decrypt the early data, so the client sends it again once the
+# handshake has finished
+TLS13_EARLY_DATA_REJECTED = [
+    _CLIENT_HELLO,
+    (CLIENT, EARLY_DATA, APPLICATION_DATA, []),
+    _SERVER_HELLO,
+    _TLS13_SERVER_FLIGHT,
+    _TLS13_CLIENT_FINISHED,
+    _CLIENT_APPLICATION_DATA,
+]
+
+TLS12_FULL = [
+    _CLIENT_HELLO,
+    (SERVER, PLAINTEXT, HANDSHAKE,
+     ["server_hello", "certificate", "server_key_exchange", "server_hello_done"]),
+    (CLIENT, PLAINTEXT, HANDSHAKE, ["client_key_exchange"]),
+    (CLIENT, PLAINTEXT, CHANGE_CIPHER_SPEC, []),
+    (CLIENT, HANDSHAKE_KEYS, HANDSHAKE, ["finished"]),
+    (SERVER, PLAINTEXT, CHANGE_CIPHER_SPEC, []),
+    (SERVER, HANDSHAKE_KEYS, HANDSHAKE, ["finished"]),
+    _CLIENT_APPLICATION_DATA,
+]
+
+TLS12_RESUMED = [
+    _CLIENT_HELLO,
+    _SERVER_HELLO,
+    (SERVER, PLAINTEXT, CHANGE_CIPHER_SPEC, []),
+    (SERVER, HANDSHAKE_KEYS, HANDSHAKE, ["finished"]),
+    (CLIENT, PLAINTEXT, CHANGE_CIPHER_SPEC, []),
+    (CLIENT, HANDSHAKE_KEYS, HANDSHAKE, ["finished"]),
+    _CLIENT_APPLICATION_DATA,
+]
+
+
+@pytest.mark.parametrize("records,round_trips,resumed", [
+    (TLS13_FULL, 1, False),
+    (TLS13_HELLO_RETRY, 2, False),
+    (TLS13_RESUMED, 1, True),
+    (TLS13_EARLY_DATA, 0, True),
+    (TLS13_EARLY_DATA_REJECTED, 1, False),
+    (TLS12_FULL, 2, False),
+    (TLS12_RESUMED, 1, True),
+], ids=["tls13_full", "tls13_hello_retry", "tls13_resumed", "tls13_early_data",
+        "tls13_early_data_rejected", "tls12_full", "tls12_resumed"])
+def test_round_trips(records, round_trips, resumed):
+    trace = _trace(records)
+    assert trace.round_trips == round_trips
+    assert trace.resumed == resumed
+
+
+def test_round_trips_unfinished_handshake():
+    assert _trace(TLS13_FULL[:3]).round_trips is None
@@ -0,0 +1,187 @@
+import fnmatch
+import os
+import subprocess
+
+
+REPOSITORY_ROOT = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "..", ".."))
+
+
+def _cipher_named(*fragments):
+    def _matches(params):
+        cipher = params.get('cipher')
+        return cipher is not None and any(fragment in cipher.name for fragment in fragments)
+    return _matches
+
+
+def _cipher_prefixed(*prefixes):
+    # Unlike _cipher_named, "DHE-" doesn't match the ECDHE ciphers
+    def _matches(params):
+        cipher = params.get('cipher')
+        return cipher is not None and cipher.name.startswith(prefixes)
+    return _matches
+
+
+def _certificate_algorithm(algorithm):
+    def _matches(params):
+        return any(certificate is not None and certificate.algorithm == algorithm
+                   for certificate in [params.get('certificate'), params.get('client_certificate')])
+    return _matches
+
+
+# Which tests exercise each area of the library. Each rule maps fnmatch patterns of
+# files, relative to the repository root, to test modules. A module maps to None to
+# run all of its tests, or to a function of a test's parameters to only run the
+# tests it returns True for.
+#
+# A changed file which no rule matches (and which isn't ignored below) could affect
+# anything, so every test runs.
+IMPACT_RULES = [
+    (["tls/s2n_early_data*", "tls/extensions/s2n_*early_data*"], {
+        "test_early_data.py": None,
+    }),
+    (["tls/s2n_psk*", "tls/extensions/s2n_client_psk*", "tls/extensions/s2n_psk_key_exchange_modes*"], {
+        "test_external_psk.py": None,
+        "test_session_resumption.py": None,
+        "test_early_data.py": None,
+    }),
+    (["tls/s2n_resume*", "tls/s2n_server_new_session_ticket*", "tls/extensions/s2n_client_session_ticket*"], {
+        "test_session_resumption.py": None,
+        "test_early_data.py": None,
+    }),
+    (["tls/s2n_key_update*", "tls/s2n_post_handshake*"], {
+        "test_key_update.py": None,
+    }),
+    (["pq-crypto/*", "tls/s2n_kem*", "tls/extensions/s2n_client_pq_kem*"], {
+        "test_pq_handshake.py": None,
+    }),
+    (["tls/s2n_server_hello_retry*", "tls/extensions/s2n_client_cookie*", "tls/extensions/s2n_*key_share*"], {
+        "test_hello_retry_requests.py": None,
+        "test_pq_handshake.py": None,
+    }),
+    (["tls/s2n_ocsp_stapling*", "tls/extensions/s2n_client_status_request*"], {
+        "test_ocsp.py": None,
+    }),
+    (["tls/s2n_signature_*", "tls/extensions/s2n_client_signature_algorithms*"], {
+        "test_signature_algorithms.py": None,
+    }),
+    (["crypto/s2n_rsa_pss*"], {
+        "test_signature_algorithms.py": None,
+        "test_happy_path.py": _certificate_algorithm('RSAPSS'),
+        "test_client_authentication.py": _certificate_algorithm('RSAPSS'),
+    }),
+    (["crypto/s2n_aead_cipher_chacha20_poly1305*"], {
+        "test_happy_path.py": _cipher_named("CHACHA20"),
+    }),
+    (["crypto/s2n_cbc_cipher_3des*"], {
+        "test_happy_path.py": _cipher_named("DES-CBC3"),
+    }),
+    (["crypto/s2n_dhe*"], {
+        "test_happy_path.py": _cipher_prefixed("DHE-"),
+    }),
+    (["tls/extensions/s2n_client_server_name*"], {
+        "test_sni_match.py": None,
+    }),
+    (["tls/extensions/s2n_client_max_frag_len*"], {
+        "test_fragmentation.py": None,
+    }),
+    (["tls/s2n_record_write*", "tls/s2n_send*"], {
+        "test_fragmentation.py": None,
+        "test_dynamic_record_sizes.py": None,
+    }),
+    (["tls/s2n_client_cert*", "tls/s2n_server_cert_request*"], {
+        "test_client_authentication.py": None,
+    }),
+    (["tls/extensions/s2n_client_supported_versions*"], {
+        "test_version_negotiation.py": None,
+    }),
+]
+
+# Files which can't change the behaviour of the integration tests
+IGNORED_FILES = [
+    "*.md",
+    "*.rst",
+    "docs/*",
+    "bindings/*",
+    "compliance/*",
+    "tests/unit/*",
+    "tests/fuzz/*",
+    "tests/saw/*",
+    "tests/sidetrail/*",
+    "tests/ctverif/*",
+    "tests/cbmc/*",
+    "tests/benchmark/*",
+]
+
+INTEGRATION_TESTS = "tests/integrationv2/"
+
+
+def changed_files(base):
+    """
+    The files which differ between base (any git revision) and the working tree.
+    """
+    output = subprocess.check_output(
+        ["git", "diff", "--name-only", base, "--"], cwd=REPOSITORY_ROOT, stderr=subprocess.STDOUT)
+    return [line for line in output.decode("utf-8").splitlines() if line]
+
+
+def _matches(path, patterns):
+    return any(fnmatch.fnmatch(path, pattern) for pattern in patterns)
+
+
+class ImpactSelection(object):
+    """
+    The tests affected by a set of changed files: a test module maps to None if
+    all of its tests are affected, or to a list of functions of a test's
+    parameters, any of which selects the test.
+    """
+
+    def __init__(self, modules):
+        self.modules = modules
+
+    def selects(self, module, params):
+        if module not in self.modules:
+            return False
+
+        predicates = self.modules[module]
+        return predicates is None or any(predicate(params) for predicate in predicates)
+
+
+def select_tests(files):
+    """
+    Return the ImpactSelection for the changed files, or None if every test
+    should run.
+    """
+    modules = {}
+
+    def _add(module, predicate):
+        if module in modules and modules[module] is None:
+            return
+        if predicate is None:
+            modules[module] = None
+        else:
+            modules.setdefault(module, []).append(predicate)
+
+    for path in files:
+        if _matches(path, IGNORED_FILES):
+            continue
+
+        if path.startswith(INTEGRATION_TESTS):
+            name = path[len(INTEGRATION_TESTS):]
+            if fnmatch.fnmatch(name, "test_*.py"):
+                _add(name, None)
+                continue
+            # The harness is shared by every test
+            return None
+
+        matched = False
+        for patterns, tests in IMPACT_RULES:
+            if _matches(path, patterns):
+                matched = True
+                for module, predicate in tests.items():
+                    _add(module, predicate)
+
+        if not matched:
+            return None
+
+    return ImpactSelection(modules)
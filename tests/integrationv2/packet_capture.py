@@ -0,0 +1,464 @@
+import concurrent.futures
+import socket
+import struct
+
+from processes import get_event_loop
+
+
+# Link types of the captured frames, from https://www.tcpdump.org/linktypes.html
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_LINUX_SLL2 = 276
+
+# The magic number which starts a pcap file, for timestamps in microseconds or nanoseconds
+_PCAP_MAGIC_MICROSECONDS = 0xa1b2c3d4
+_PCAP_MAGIC_NANOSECONDS = 0xa1b23c4d
+_PCAP_HEADER_SIZE = 24
+_PCAP_RECORD_HEADER_SIZE = 16
+
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_IPV6 = 0x86dd
+_IPPROTO_TCP = 6
+
+TCP_FIN = 0x01
+TCP_SYN = 0x02
+
+# TLS record content types
+CHANGE_CIPHER_SPEC = 20
+ALERT = 21
+HANDSHAKE = 22
+APPLICATION_DATA = 23
+HEARTBEAT = 24
+_TLS_RECORD_HEADER = struct.Struct("!BHH")
+
+# Which side of the connection sent a segment or record
+CLIENT = "client"
+SERVER = "server"
+
+# Linux socket options which aren't in the socket module
+_ETH_P_ALL = 3
+_SO_TIMESTAMPNS = 35
+_SO_RCVBUFFORCE = 33
+_PACKET_OUTGOING = 4
+
+# Large enough for the segments of the loopback's generic segmentation offload,
+# which may be much larger than its MTU
+_MAX_FRAME_SIZE = 256 * 1024
+
+# How much of tcpdump's output is parsed at a time
+_READ_SIZE = 1024 * 1024
+
+
+def distribution(sizes):
+    """
+    Return how many times each size occurs, ordered by size.
+    """
+    counts = {}
+    for size in sizes:
+        counts[size] = counts.get(size, 0) + 1
+    return dict(sorted(counts.items()))
+
+
+class Segment(object):
+    """
+    A TCP segment to or from the captured port. length is the size of the TCP
+    payload, so segments which only carry flags have a length of 0.
+    """
+
+    def __init__(self, time, sender, seq, flags, payload, length):
+        self.time = time
+        self.sender = sender
+        self.seq = seq
+        self.flags = flags
+        self.payload = payload
+        self.length = length
+
+
+class TlsRecord(object):
+    """
+    A TLS record reassembled from the TCP stream. length is the length in the record
+    header, so the record takes length + 5 bytes on the wire. time is when the
+    segment which completed the record was captured. payload is the body of the
+    record, if the trace keeps them.
+    """
+
+    def __init__(self, time, sender, content_type, version, length, payload=None):
+        self.time = time
+        self.sender = sender
+        self.content_type = content_type
+        self.version = version
+        self.length = length
+        self.payload = payload
+
+    def __repr__(self):
+        return "TlsRecord({}, {}, type={}, length={})".format(self.time, self.sender, self.content_type, self.length)
+
+
+class PcapReader(object):
+    """
+    Parses a pcap file a chunk at a time, as it is written. Each call to feed returns
+    the packets which the chunk completed, as (time, frame) pairs.
+    """
+
+    def __init__(self):
+        self.linktype = None
+        self._buffer = bytearray()
+        self._record_header = None
+        self._time_divisor = None
+
+    def feed(self, data):
+        self._buffer += data
+        offset = 0
+        if self._record_header is None:
+            if len(self._buffer) < _PCAP_HEADER_SIZE:
+                return []
+            self._read_header()
+            offset = _PCAP_HEADER_SIZE
+
+        packets = []
+        buffer = self._buffer
+        unpack_from = self._record_header.unpack_from
+        while len(buffer) - offset >= _PCAP_RECORD_HEADER_SIZE:
+            seconds, fraction, captured_length, _ = unpack_from(buffer, offset)
+            end = offset + _PCAP_RECORD_HEADER_SIZE + captured_length
+            if end > len(buffer):
+                break
+            packets.append((seconds + fraction / self._time_divisor,
+                            bytes(buffer[offset + _PCAP_RECORD_HEADER_SIZE:end])))
+            offset = end
+
+        del buffer[:offset]
+        return packets
+
+    def _read_header(self):
+        for byte_order in "<>":
+            magic, = struct.unpack_from(byte_order + "I", self._buffer)
+            if magic in (_PCAP_MAGIC_MICROSECONDS, _PCAP_MAGIC_NANOSECONDS):
+                break
+        else:
+            raise ValueError("Not a pcap file: {}".format(
+                bytes(self._buffer[:4]).hex()))
+
+        self._time_divisor = 1e6 if magic == _PCAP_MAGIC_MICROSECONDS else 1e9
+        self.linktype, = struct.unpack_from(byte_order + "I", self._buffer, 20)
+        self.linktype &= 0xffff
+        self._record_header = struct.Struct(byte_order + "IIII")
+
+
+def _network_layer(linktype, frame):
+    """
+    Return the ethertype and the network layer of a frame, or None for frames which
+    aren't IP.
+    """
+    if linktype == LINKTYPE_ETHERNET:
+        ethertype, = struct.unpack_from("!H", frame, 12)
+        return ethertype, frame[14:]
+    if linktype == LINKTYPE_LINUX_SLL:
+        ethertype, = struct.unpack_from("!H", frame, 14)
+        return ethertype, frame[16:]
+    if linktype == LINKTYPE_LINUX_SLL2:
+        ethertype, = struct.unpack_from("!H", frame, 0)
+        return ethertype, frame[20:]
+    if linktype == LINKTYPE_NULL:
+        family, = struct.unpack_from("=I", frame, 0)
+        return (ETHERTYPE_IPV4 if family == socket.AF_INET else ETHERTYPE_IPV6), frame[4:]
+    if linktype == LINKTYPE_RAW:
+        return (ETHERTYPE_IPV4 if frame[0] >> 4 == 4 else ETHERTYPE_IPV6), frame
+    return None
+
+
+def _tcp_segment(linktype, frame):
+    """
+    Return the TCP header and payload of a frame, along with the length of the payload
+    the IP header gives, which is longer than the payload if the frame was truncated.
+    Returns None for frames which aren't TCP.
+    """
+    network = _network_layer(linktype, frame)
+    if network is None:
+        return None
+
+    ethertype, packet = network
+    if ethertype == ETHERTYPE_IPV4:
+        if packet[9] != _IPPROTO_TCP:
+            return None
+        header_length = (packet[0] & 0x0f) * 4
+        total_length, = struct.unpack_from("!H", packet, 2)
+        # Segmentation offload may leave the length of a large packet unset
+        total_length = total_length or len(packet)
+    elif ethertype == ETHERTYPE_IPV6:
+        if packet[6] != _IPPROTO_TCP:
+            return None
+        header_length = 40
+        payload_length, = struct.unpack_from("!H", packet, 4)
+        total_length = header_length + payload_length
+    else:
+        return None
+
+    tcp = packet[header_length:]
+    tcp_header_length = (tcp[12] >> 4) * 4
+    return tcp, tcp[tcp_header_length:total_length - header_length], total_length - header_length - tcp_header_length
+
+
+class _Stream(object):
+    """
+    Reassembles the bytes one side of a TCP connection sent, and splits them into TLS
+    records. Retransmitted bytes are dropped and segments which arrive early wait for
+    the bytes before them.
+    """
+
+    def __init__(self, sender, keep_payloads):
+        self.sender = sender
+        self.keep_payloads = keep_payloads
+        self.records = []
+        # False once the stream has a gap, or bytes which aren't TLS records
+        self.parsing = True
+        self._next_seq = None
+        self._early = {}
+        self._buffer = bytearray()
+
+    def add(self, segment):
+        if self._next_seq is None:
+            self._next_seq = segment.seq
+        if segment.flags & TCP_SYN:
+            self._next_seq = (segment.seq + 1) & 0xffffffff
+            return
+        if segment.length != len(segment.payload):
+            # Truncated by the capture, so the rest of the stream can't be parsed
+            self.parsing = False
+        if not segment.payload or not self.parsing:
+            return
+
+        payload = segment.payload
+        ahead = (segment.seq - self._next_seq) & 0xffffffff
+        if ahead & 0x80000000:
+            # Starts with bytes which were already seen
+            payload = payload[(self._next_seq - segment.seq) & 0xffffffff:]
+            if not payload:
+                return
+        elif ahead:
+            self._early[segment.seq] = (segment.time, payload)
+            return
+
+        self._append(segment.time, payload)
+        while self._next_seq in self._early:
+            self._append(*self._early.pop(self._next_seq))
+
+    def _append(self, time, payload):
+        self._next_seq = (self._next_seq + len(payload)) & 0xffffffff
+        self._buffer += payload
+
+        offset = 0
+        buffer = self._buffer
+        while len(buffer) - offset >= _TLS_RECORD_HEADER.size:
+            content_type, version, length = _TLS_RECORD_HEADER.unpack_from(
+                buffer, offset)
+            if not CHANGE_CIPHER_SPEC <= content_type <= HEARTBEAT:
+                self.parsing = False
+                break
+            end = offset + _TLS_RECORD_HEADER.size + length
+            if end > len(buffer):
+                break
+            payload = None
+            if self.keep_payloads:
+                payload = bytes(buffer[end - length:end])
+            self.records.append(TlsRecord(
+                time, self.sender, content_type, version, length, payload))
+            offset = end
+
+        del buffer[:offset]
+
+
+class PacketTrace(object):
+    """
+    The TCP segments and TLS records of the connections to one port, in the order they
+    were captured. Times are in seconds since the epoch.
+
+    Segment sizes are as captured. The loopback segments with generic segmentation
+    offload, so its segments may be larger than its MTU.
+
+    With keep_payloads, each record also keeps its body, for decrypting them (see
+    record_trace.py).
+    """
+
+    def __init__(self, port, keep_payloads=False):
+        self.port = port
+        self.keep_payloads = keep_payloads
+        self.segments = []
+        self._streams = {}
+
+    def add_frame(self, time, linktype, frame):
+        tcp = _tcp_segment(linktype, frame)
+        if tcp is None:
+            return
+
+        header, payload, length = tcp
+        src_port, dst_port, seq = struct.unpack_from("!HHI", header)
+        if self.port == dst_port:
+            sender, client_port = CLIENT, src_port
+        elif self.port == src_port:
+            sender, client_port = SERVER, dst_port
+        else:
+            return
+
+        segment = Segment(time, sender, seq, header[13], payload, length)
+        self.segments.append(segment)
+        key = (client_port, sender)
+        if key not in self._streams:
+            self._streams[key] = _Stream(sender, self.keep_payloads)
+        self._streams[key].add(segment)
+
+    @property
+    def records(self):
+        """
+        The TLS records of every connection, in the order they were completed
+        """
+        records = [record for stream in self._streams.values()
+                   for record in stream.records]
+        return sorted(records, key=lambda record: record.time)
+
+    @property
+    def connections(self):
+        """
+        The TLS records of each connection, in the order they were completed, for each
+        connection in the order it was made
+        """
+        # The streams are added as their first segment is captured
+        connections = {}
+        for (client_port, _), stream in self._streams.items():
+            connections.setdefault(client_port, []).extend(stream.records)
+        return [sorted(records, key=lambda record: record.time) for records in connections.values()]
+
+    @property
+    def complete(self):
+        """
+        Whether every byte of every connection was parsed into records
+        """
+        return all(stream.parsing for stream in self._streams.values())
+
+    def segment_sizes(self, sender=None):
+        """
+        The payload size of each segment which carried data
+        """
+        return [segment.length for segment in self.segments
+                if segment.length and sender in (None, segment.sender)]
+
+    def record_sizes(self, sender=None, content_type=None):
+        """
+        The size of each TLS record on the wire, header included
+        """
+        return [record.length + _TLS_RECORD_HEADER.size for record in self.records
+                if sender in (None, record.sender) and content_type in (None, record.content_type)]
+
+    def format_summary(self):
+        """
+        Return the distributions of the segment and record sizes each side sent
+        """
+        lines = []
+        for sender in (CLIENT, SERVER):
+            lines.append("{} segment sizes: {}".format(
+                sender, distribution(self.segment_sizes(sender))))
+            lines.append("{} record sizes: {}".format(
+                sender, distribution(self.record_sizes(sender))))
+        return "\n".join(lines)
+
+
+class LoopbackCapture(object):
+    """
+    Captures the connections to a port on the loopback with an AF_PACKET socket, which
+    needs CAP_NET_RAW. Packets are parsed on the event loop as they arrive, so the
+    socket's buffer only has to hold what arrives between reads.
+    """
+
+    def __init__(self, port, keep_payloads=False):
+        self.trace = PacketTrace(port, keep_payloads)
+        self._frame = bytearray(_MAX_FRAME_SIZE)
+        self._ancillary_size = socket.CMSG_SPACE(struct.calcsize("qq"))
+
+        self._socket = socket.socket(
+            socket.AF_PACKET, socket.SOCK_RAW, socket.htons(_ETH_P_ALL))
+        self._socket.setsockopt(socket.SOL_SOCKET, _SO_TIMESTAMPNS, 1)
+        self._socket.setsockopt(
+            socket.SOL_SOCKET, _SO_RCVBUFFORCE, 16 * 1024 * 1024)
+        self._socket.bind(("lo", 0))
+        self._socket.setblocking(False)
+
+        registered = concurrent.futures.Future()
+
+        def _register():
+            get_event_loop().add_reader(self._socket.fileno(), self._read_ready)
+            registered.set_result(None)
+
+        get_event_loop().call_soon_threadsafe(_register)
+        registered.result()
+
+    def _read_ready(self):
+        view = memoryview(self._frame)
+        while True:
+            try:
+                length, ancillary, _, address = self._socket.recvmsg_into(
+                    [view], self._ancillary_size)
+            except BlockingIOError:
+                return
+
+            # Every packet on the loopback is seen both going out and coming in
+            if address[2] == _PACKET_OUTGOING:
+                continue
+
+            time = None
+            for level, kind, data in ancillary:
+                if level == socket.SOL_SOCKET and kind == _SO_TIMESTAMPNS:
+                    seconds, nanoseconds = struct.unpack("qq", data)
+                    time = seconds + nanoseconds / 1e9
+            self.trace.add_frame(time, LINKTYPE_ETHERNET, bytes(view[:length]))
+
+    def stop(self):
+        """
+        Stop capturing, once every packet already captured has been parsed, and return
+        the trace.
+        """
+        if self._socket.fileno() < 0:
+            return self.trace
+
+        stopped = concurrent.futures.Future()
+
+        def _stop():
+            get_event_loop().remove_reader(self._socket.fileno())
+            self._read_ready()
+            stopped.set_result(None)
+
+        get_event_loop().call_soon_threadsafe(_stop)
+        stopped.result()
+        self._socket.close()
+        return self.trace
+
+    close = stop
+
+
+class TcpdumpCapture(object):
+    """
+    Captures the connections to a port with tcpdump (see the Tcpdump provider), for
+    when the tests can't open an AF_PACKET socket themselves. tcpdump writes a pcap
+    file to its output, which is parsed a chunk at a time once it is stopped.
+    """
+
+    def __init__(self, process, port, keep_payloads=False):
+        self.trace = PacketTrace(port, keep_payloads)
+        self._process = process
+
+    def stop(self):
+        if self._process is None:
+            return self.trace
+
+        process, self._process = self._process, None
+        process.terminate().result()
+        for results in process.get_results():
+            output = results.stdout_view()
+            reader = PcapReader()
+            for start in range(0, len(output), _READ_SIZE):
+                for time, frame in reader.feed(output[start:start + _READ_SIZE]):
+                    self.trace.add_frame(time, reader.linktype, frame)
+        return self.trace
+
+    close = stop
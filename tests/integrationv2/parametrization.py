@@ -0,0 +1,237 @@
+import enum
+import heapq
+import itertools
+import re
+import weakref
+
+from global_flags import get_flag, S2N_COVERAGE_STRENGTH
+
+
+# Test functions whose parameters were generated here. Every combination they
+# were given is valid, so they don't need to be checked again after collection.
+_generated = weakref.WeakSet()
+
+
+def was_generated(function):
+    return function in _generated
+
+
+def _parameter_id(metafunc, argname, value, index, idfn):
+    """
+    The ID pytest would give value if it parametrized argname by itself.
+    """
+    if idfn is not None:
+        value_id = idfn(value)
+        if value_id is not None:
+            return str(value_id)
+
+    value_id = metafunc.config.hook.pytest_make_parametrize_id(
+        config=metafunc.config, val=value, argname=argname)
+    if value_id is not None:
+        return value_id
+
+    if isinstance(value, (str, int, float, bool, complex)) or value is None:
+        return str(value)
+    if isinstance(value, bytes):
+        return value.decode('ascii', 'backslashreplace')
+    if isinstance(value, re.Pattern):
+        return value.pattern
+    if isinstance(value, enum.Enum):
+        return str(value)
+    if isinstance(getattr(value, '__name__', None), str):
+        return value.__name__
+    return argname + str(index)
+
+
+def _parameter_ids(metafunc, argname, values, ids):
+    if ids is not None and not callable(ids):
+        ids = [str(value_id) for value_id in ids]
+    else:
+        ids = [_parameter_id(metafunc, argname, value, index, ids)
+               for index, value in enumerate(values)]
+
+    # Like pytest, make duplicate IDs unique with their index
+    duplicates = set(value_id for value_id in ids if ids.count(value_id) > 1)
+    return [value_id + str(index) if value_id in duplicates else value_id for index, value_id in enumerate(ids)]
+
+
+def _simple_parameters(metafunc):
+    """
+    The argname, values and ids of each parametrize mark on the test function, if
+    they can all be combined here. Otherwise None, and pytest combines them.
+    """
+    definition = metafunc.definition
+    own_marks = [mark for mark in definition.own_markers
+                 if mark.name == 'parametrize']
+    if len(own_marks) != len(list(definition.iter_markers(name='parametrize'))):
+        # Marks on a class or module are combined with these by pytest
+        return None
+
+    parameters = []
+    for mark in own_marks:
+        if len(mark.args) != 2 or set(mark.kwargs) - {'ids'}:
+            return None
+
+        argname, values = mark.args
+        if not isinstance(argname, str) or ',' in argname:
+            return None
+
+        values = list(values)
+        if any(type(value).__name__ == 'ParameterSet' for value in values):
+            return None
+
+        parameters.append((argname.strip(), values, mark.kwargs.get('ids')))
+
+    return own_marks, parameters
+
+
+def _constraint_depths(func, argnames):
+    """
+    Group the checks of an uncollect_if function by how many parameters must be
+    chosen before each check can run. Functions without a constraints attribute are
+    one check, which needs every parameter.
+    """
+    depths = [[] for _ in argnames]
+    constraints = getattr(func, 'constraints', None)
+    if func is None or not argnames:
+        return depths
+
+    if constraints is None:
+        depths[-1].append(func)
+        return depths
+
+    for check in constraints:
+        needed = [argnames.index(name)
+                  for name in check.requires if name in argnames]
+        depths[max(needed, default=0)].append(check)
+    return depths
+
+
+def valid_combinations(func, argnames, values):
+    """
+    Yield the index of each value in every combination which func doesn't reject,
+    in the order pytest would list the full product.
+
+    Combinations are built one parameter at a time, and each check of func runs as
+    soon as the parameters it reads are chosen. A rejected prefix skips every
+    combination that starts with it, so most invalid combinations are never built.
+    """
+    depths = _constraint_depths(func, argnames)
+    chosen = {}
+    indexes = []
+
+    def _walk(depth):
+        argname = argnames[depth]
+        for index, value in enumerate(values[depth]):
+            chosen[argname] = value
+            if any(check(**chosen) for check in depths[depth]):
+                continue
+
+            indexes.append(index)
+            if depth + 1 == len(argnames):
+                yield tuple(indexes)
+            else:
+                yield from _walk(depth + 1)
+            indexes.pop()
+        chosen.pop(argname, None)
+
+    if argnames:
+        yield from _walk(0)
+
+
+def covering_combinations(combinations, strength):
+    """
+    Choose combinations which between them include every combination of values of
+    any strength parameters that appears in combinations, e.g. every pair of
+    values for a strength of 2. Only valid combinations are given, so only valid
+    tuples of values need to be covered.
+
+    This is the usual greedy construction: repeatedly take the combination which
+    covers the most tuples not covered yet. A combination can only cover fewer new
+    tuples as others are taken, so each one's count is only recomputed when it
+    reaches the top of the heap. Ties go to the earliest combination, so every
+    xdist worker chooses the same tests.
+
+    The chosen combinations keep their original order.
+    """
+    if not strength or not combinations or strength >= len(combinations[0]):
+        return combinations
+
+    positions = list(itertools.combinations(
+        range(len(combinations[0])), strength))
+
+    def _tuples(combination):
+        return [(position, tuple(combination[i] for i in position)) for position in positions]
+
+    uncovered = set()
+    for combination in combinations:
+        uncovered.update(_tuples(combination))
+
+    heap = [(-len(positions), index) for index in range(len(combinations))]
+    chosen = []
+    while uncovered:
+        _, index = heapq.heappop(heap)
+        new_tuples = [t for t in _tuples(combinations[index]) if t in uncovered]
+        if not new_tuples:
+            continue
+
+        if heap and len(new_tuples) < -heap[0][0]:
+            heapq.heappush(heap, (-len(new_tuples), index))
+            continue
+
+        chosen.append(index)
+        uncovered.difference_update(new_tuples)
+
+    return [combinations[index] for index in sorted(chosen)]
+
+
+def generate_valid_parameters(metafunc):
+    """
+    Parametrize a test marked with uncollect_if with only the combinations its
+    function accepts, instead of letting pytest build the full product and
+    deselecting most of it after collection.
+
+    With --coverage-strength, only a covering array of the valid combinations is
+    kept. That also applies to tests without uncollect_if, which otherwise are left
+    to pytest.
+
+    Tests with parametrize marks this can't combine (marks on a class or module,
+    indirect parameters, pytest.param values) are left to pytest, and filtered after
+    collection like before.
+    """
+    strength = get_flag(S2N_COVERAGE_STRENGTH)
+    uncollect = metafunc.definition.get_closest_marker('uncollect_if')
+    if uncollect is None and not strength:
+        return
+    func = uncollect.kwargs['func'] if uncollect is not None else None
+
+    simple = _simple_parameters(metafunc)
+    if simple is None:
+        return
+    marks, parameters = simple
+    if not parameters:
+        return
+
+    argnames = [argname for argname, _, _ in parameters]
+    values = [argvalues for _, argvalues, _ in parameters]
+    ids = [_parameter_ids(metafunc, argname, argvalues, argids)
+           for argname, argvalues, argids in parameters]
+
+    combinations = covering_combinations(
+        list(valid_combinations(func, argnames, values)), strength)
+    if not combinations:
+        # pytest would add a skipped test for an empty parameter set, where the
+        # test used to be deselected entirely
+        return
+
+    # pytest parametrizes from the marks too, which would parametrize the same
+    # arguments twice
+    for mark in marks:
+        metafunc.definition.own_markers.remove(mark)
+    _generated.add(metafunc.function)
+
+    metafunc.parametrize(
+        argnames,
+        [tuple(values[i][index] for i, index in enumerate(combination))
+         for combination in combinations],
+        ids=["-".join(ids[i][index] for i, index in enumerate(combination)) for combination in combinations])
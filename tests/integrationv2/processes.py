@@ -1,16 +1,460 @@
-import time
+import ast
+import asyncio
+import concurrent.futures
+import fcntl
+import itertools
+import mmap
 import os
-import select
-import selectors
+import signal
 import subprocess
+import tempfile
 import threading
 
-from common import Results, TimeoutException
+from common import ProcessTimestamps, ResourceUsage, Results, TimeoutException
+from event_log import event_log_enabled, log_event
+from global_flags import get_flag, S2N_CGROUP_ROOT, S2N_LOG_PROCESS_OUTPUT
 from time import monotonic as _time
 
 
-_PopenSelector = selectors.PollSelector
-_PIPE_BUF = getattr(select, 'PIPE_BUF', 512)
+# Minimum free space in an output buffer before reading from stdout/stderr
+_READ_SIZE = 32768
+
+# Initial size of the buffer capturing each output stream
+_INITIAL_OUTPUT_SIZE = 65536
+
+# Output beyond this many bytes per stream is stored in a temporary file
+OUTPUT_MEMORY_LIMIT = 8 * 1024 * 1024
+
+# Requested size of the stdin pipe, so large messages need fewer wake-ups
+_STDIN_PIPE_SIZE = 1024 * 1024
+
+# Largest number of buffers passed to a single writev() call
+_IOV_MAX = os.sysconf('SC_IOV_MAX')
+
+# Seconds between checks for process exit, when the kernel doesn't support pidfds
+_EXIT_POLL_INTERVAL = 0.01
+
+# Seconds a process has to exit after SIGTERM, before it is sent SIGKILL
+KILL_GRACE_PERIOD = 0.5
+
+_event_loop = None
+_event_loop_lock = threading.Lock()
+
+
+def get_event_loop():
+    """
+    Return the event loop which drives every ManagedProcess in this worker.
+
+    Each xdist worker is a separate Python process, so all of the clients, servers
+    and captures launched by a worker share one loop running in a single daemon
+    thread. Tests remain synchronous and hand their coroutines to this loop.
+    """
+    global _event_loop
+
+    with _event_loop_lock:
+        if _event_loop is None:
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(
+                target=loop.run_forever, name="managed-process-loop", daemon=True)
+            thread.start()
+            _event_loop = loop
+
+    return _event_loop
+
+
+def marker_bytes(marker):
+    """
+    Markers may be given as bytes or as strings. Tests often pass str(some_bytes) as
+    a marker, so a string which is the repr of a bytes object is turned back into
+    the bytes it represents.
+    """
+    if marker is None or isinstance(marker, bytes):
+        return marker
+
+    if marker.startswith(("b'", 'b"')):
+        try:
+            value = ast.literal_eval(marker)
+        except (ValueError, SyntaxError):
+            value = None
+        if isinstance(value, bytes):
+            return value
+
+    return marker.encode('utf-8')
+
+
+class _OutputCapture(object):
+    """
+    Stores everything a process writes to one of its output streams.
+
+    Data is read straight from the pipe into a preallocated buffer, which grows
+    geometrically until it reaches memory_limit. After that the buffer is moved to
+    an mmap of a temporary file, so processes which print megabytes of debugging
+    output don't hold all of it in memory.
+    """
+
+    def __init__(self, memory_limit=OUTPUT_MEMORY_LIMIT):
+        self.memory_limit = memory_limit
+        self._buffer = bytearray(min(_INITIAL_OUTPUT_SIZE, memory_limit))
+        self._length = 0
+        self._file = None
+
+    def __len__(self):
+        return self._length
+
+    def read_from(self, fd):
+        """
+        Read whatever is available from fd into the buffer. Returns the number of
+        bytes read, which is zero at the end of the stream.
+        """
+        if len(self._buffer) - self._length < _READ_SIZE:
+            self._grow(self._length + _READ_SIZE)
+
+        with memoryview(self._buffer) as view:
+            read = os.readv(fd, [view[self._length:]])
+
+        self._length += read
+        return read
+
+    def find(self, sub, start=0, end=None):
+        if end is None:
+            end = self._length
+        return self._buffer.find(sub, start, end)
+
+    def view(self):
+        """
+        Return a read-only memoryview of the captured data, without copying it.
+        The capture can't grow while the view is held, so only use this once the
+        stream has been closed.
+        """
+        with memoryview(self._buffer) as view:
+            return view[:self._length].toreadonly()
+
+    def getvalue(self, start=0, end=None):
+        if end is None:
+            end = self._length
+        with memoryview(self._buffer) as view:
+            return view[start:min(end, self._length)].tobytes()
+
+    def _grow(self, needed):
+        size = max(len(self._buffer) * 2, needed)
+
+        if self._file is not None:
+            self._buffer.resize(size)
+        elif size > self.memory_limit:
+            self._spill(size)
+        else:
+            self._buffer.extend(bytearray(size - len(self._buffer)))
+
+    def _spill(self, size):
+        self._file = tempfile.TemporaryFile(prefix='s2n_integ_output_')
+        self._file.truncate(size)
+
+        spilled = mmap.mmap(self._file.fileno(), size)
+        spilled[:self._length] = self._buffer[:self._length]
+        self._buffer = spilled
+
+
+class _InputWriter(object):
+    """
+    Writes messages to the non-blocking stdin pipe of a process.
+
+    A message may be bytes-like, a file object, or an iterable (e.g. a generator)
+    of bytes-like chunks. Buffers are written with os.writev, without copying or
+    joining them, and files are copied to the pipe with os.sendfile, so neither has
+    to be read into memory. Each call writes as much as the pipe will take.
+    """
+
+    def __init__(self, fd):
+        self.fd = fd
+        os.set_blocking(fd, False)
+
+        # Linux allows growing a pipe beyond the default 64k. This is only an
+        # optimization, so failures are ignored.
+        if hasattr(fcntl, 'F_SETPIPE_SZ'):
+            try:
+                fcntl.fcntl(fd, fcntl.F_SETPIPE_SZ, _STDIN_PIPE_SIZE)
+            except OSError:
+                pass
+
+    def __bool__(self):
+        return self.fd is not None
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    async def write(self, message, newline=False):
+        """
+        Write a message to stdin, returning False if the process has closed its end.
+        """
+        try:
+            if hasattr(message, 'fileno'):
+                await self._write_file(message)
+                if newline:
+                    await self._write_buffers([memoryview(b'\n')])
+            elif isinstance(message, (bytes, bytearray, memoryview)):
+                buffers = [memoryview(message).cast('B')]
+                if newline:
+                    buffers.append(memoryview(b'\n'))
+                await self._write_buffers(buffers)
+            else:
+                for chunk in message:
+                    await self._write_buffers([memoryview(chunk).cast('B')])
+                if newline:
+                    await self._write_buffers([memoryview(b'\n')])
+        except (BrokenPipeError, ConnectionResetError):
+            return False
+
+        return True
+
+    async def _write_buffers(self, buffers):
+        buffers = [b for b in buffers if len(b)]
+        while buffers:
+            try:
+                written = os.writev(self.fd, buffers[:_IOV_MAX])
+            except (BlockingIOError, InterruptedError):
+                await self._writable()
+                continue
+
+            # Drop everything which was written, and trim a partial write
+            while buffers and written >= len(buffers[0]):
+                written -= len(buffers.pop(0))
+            if written:
+                buffers[0] = buffers[0][written:]
+
+    async def _write_file(self, file):
+        in_fd = file.fileno()
+        offset = file.tell() if file.seekable() else None
+        total = os.fstat(in_fd).st_size - offset if offset is not None else None
+
+        while total is None or total > 0:
+            count = _STDIN_PIPE_SIZE
+            if total is not None:
+                count = min(total, _STDIN_PIPE_SIZE)
+            try:
+                sent = os.sendfile(self.fd, in_fd, offset, count)
+            except (BlockingIOError, InterruptedError):
+                await self._writable()
+                continue
+
+            if sent == 0:
+                break
+            if offset is not None:
+                offset += sent
+                total -= sent
+
+        if offset is not None:
+            file.seek(offset)
+
+    async def _writable(self):
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+
+        def _ready():
+            if not ready.done():
+                ready.set_result(None)
+
+        loop.add_writer(self.fd, _ready)
+        try:
+            await ready
+        finally:
+            loop.remove_writer(self.fd)
+
+
+class _ProcessGroup(object):
+    """
+    The processes started for one ManagedProcess.
+
+    Every process is the leader of a new process group, so signals also reach any
+    children it starts, such as the programs run by a wrapper script. If a cgroup v2
+    root is configured with --cgroup-root, each process also gets its own cgroup,
+    which catches children that leave the process group.
+    """
+
+    _cgroup_ids = itertools.count()
+
+    def __init__(self, cgroup_root=None):
+        self.pgid = None
+        self.cgroup = None
+
+        if cgroup_root:
+            name = "s2n-integ-{}-{}".format(
+                os.getpid(), next(self._cgroup_ids))
+            path = os.path.join(cgroup_root, name)
+            try:
+                os.mkdir(path)
+            except OSError:
+                # Fall back to only using the process group
+                return
+
+            # The kernel creates the interface files in every cgroup. Without
+            # them, cgroup_root isn't part of a cgroup v2 hierarchy.
+            if os.path.exists(os.path.join(path, "cgroup.procs")):
+                self.cgroup = path
+            else:
+                os.rmdir(path)
+
+    def wrap(self, cmd_line):
+        """
+        Return the command line which moves the process into its cgroup before
+        running cmd_line. The exec keeps the pid, so the process is still the
+        leader of its process group.
+        """
+        if self.cgroup is None:
+            return cmd_line
+        return ['sh', '-c', 'echo 0 > "$0/cgroup.procs" && exec "$@"', self.cgroup] + cmd_line
+
+    def started(self, proc):
+        self.pgid = proc.pid
+
+    def signal(self, sig, leader_reaped=False):
+        """
+        Send sig to every process in the group. Once the leader has been reaped,
+        only the cgroup is signalled: the process group may have emptied, and its
+        pgid may now belong to another session leader, such as a process started
+        by another test.
+        """
+        if self.cgroup is not None:
+            self._signal_cgroup(sig)
+
+        if self.pgid is not None and not leader_reaped:
+            try:
+                os.killpg(self.pgid, sig)
+            except (ProcessLookupError, PermissionError):
+                pass
+
+    def _signal_cgroup(self, sig):
+        try:
+            if sig == signal.SIGKILL and os.path.exists(os.path.join(self.cgroup, "cgroup.kill")):
+                with open(os.path.join(self.cgroup, "cgroup.kill"), "w") as f:
+                    f.write("1")
+                return
+
+            with open(os.path.join(self.cgroup, "cgroup.procs")) as f:
+                pids = [int(pid) for pid in f.read().split() if int(pid) > 0]
+        except OSError:
+            return
+
+        for pid in pids:
+            try:
+                os.kill(pid, sig)
+            except ProcessLookupError:
+                pass
+
+    def remove(self):
+        """
+        Remove the cgroup, returning False if it still has processes in it.
+        """
+        if self.cgroup is None:
+            return True
+
+        try:
+            os.rmdir(self.cgroup)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            return False
+
+        self.cgroup = None
+        return True
+
+
+def _watch_exit(proc):
+    """
+    Return a future which resolves with the os.wait4 rusage of proc once it exits,
+    after setting proc.returncode.
+
+    Processes are reaped here rather than by asyncio's child watcher, which discards
+    the rusage. The exit is noticed through a pidfd registered with the event loop,
+    or by polling if the kernel doesn't support pidfds.
+    """
+    loop = asyncio.get_running_loop()
+    exited = loop.create_future()
+
+    def _reap():
+        if exited.done():
+            return True
+        try:
+            pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+        except ChildProcessError:
+            # Already reaped by someone else, so there is no rusage to report
+            pid, status, rusage = proc.pid, None, None
+        if pid == 0:
+            return False
+
+        if status is not None:
+            proc.returncode = os.waitstatus_to_exitcode(status)
+        exited.set_result(rusage)
+        return True
+
+    try:
+        pidfd = os.pidfd_open(proc.pid)
+    except (AttributeError, OSError):
+        pidfd = None
+
+    if pidfd is not None:
+        def _pidfd_ready():
+            if _reap():
+                loop.remove_reader(pidfd)
+                os.close(pidfd)
+
+        loop.add_reader(pidfd, _pidfd_ready)
+    else:
+        def _poll():
+            if not _reap():
+                loop.call_later(_EXIT_POLL_INTERVAL, _poll)
+
+        _poll()
+
+    return exited
+
+
+def terminate_all(processes, grace_period=KILL_GRACE_PERIOD):
+    """
+    Terminate every ManagedProcess in processes which is still running, and wait
+    for them to exit. All of the processes share one grace period, so a test's
+    teardown takes at most grace_period longer than its slowest process takes
+    to die.
+    """
+    running = [p for p in processes if p.running()]
+    concurrent.futures.wait([p.terminate(grace_period) for p in running])
+    for p in running:
+        p.join()
+
+
+def format_output(cmd_line, results):
+    """
+    Describe a process and its output, as printed when a test fails.
+    """
+    def _decode(output):
+        return bytes(output).decode("utf-8", "backslashreplace") if output is not None else None
+
+    exit_code = results.exit_code if results else None
+    stdout = _decode(results.stdout_view()) if results else None
+    stderr = _decode(results.stderr_view()) if results else None
+    return "Command line: {}\nExit code: {}\nStdout: {}\nStderr: {}".format(
+        " ".join(cmd_line), exit_code, stdout, stderr)
+
+
+def _find_markers(capture, start, end, markers):
+    """
+    Return a dict of the markers which end in capture[start:end], and where
+    each one starts.
+
+    Searching from len(marker) - 1 bytes before start finds markers which
+    straddle two reads, without finding a marker which was already seen. Each
+    search runs directly on the capture buffer, so nothing is copied or decoded.
+    """
+    found = {}
+    for marker in markers:
+        if marker is None:
+            continue
+        offset = capture.find(marker, max(start - len(marker) + 1, 0), end)
+        if offset != -1:
+            found[marker] = offset
+
+    return found
 
 
 class _processCommunicator(object):
@@ -20,48 +464,68 @@ class _processCommunicator(object):
     TLS clients (OpenSSL derivatives) to shut down before the handshake is complete.
 
     To prevent a premature shutdown, we need to wait until the handshake is complete
-    before writing to stdin. To accomplish this we `poll` stdout for a send
-    marker. Once that marker is found, we can write input data to stdin. The
-    benefit of using `poll` and `os.read` is that we get non-blocking IO. Our timeouts
-    are much more reliable, and we don't risk deadlocking on a readline() call which
-    will never complete.
-
-    Another method is to read stdout line by line. This removes a lot of code that
-    registers and unregisters file descriptors with a selector. It would make reading
-    and writing sequential (as opposed to event based), which can be easier to read
-    and maintain. The downsides with this method exist in the current integration test
-    framework. We rely on sleeps and waits, and still hit hard to debug deadlocks from
-    time to time.
+    before writing to stdin. To accomplish this we read stdout for a send marker.
+    Once that marker is found, we can write input data to stdin.
+
+    Markers are matched against the raw bytes of each stream as it is read, see
+    _find_markers. A marker split across two reads is still found.
+
+    All IO happens on the shared asyncio event loop. The read end of each output pipe
+    is watched by the loop, and data is read into an _OutputCapture as soon as it is
+    available. Each read is then handed to _communicate, which checks it for markers
+    and writes to stdin. Because reads keep happening while stdin is written, a peer
+    can never deadlock on a full stdout pipe.
     """
 
-    def __init__(self, proc):
+    def __init__(self, proc, cmd_line, stdin_fd, output_fds, output_memory_limit=OUTPUT_MEMORY_LIMIT,
+                 group=None):
         self.proc = proc
+        self.cmd_line = cmd_line
+        self.group = group
         self.wait_for_marker = None
 
+        # The write end of the stdin pipe
+        self.stdin = _InputWriter(stdin_fd)
+
+        # Map of stream name ('stdout' or 'stderr') to the read end of its pipe
+        self.output_fds = output_fds
+        self.output_memory_limit = output_memory_limit
+
+        # Markers being watched for by watch(), as (stream, marker, start, future)
+        self._watches = []
+
+        # Resolves with the rusage of the process once it has been reaped
+        self.exited = _watch_exit(proc)
+        self.exited.add_done_callback(self._record_exit)
+
+        # Monotonic timestamps of the first output, and of the process exit
+        self.first_byte_time = None
+        self.exit_time = None
+
         # If the process times out, communicate() is called once more to pick
         # up any data remaining in stdout/stderr. This flags lets us know if
-        # we need to do initial setup on the file descriptors, or if it was done
-        # during the initial call.
+        # we need to start the reader tasks, or if it was done during the
+        # initial call.
         self._communication_started = False
 
-    def wait_for(self, wait_for_marker, timeout=None):
+    async def wait_for(self, wait_for_marker, timeout=None):
         """
         Wait for a specific marker in stdout.
         If the marker is not seen, a timeout will be raised.
         """
-        self.wait_for_marker = wait_for_marker
+        self.wait_for_marker = marker_bytes(wait_for_marker)
         stdout = None
         stderr = None
 
         try:
-            stdout, stderr = self._communicate(None, timeout=timeout)
+            stdout, stderr = await self._communicate(None, timeout=timeout)
         finally:
             self._communication_started = True
 
         return (stdout, stderr)
 
-    def communicate(self, input_data=None, send_marker_list=None, close_marker=None, kill_marker=None,
-                    send_with_newline=False, timeout=None):
+    async def communicate(self, input_data=None, send_marker_list=None, close_marker=None, kill_marker=None,
+                          send_with_newline=False, timeout=None):
         """
         Communicates with the managed process. If send_marker_list is set, input_data will not be sent
         until the marker is seen.
@@ -74,7 +538,7 @@ class _processCommunicator(object):
         stderr = None
 
         try:
-            stdout, stderr = self._communicate(
+            stdout, stderr = await self._communicate(
                 input_data,
                 send_marker_list,
                 close_marker,
@@ -87,43 +551,109 @@ class _processCommunicator(object):
 
         return (stdout, stderr)
 
-    def _communicate(self, input_data=None, send_marker_list=None, close_marker=None, kill_marker=None,
-                     send_with_newline=False, timeout=None):
+    def _start_readers(self):
         """
-        This method will read and write data to a subprocess in a non-blocking manner.
-        The code is heavily based on Popen.communicate. There are a couple differences:
+        Watch each output pipe for data. Every read is stored, and queued so
+        _communicate can look for markers in it. An empty read marks the end
+        of a stream.
+        """
+        self._fileobj2output = {}
+        self._open_streams = set()
+        self._chunks = asyncio.Queue()
+
+        loop = asyncio.get_running_loop()
+        for stream, fd in self.output_fds.items():
+            os.set_blocking(fd, False)
+            self._fileobj2output[stream] = _OutputCapture(
+                self.output_memory_limit)
+            self._open_streams.add(stream)
+            loop.add_reader(fd, self._read_ready, stream)
+
+    def _read_ready(self, stream):
+        capture = self._fileobj2output[stream]
+        start = len(capture)
+
+        try:
+            read = capture.read_from(self.output_fds[stream])
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            read = 0
+
+        if not read:
+            self._stop_reader(stream)
+        else:
+            if self.first_byte_time is None:
+                self.first_byte_time = _time()
+            self._check_watches(stream, start)
+
+        self._chunks.put_nowait((stream, start, start + read))
+
+    def _stop_reader(self, stream):
+        fd = self.output_fds.pop(stream, None)
+        if fd is not None:
+            asyncio.get_running_loop().remove_reader(fd)
+            os.close(fd)
 
-            * STDIN is not registered for events until the read_to_send marker is found
-            * STDIN is only closed after all registered events have been processed (including
-              pending stdout/stderr events, allowing more data to be stored).
+        for watch in [w for w in self._watches if w[0] == stream]:
+            self._watches.remove(watch)
+            watch[3].set_exception(EOFError(
+                "{} closed before {} was seen".format(stream, watch[1])))
+
+    def output_lengths(self):
         """
-        if input_data is not None and self.proc.stdin:
-            # Flush stdio buffer.  This might block, if the user has
-            # been writing to .stdin in an uncontrolled fashion.
-            try:
-                self.proc.stdin.flush()
-            except BrokenPipeError:
-                pass  # communicate() must ignore BrokenPipeError.
+        Return the number of bytes captured so far from each stream.
+        """
+        return {stream: len(capture) for stream, capture in self._fileobj2output.items()}
 
-        # The process' stdout and stderr are stored in a map, with two variable
-        # pointing to the file objects. This allows us to include stdout/stderr
-        # data in a timeout exception.
+    def watch(self, stream, marker, start, future):
+        """
+        Resolve future with output_lengths() once marker appears in stream at or
+        after offset start. Unlike send markers, a watch doesn't affect stdin.
+        """
+        self._watches.append((stream, marker_bytes(marker), start, future))
+        if stream not in self.output_fds:
+            self._stop_reader(stream)
+        else:
+            self._check_watches(stream, start)
+
+    def _check_watches(self, stream, start):
+        capture = self._fileobj2output[stream]
+        for watch in [w for w in self._watches if w[0] == stream]:
+            _, marker, watch_start, future = watch
+            if capture.find(marker, max(watch_start, start - len(marker) + 1)) != -1:
+                self._watches.remove(watch)
+                future.set_result(self.output_lengths())
+
+    def _stop_readers(self):
+        for stream in list(self.output_fds):
+            self._stop_reader(stream)
+
+    async def _communicate(self, input_data=None, send_marker_list=None, close_marker=None, kill_marker=None,
+                           send_with_newline=False, timeout=None):
+        """
+        This method will read and write data to a subprocess without blocking the event loop.
+        The code is heavily based on Popen.communicate. There are a couple differences:
+
+            * STDIN is not written to until the read_to_send marker is found
+            * STDIN is only closed after all queued output has been processed (including
+              pending stdout/stderr chunks, allowing more data to be stored).
+        """
+        # The process' stdout and stderr are stored in a map. This allows us to
+        # include stdout/stderr data in a timeout exception.
         if not self._communication_started:
-            self._fileobj2output = {}
-            if self.proc.stdout:
-                self._fileobj2output[self.proc.stdout] = []
-            if self.proc.stderr:
-                self._fileobj2output[self.proc.stderr] = []
+            self._start_readers()
 
-        stdout = self._fileobj2output[self.proc.stdout]
-        stderr = self._fileobj2output[self.proc.stderr]
+        stdout = self._fileobj2output.get('stdout')
+        stderr = self._fileobj2output.get('stderr')
 
-        input_data_len = 0
-        input_data_offset = 0
         input_data_sent = False
         send_marker = None
         if send_marker_list:
-            send_marker = send_marker_list.pop(0)
+            send_marker = marker_bytes(send_marker_list.pop(0))
+        close_marker = marker_bytes(close_marker)
+        close_marker_seen = False
+        kill_marker = marker_bytes(kill_marker)
 
         # Keeping track of the original timeout value, and the expected end
         # time of the operation allow us to timeout while reads/writes are
@@ -135,93 +665,143 @@ class _processCommunicator(object):
         else:
             endtime = None
 
-        with _PopenSelector() as selector:
-            if self.proc.stdout and not self.proc.stdout.closed:
-                selector.register(self.proc.stdout, selectors.EVENT_READ)
-            if self.proc.stderr and not self.proc.stderr.closed:
-                selector.register(self.proc.stderr, selectors.EVENT_READ)
-
-            while selector.get_map():
-                timeout = self._remaining_time(endtime)
-                if timeout is not None and timeout < 0:
-                    self._check_timeout(endtime, orig_timeout,
-                                        stdout, stderr,
-                                        skip_check_and_raise=True)
-                    raise RuntimeError(  # Impossible :)
-                        '_check_timeout(..., skip_check_and_raise=True) '
-                        'failed to raise TimeoutExpired.')
-
-                ready = selector.select(timeout)
-                self._check_timeout(endtime, orig_timeout, stdout, stderr)
-
-                for key, events in ready:
-                    # STDIN is only registered to receive events after the send_marker is found.
-                    if key.fileobj is self.proc.stdin:
-                        chunk = input_view[input_data_offset:
-                                           input_data_offset + _PIPE_BUF]
-                        try:
-                            input_data_offset += os.write(key.fd, chunk)
-                        except BrokenPipeError:
-                            selector.unregister(key.fileobj)
-                        else:
-                            if input_data_offset >= input_data_len:
-                                selector.unregister(key.fileobj)
-                                input_data_sent = True
-                                input_data_offset = 0
-                                if send_marker_list:
-                                    send_marker = send_marker_list.pop(0)
-                    elif key.fileobj in (self.proc.stdout, self.proc.stderr):
-                        data = os.read(key.fd, 32768)
-                        if not data:
-                            selector.unregister(key.fileobj)
-
-                        # fileobj2output[key.fileobj] is a list of data chunks
-                        # that get joined later
-                        self._fileobj2output[key.fileobj].append(data)
-
-                        # If we are looking for, and find, the ready-to-send marker, then
-                        # register STDIN to receive events. If there is no data to send,
-                        # just mark input_send as true so we can close out STDIN.
-                        if send_marker is not None and send_marker in str(data):
-                            if self.proc.stdin and input_data:
-                                selector.register(
-                                    self.proc.stdin, selectors.EVENT_WRITE)
-                                message = input_data.pop(0)
-                                if send_with_newline:
-                                    message += b'\n'
-                                # Data destined for stdin is stored in a memoryview
-                                input_view = memoryview(message)
-                                input_data_len = len(message)
-                            else:
-                                input_data_sent = True
-
-                        if self.wait_for_marker is not None and self.wait_for_marker in str(data):
-                            selector.unregister(self.proc.stdout)
-                            selector.unregister(self.proc.stderr)
-                            return None, None
-
-                        if kill_marker is not None and kill_marker in data:
-                            selector.unregister(self.proc.stdout)
-                            selector.unregister(self.proc.stderr)
-                            self.proc.kill()
-
-                # If we have finished sending all our input, and have received the
-                # ready-to-send marker, we can close out stdin.
-                if self.proc.stdin and input_data_sent:
-                    if close_marker is None or (close_marker and close_marker in str(data)):
-                        input_data_sent = None
-                        self.proc.stdin.close()
-
-        self.proc.wait(timeout=self._remaining_time(endtime))
-
-        # All data exchanged.  Translate lists into strings.
-        if stdout is not None:
-            stdout = b''.join(stdout)
-        if stderr is not None:
-            stderr = b''.join(stderr)
+        while self._open_streams:
+            try:
+                stream, start, end = await asyncio.wait_for(
+                    self._chunks.get(), self._remaining_time(endtime))
+            except asyncio.TimeoutError:
+                raise self._timeout_expired(orig_timeout, stdout, stderr)
+
+            if start == end:
+                self._open_streams.discard(stream)
+
+            found = _find_markers(self._fileobj2output[stream], start, end,
+                                  (send_marker, close_marker, kill_marker, self.wait_for_marker))
+            if found and event_log_enabled():
+                self._log_markers(found, stream, (('send', send_marker), ('close', close_marker),
+                                                  ('kill', kill_marker), ('ready', self.wait_for_marker)))
+            if close_marker in found:
+                close_marker_seen = True
+
+            # If we are looking for, and find, the ready-to-send marker, then
+            # write to STDIN. If there is no data to send, just mark input_send
+            # as true so we can close out STDIN.
+            if send_marker in found:
+                if self.stdin and input_data:
+                    message = input_data.pop(0)
+
+                    try:
+                        written = await asyncio.wait_for(
+                            self.stdin.write(
+                                message, newline=send_with_newline),
+                            self._remaining_time(endtime))
+                    except asyncio.TimeoutError:
+                        raise self._timeout_expired(
+                            orig_timeout, stdout, stderr)
+
+                    if written:
+                        input_data_sent = True
+                        if send_marker_list:
+                            send_marker = marker_bytes(send_marker_list.pop(0))
+                else:
+                    input_data_sent = True
+
+            if self.wait_for_marker in found:
+                return None, None
+
+            if kill_marker in found:
+                self._stop_readers()
+                self._kill()
+                break
+
+            # If we have finished sending all our input, and have received the
+            # ready-to-send marker, we can close out stdin.
+            if self.stdin and input_data_sent:
+                if close_marker is None or close_marker_seen:
+                    input_data_sent = None
+                    self.stdin.close()
 
+        try:
+            await asyncio.wait_for(asyncio.shield(self.exited), self._remaining_time(endtime))
+        except asyncio.TimeoutError:
+            raise subprocess.TimeoutExpired(self.cmd_line, orig_timeout)
+
+        self.stdin.close()
+
+        # All data exchanged. The captures are returned as they are, so the
+        # output is only copied into bytes if a test asks for it.
         return (stdout, stderr)
 
+    def _log_markers(self, found, stream, markers):
+        for kind, marker in markers:
+            if marker in found:
+                log_event('marker', pid=self.proc.pid, kind=kind, stream=stream, offset=found[marker],
+                          marker=marker.decode('utf-8', 'backslashreplace'))
+
+    def _record_exit(self, exited):
+        self.exit_time = _time()
+        if self.group is not None:
+            self._remove_group()
+
+    def _remove_group(self, attempts=10):
+        # A cgroup can only be removed once every process in it has exited
+        if not self.group.remove() and attempts > 0:
+            asyncio.get_running_loop().call_later(
+                _EXIT_POLL_INTERVAL, self._remove_group, attempts - 1)
+
+    @property
+    def resource_usage(self):
+        """
+        The ResourceUsage of the process, once it has exited.
+        """
+        if not self.exited.done() or self.exited.result() is None:
+            return None
+        return ResourceUsage.from_rusage(self.exited.result())
+
+    def _signal(self, sig):
+        # Popen.kill() would poll, and could reap the process before _watch_exit
+        # collects its rusage. Processes are only reaped on the event loop, so the
+        # pid can't have been reused while returncode is None.
+        if self.group is not None:
+            self.group.signal(sig, leader_reaped=self.exited.done())
+        elif self.proc.returncode is None:
+            try:
+                os.kill(self.proc.pid, sig)
+            except ProcessLookupError:
+                pass
+
+    def _kill(self):
+        # Children of the process may still hold its output pipes open after it
+        # has exited, so its cgroup is killed even if the process is gone.
+        self._signal(signal.SIGKILL)
+
+    async def terminate(self, grace_period=KILL_GRACE_PERIOD):
+        """
+        Send SIGTERM to the process group, and SIGKILL if the process is still
+        running after grace_period.
+        """
+        if not self.exited.done():
+            self._signal(signal.SIGTERM)
+            try:
+                await asyncio.wait_for(asyncio.shield(self.exited), grace_period)
+            except asyncio.TimeoutError:
+                pass
+
+        self._kill()
+
+    async def drain(self, timeout=KILL_GRACE_PERIOD):
+        """
+        Read what is left of the output of a killed process. A child outside its
+        process group can hold the pipes open, so reading stops after timeout and
+        whatever was captured is returned.
+        """
+        try:
+            return await self.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            self._stop_readers()
+            return (self._fileobj2output.get('stdout'),
+                    self._fileobj2output.get('stderr'))
+
     def _remaining_time(self, endtime):
         """Convenience for _communicate when computing timeouts."""
         if endtime is None:
@@ -229,26 +809,22 @@ class _processCommunicator(object):
         else:
             return endtime - _time()
 
-    def _check_timeout(self, endtime, orig_timeout, stdout_seq, stderr_seq,
-                       skip_check_and_raise=False):
+    def _timeout_expired(self, orig_timeout, stdout, stderr):
         """
-        Convenience for checking if a timeout has expired.
+        Build the exception raised when a timeout has expired.
 
-        NOTE: This method is included here to prevent our custom _communicate method
-        from relying on a particular version of Python.
+        NOTE: subprocess.TimeoutExpired is used, rather than asyncio.TimeoutError,
+        so callers don't need to know how the process is driven.
         """
-        if endtime is None:
-            return
-        if skip_check_and_raise or _time() > endtime:
-            raise subprocess.TimeoutExpired(
-                self.proc.args, orig_timeout,
-                output=b''.join(stdout_seq) if stdout_seq else None,
-                stderr=b''.join(stderr_seq) if stderr_seq else None)
+        return subprocess.TimeoutExpired(
+            self.cmd_line, orig_timeout,
+            output=stdout.getvalue() if stdout else None,
+            stderr=stderr.getvalue() if stderr else None)
 
 
-class ManagedProcess(threading.Thread):
+class ManagedProcess(object):
     """
-    A ManagedProcess is a thread that monitors a subprocess.
+    A ManagedProcess monitors a subprocess from the shared event loop.
     This class provides a single place to control process timeouts and cleanup.
 
     The stdin/stdout/stderr and exist code a monitored and results
@@ -257,9 +833,7 @@ class ManagedProcess(threading.Thread):
 
     def __init__(self, cmd_line, provider_set_ready_condition, wait_for_marker=None, send_marker_list=None,
                  close_marker=None, timeout=5, data_source=None, env_overrides=dict(), expect_stderr=False,
-                 kill_marker=None, send_with_newline=False):
-        threading.Thread.__init__(self)
-
+                 kill_marker=None, send_with_newline=False, output_memory_limit=OUTPUT_MEMORY_LIMIT):
         proc_env = os.environ.copy()
 
         for key in env_overrides:
@@ -273,13 +847,23 @@ class ManagedProcess(threading.Thread):
         # Total time to wait until killing the subprocess
         self.timeout = timeout
 
-        # Condition variable indicating when results are ready to be collected
-        self.results_condition = threading.Condition()
+        # Bytes of stdout/stderr kept in memory before spilling to a temporary file
+        self.output_memory_limit = output_memory_limit
+
+        # The subprocess, and the future tracking run() on the event loop
+        self.proc = None
         self.results = None
+        self._future = None
+        self._communicator = None
+
+        # Resolved as soon as the process is ready for testing. If the process
+        # exits or times out first, it holds the exception instead.
+        self._ready = concurrent.futures.Future()
+
+        # Monotonic timestamps of the process launch, and of the ready marker
+        self.spawn_time = None
+        self.ready_time = None
 
-        # Condition variable indicating when this subprocess has been launched successfully
-        self.ready_condition = threading.Condition()
-        self.process_ready = False
         self.provider_set_ready_condition = provider_set_ready_condition
 
         # Indicates the process has completed some initial setup and is ready for testing
@@ -300,97 +884,301 @@ class ManagedProcess(threading.Thread):
             if type(send_marker_list) is not list:
                 self.send_marker_list = [send_marker_list]
 
-    def run(self):
-        with self.results_condition:
+    async def run(self):
+        # stdin, stdout and stderr are plain pipes driven by the event loop, rather
+        # than asyncio streams. Output is read directly into an _OutputCapture, and
+        # input is written by an _InputWriter without being copied.
+        stdin_r, stdin_w = os.pipe()
+        stdout_r, stdout_w = os.pipe()
+        stderr_r, stderr_w = os.pipe()
+        group = _ProcessGroup(get_flag(S2N_CGROUP_ROOT))
+        try:
+            # The process is reaped by _watch_exit, so asyncio's subprocess support
+            # and child watchers aren't used. A new session makes the process the
+            # leader of its own process group.
+            proc = subprocess.Popen(group.wrap(self.cmd_line), env=self.proc_env, stdin=stdin_r,
+                                    stdout=stdout_w, stderr=stderr_w, close_fds=True, start_new_session=True)
+            group.started(proc)
+            self.proc = proc
+            self.spawn_time = _time()
+            log_event('spawn', pid=proc.pid,
+                      cmd_line=self.cmd_line, cgroup=group.cgroup)
+        except Exception as ex:
+            group.remove()
+            os.close(stdin_w)
+            os.close(stdout_r)
+            os.close(stderr_r)
+            self.results = Results(
+                None, None, None, ex, self.expect_stderr)
+            raise ex
+        finally:
+            os.close(stdin_r)
+            os.close(stdout_w)
+            os.close(stderr_w)
+
+        communicator = _processCommunicator(
+            proc, self.cmd_line, stdin_w,
+            {'stdout': stdout_r, 'stderr': stderr_r},
+            self.output_memory_limit, group)
+        self._communicator = communicator
+
+        if self.ready_to_test is not None:
+            # Some processes won't be ready until they have emitted some string in stdout.
             try:
-                proc = subprocess.Popen(self.cmd_line, env=self.proc_env, stdin=subprocess.PIPE,
-                                        stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
-                self.proc = proc
-            except Exception as ex:
+                await communicator.wait_for(self.ready_to_test, timeout=self.timeout)
+            except subprocess.TimeoutExpired as ex:
+                # Don't leave the process running until its own timeout
+                communicator._kill()
+                wrapped_ex = TimeoutException(ex)
+                self._ready.set_exception(wrapped_ex)
+
+                proc_results = await communicator.drain()
                 self.results = Results(
-                    None, None, None, ex, self.expect_stderr)
-                raise ex
+                    proc_results[0], proc_results[1], proc.returncode, wrapped_ex, self.expect_stderr,
+                    resource_usage=communicator.resource_usage, timestamps=self.timestamps)
+                self._log_exit()
+                return
+
+        # Let anything waiting on process launch proceed
+        self.ready_time = _time()
+        log_event('ready', pid=proc.pid, startup_latency=self.startup_latency)
+        self._ready.set_result(self)
+        self.provider_set_ready_condition()
+
+        proc_results = None
+        try:
+            proc_results = await communicator.communicate(
+                input_data=self.data_source,
+                send_marker_list=self.send_marker_list,
+                close_marker=self.close_marker,
+                kill_marker=self.kill_marker,
+                send_with_newline=self.send_with_newline,
+                timeout=self.timeout,
+            )
+            self.results = Results(
+                proc_results[0],
+                proc_results[1],
+                proc.returncode,
+                None,
+                expect_stderr=self.expect_stderr,
+                expect_nonzero_exit=self.kill_marker is not None,
+                resource_usage=communicator.resource_usage,
+                timestamps=self.timestamps
+            )
+        except subprocess.TimeoutExpired as ex:
+            communicator._kill()
+            wrapped_ex = TimeoutException(ex)
+
+            # Read any remaining output
+            proc_results = await communicator.drain()
+            self.results = Results(
+                proc_results[0], proc_results[1], proc.returncode, wrapped_ex, self.expect_stderr,
+                resource_usage=communicator.resource_usage, timestamps=self.timestamps)
+        except Exception as ex:
+            self.results = Results(
+                proc_results[0], proc_results[1], proc.returncode, ex, self.expect_stderr,
+                resource_usage=communicator.resource_usage, timestamps=self.timestamps)
+            raise ex
+        finally:
+            self._log_exit()
 
-            communicator = _processCommunicator(proc)
+    def _log_exit(self):
+        """
+        Log how the process exited. The full output is only logged if the process
+        failed, or if it was requested with --log-process-output. The managed_process
+        fixture prints the output of every process when a test fails.
+        """
+        if not event_log_enabled():
+            return
 
-            if self.ready_to_test is not None:
-                # Some processes won't be ready until they have emitted some string in stdout.
-                communicator.wait_for(self.ready_to_test, timeout=self.timeout)
+        results = self.results
+        exception = None
+        if results and results.exception:
+            exception = repr(results.exception)
+        resource_usage = results.resource_usage if results else None
+        log_event('exit', pid=self.proc.pid, exit_code=self.proc.returncode,
+                  exception=exception,
+                  stdout_bytes=len(results.stdout_view()) if results else None,
+                  stderr_bytes=len(results.stderr_view()) if results else None,
+                  timestamps=self.timestamps.as_dict(),
+                  resource_usage=resource_usage.as_dict() if resource_usage else None)
 
-            # Let any threads waiting on process launch proceed
-            self.provider_set_ready_condition()
+        try:
+            results.assert_success()
+            failed = False
+        except Exception:
+            failed = True
 
-            proc_results = None
-            try:
-                proc_results = communicator.communicate(
-                    input_data=self.data_source,
-                    send_marker_list=self.send_marker_list,
-                    close_marker=self.close_marker,
-                    kill_marker=self.kill_marker,
-                    send_with_newline=self.send_with_newline,
-                    timeout=self.timeout,
-                )
-                self.results = Results(
-                    proc_results[0],
-                    proc_results[1],
-                    proc.returncode,
-                    None,
-                    expect_stderr=self.expect_stderr,
-                    expect_nonzero_exit=self.kill_marker is not None
-                )
-            except subprocess.TimeoutExpired as ex:
-                proc.kill()
-                wrapped_ex = TimeoutException(ex)
+        if failed or get_flag(S2N_LOG_PROCESS_OUTPUT, False):
+            log_event('output', pid=self.proc.pid,
+                      output=format_output(self.cmd_line, results))
 
-                # Read any remaining output
-                proc_results = communicator.communicate()
-                self.results = Results(
-                    proc_results[0], proc_results[1], proc.returncode, wrapped_ex, self.expect_stderr)
-            except Exception as ex:
-                self.results = Results(
-                    proc_results[0], proc_results[1], proc.returncode, ex, self.expect_stderr)
-                raise ex
-            finally:
-                # This data is dumped to stdout so we capture this
-                # information no matter where a test fails.
-                print("Command line: {}".format(" ".join(self.cmd_line)))
-                print("Exit code: {}".format(proc.returncode))
-                print("Stdout: {}".format(
-                    proc_results[0].decode("utf-8", "backslashreplace")))
-                print("Stderr: {}".format(
-                    proc_results[1].decode("utf-8", "backslashreplace")))
+    def format_output(self):
+        """
+        Describe the command line, exit code and output of the process.
+        """
+        return format_output(self.cmd_line, self.results)
+
+    def start(self):
+        """
+        Schedule the process on the worker's event loop and return immediately.
+        """
+        self._future = asyncio.run_coroutine_threadsafe(
+            self.run(), get_event_loop())
+        self._future.add_done_callback(self._run_finished)
+
+    def _run_finished(self, future):
+        """
+        If run() ends before the process was ready, wake anything waiting for it.
+        """
+        if self._ready.done():
+            return
+
+        exception = None if future.cancelled() else future.exception()
+        if exception is None:
+            exception = RuntimeError("Process exited before it was ready: {}".format(
+                " ".join(self.cmd_line)))
+        self._ready.set_exception(exception)
+
+    async def ready(self):
+        """
+        Wait until the process is ready for testing. Raises the exception which
+        stopped the process if it never became ready.
+        """
+        return await asyncio.wrap_future(self._ready)
+
+    async def result(self):
+        """
+        Wait until the process has exited and return its Results.
+        """
+        try:
+            await asyncio.wrap_future(self._future)
+        except Exception:
+            if self.results is None:
+                raise
+
+        return self.results
+
+    def wait_ready(self, timeout=None):
+        """
+        Block until the process is ready for testing, returning False if it
+        never became ready within the timeout.
+        """
+        try:
+            self._ready.result(timeout=timeout)
+        except Exception:
+            return False
+
+        return True
+
+    @property
+    def startup_latency(self):
+        """
+        Seconds between launching the process and it being ready for testing.
+        """
+        return self.timestamps.startup_latency
+
+    @property
+    def timestamps(self):
+        """
+        ProcessTimestamps of the stages this process has reached so far.
+        """
+        communicator = self._communicator
+        return ProcessTimestamps(
+            spawn=self.spawn_time,
+            ready=self.ready_time,
+            first_byte=communicator.first_byte_time if communicator else None,
+            exit=communicator.exit_time if communicator else None)
+
+    def join(self, timeout=None):
+        """
+        Block until the process has exited and its results have been collected.
+        """
+        if self._future is not None:
+            concurrent.futures.wait([self._future], timeout=timeout)
 
     def kill(self):
-        self.proc.kill()
+        get_event_loop().call_soon_threadsafe(self._kill)
 
-    def _process_ready(self):
-        """Condition variable predicate"""
-        return self.process_ready is True
+    def _kill(self):
+        if self._communicator is not None:
+            self._communicator._kill()
+
+    def terminate(self, grace_period=KILL_GRACE_PERIOD):
+        """
+        Send SIGTERM to the process and its children, then SIGKILL to any still
+        running after grace_period. Returns a concurrent.futures.Future which is
+        done once the signals have been sent, so many processes can be terminated
+        at once.
+        """
+        return asyncio.run_coroutine_threadsafe(self._terminate(grace_period), get_event_loop())
 
-    def _results_ready(self):
-        """Condition variable predicate"""
-        return self.results is not None
+    async def _terminate(self, grace_period):
+        if self._communicator is not None:
+            await self._communicator.terminate(grace_period)
 
     def get_cmd_line(self):
         return self.cmd_line
 
-    def launch(self):
+    def running(self):
+        return self._future is not None and not self._future.done()
+
+    def _call_on_loop(self, fn, *args):
+        """
+        Run fn on the event loop and return its result. Output captures are only
+        touched from the loop, so they are never resized while being read.
+        """
+        future = concurrent.futures.Future()
+
+        def _call():
+            try:
+                future.set_result(fn(*args))
+            except Exception as ex:
+                future.set_exception(ex)
+
+        get_event_loop().call_soon_threadsafe(_call)
+        return future.result()
+
+    def output_lengths(self):
         """
-        This method must be implemented by the subclass.
-        It should call the run function.
+        Return the number of bytes captured so far from stdout and stderr.
+        Only valid once the process is ready.
         """
-        raise NotImplementedError
+        return self._call_on_loop(self._communicator.output_lengths)
+
+    def get_output(self, stream, start=0, end=None):
+        """
+        Return a copy of the bytes captured from stream ('stdout' or 'stderr')
+        between the offsets start and end.
+        """
+        return self._call_on_loop(
+            lambda: self._communicator._fileobj2output[stream].getvalue(start, end))
+
+    def watch_for(self, marker, start=0, stream='stdout'):
+        """
+        Return a concurrent.futures.Future which resolves with output_lengths()
+        once marker appears in stream after offset start. If the stream closes
+        first, the future holds an EOFError. Only valid once the process is ready.
+        """
+        future = concurrent.futures.Future()
+        get_event_loop().call_soon_threadsafe(
+            self._communicator.watch, stream, marker, start, future)
+        return future
 
     def get_results(self, send_data=None):
         """
         Block until the results are ready, or a timeout is reached.
         Return the results, or raise the timeout exception.
         """
-        with self.results_condition:
-            result = self.results_condition.wait_for(
-                self._results_ready, timeout=self.timeout)
-
-            if result is False:
-                raise Exception("Timeout")
+        # A process which times out is killed, and its output drained for up to
+        # KILL_GRACE_PERIOD, before its results are set. The second grace period
+        # allows for the time taken to kill it.
+        timeout = None
+        if self.timeout is not None:
+            timeout = self.timeout + 2 * KILL_GRACE_PERIOD
+        self.join(timeout)
+
+        if self.results is None:
+            raise Exception("Timeout")
 
         yield self.results
@@ -1,7 +1,11 @@
+import os
 import pytest
+import ssl
 import threading
 
-from common import ProviderOptions, Ciphers, Curves, Protocols, Certificates, Signatures
+import python_ssl
+
+from common import ProviderOptions, Ciphers, Curves, Protocols, Certificates, Signatures, Transports
 from global_flags import get_flag, S2N_PROVIDER_VERSION, S2N_FIPS_MODE
 
 
@@ -20,6 +24,10 @@ class Provider(object):
     ClientMode = "client"
     ServerMode = "server"
 
+    # Providers which run inside the test process, instead of as a command line,
+    # set this to True. See PythonSSL.
+    in_process = False
+
     def __init__(self, options: ProviderOptions):
         # If the provider includes stderr output on a success, set this to True.
         self.expect_stderr = False
@@ -32,6 +40,11 @@ class Provider(object):
         # with some providers to properly write to stdin.
         self.send_with_newline = False
 
+        # Servers which handle connections one at a time can print a message when
+        # each connection is finished. Set this to that message to allow the server
+        # to be reused by several tests, see server_pool.py.
+        self.connection_closed_marker = None
+
         # By default, we expect clients to send, but not servers.
         if options.mode == Provider.ClientMode:
             self.ready_to_send_input_marker = self.get_send_marker()
@@ -84,6 +97,14 @@ class Provider(object):
     def supports_signature(cls, signature):
         return True
 
+    @classmethod
+    def supports_transport(cls, transport):
+        """
+        Whether the provider can use a transport from Transports. Providers fall back
+        to TCP when they can't, so the option never needs to be cleared for them.
+        """
+        return transport == Transports.TCP
+
     def get_cmd_line(self):
         return self.cmd_line
 
@@ -98,27 +119,27 @@ class Provider(object):
 
 class Tcpdump(Provider):
     """
-    TcpDump is used by the dynamic record test. It only needs to watch
-    a handful of packets before it can exit.
+    Tcpdump captures the connections to a port on the loopback, for TcpdumpCapture
+    (see the packet_capture fixture). It writes the packets to its standard output
+    as a pcap file, until it is terminated.
 
     This class still follows the provider setup, but all values are hardcoded
-    because this isn't expected to be used outside of the dynamic record test.
+    because this isn't expected to be used outside of packet captures.
     """
 
     def __init__(self, options: ProviderOptions):
         Provider.__init__(self, options)
+        # tcpdump reports what it is listening on, and how many packets it captured
+        self.expect_stderr = True
 
     def setup_client(self):
         self.ready_to_test_marker = 'listening on lo'
-        tcpdump_filter = "dst port {}".format(self.options.port)
+        tcpdump_filter = "port {}".format(self.options.port)
 
         cmd_line = ["tcpdump",
-                    # Line buffer the output
-                    "-l",
-
-                    # Only read 10 packets before exiting. This is enough to find a large
-                    # packet, and still exit before the timeout.
-                    "-c", "10",
+                    # Write each packet to standard output as soon as it is captured,
+                    # as a pcap file
+                    "-w", "-", "-U",
 
                     # Watch the loopback device
                     "-i", "lo",
@@ -126,8 +147,8 @@ class Tcpdump(Provider):
                     # Don't resolve IP addresses
                     "-nn",
 
-                    # Set the buffer size to 1k
-                    "-B", "1024",
+                    # Set the buffer size to 4M, so no packets of large transfers are dropped
+                    "-B", "4096",
                     tcpdump_filter]
 
         return cmd_line
@@ -187,6 +208,37 @@ class S2N(Provider):
 
         return True
 
+    @classmethod
+    def supports_transport(cls, transport):
+        return transport in (Transports.TCP, Transports.UNIX)
+
+    def _transport_flags(self):
+        """
+        s2nd also listens on the Unix socket, so clients which only speak TCP can still
+        connect. s2nc falls back to TCP if nothing listens on the socket, e.g. when the
+        server is another provider. The mainline version doesn't have the option.
+        """
+        if self.options.transport == Transports.UNIX and self.options.use_mainline_version is not True:
+            return ['--unix-socket', self.options.unix_socket]
+        return []
+
+    def _write_batch_file(self):
+        """
+        Write the connections of ProviderOptions.batch for s2nc --batch.
+        """
+        if self.options.use_mainline_version is True:
+            raise ValueError(
+                "The mainline version of s2nc doesn't support batch mode")
+
+        # Clients which share the options write the same file, so it's replaced
+        # atomically rather than truncated under a client which is reading it
+        partial = "{}.{}".format(self.options.batch_file, os.getpid())
+        with open(partial, 'w') as batch_file:
+            for connection in self.options.batch:
+                batch_file.write(connection.to_line() + '\n')
+        os.replace(partial, self.options.batch_file)
+        return self.options.batch_file
+
     def setup_client(self):
         """
         Using the passed ProviderOptions, create a command line.
@@ -200,7 +252,7 @@ class S2N(Provider):
 
         # Tests requiring reconnects can't wait on echo data,
         # but all other tests can.
-        if self.options.reconnect is not True:
+        if self.options.reconnect is not True and not self.options.batch:
             cmd_line.append('-e')
 
         if self.options.use_session_ticket is False:
@@ -216,6 +268,9 @@ class S2N(Provider):
         if self.options.reconnect is True:
             cmd_line.append('-r')
 
+        if self.options.batch:
+            cmd_line.extend(['--batch', self._write_batch_file()])
+
         # If the test provided a cipher (security policy) that is compatible with
         # s2n, we'll use it. Otherwise, default to the appropriate `test_all` policy.
         cipher_prefs = 'test_all_tls12'
@@ -241,6 +296,7 @@ class S2N(Provider):
         if self.options.extra_flags is not None:
             cmd_line.extend(self.options.extra_flags)
 
+        cmd_line.extend(self._transport_flags())
         cmd_line.extend([self.options.host, self.options.port])
 
         # Clients are always ready to connect
@@ -252,6 +308,14 @@ class S2N(Provider):
         # s2nd prints this message after it begins listening for connections
         self.ready_to_test_marker = 'Listening on'
 
+        # With --print-connection-closed, s2nd prints this message after each
+        # connection, unless connections are handled in parallel. Older versions
+        # of s2nd don't have the flag.
+        if self.options.mark_closed_connections and \
+                self.options.use_mainline_version is not True and \
+                '--parallelize' not in (self.options.extra_flags or []):
+            self.connection_closed_marker = 'Connection closed'
+
         """
         Using the passed ProviderOptions, create a command line.
         """
@@ -260,7 +324,13 @@ class S2N(Provider):
             cmd_line.append('s2nd_head')
         else:
             cmd_line.append('s2nd')
-        cmd_line.extend(['-X', '--self-service-blinding', '--non-blocking'])
+        # With --parallelize, s2nd only exits after --max-conns connections, so it
+        # keeps accepting connections unless the test limits them
+        if '--parallelize' not in (self.options.extra_flags or []):
+            cmd_line.append('-X')
+        cmd_line.extend(['--self-service-blinding', '--non-blocking'])
+        if self.connection_closed_marker is not None:
+            cmd_line.append('--print-connection-closed')
 
         if self.options.key is not None:
             cmd_line.extend(['--key', self.options.key])
@@ -303,6 +373,7 @@ class S2N(Provider):
         if self.options.extra_flags is not None:
             cmd_line.extend(self.options.extra_flags)
 
+        cmd_line.extend(self._transport_flags())
         cmd_line.extend([self.options.host, self.options.port])
 
         return cmd_line
@@ -395,7 +466,8 @@ class OpenSSL(Provider):
             ['-connect', '{}:{}'.format(self.options.host, self.options.port)])
 
         # Additional debugging that will be captured incase of failure
-        cmd_line.extend(['-debug', '-tlsextdebug', '-state'])
+        if self.options.debug:
+            cmd_line.extend(['-debug', '-tlsextdebug', '-state'])
 
         if self.options.key is not None:
             cmd_line.extend(['-key', self.options.key])
@@ -452,6 +524,7 @@ class OpenSSL(Provider):
     def setup_server(self):
         # s_server prints this message before it is ready to send/receive data
         self.ready_to_test_marker = 'ACCEPT'
+        self.connection_closed_marker = 'CONNECTION CLOSED'
 
         cmd_line = ['openssl', 's_server']
         cmd_line.extend(['-accept', '{}'.format(self.options.port)])
@@ -465,7 +538,8 @@ class OpenSSL(Provider):
             cmd_line.extend(['-naccept', '1'])
 
         # Additional debugging that will be captured incase of failure
-        cmd_line.extend(['-debug', '-tlsextdebug', '-state'])
+        if self.options.debug:
+            cmd_line.extend(['-debug', '-tlsextdebug', '-state'])
 
         if self.options.cert is not None:
             cmd_line.extend(['-cert', self.options.cert])
@@ -730,10 +804,12 @@ class GnuTLS(Provider):
             "gnutls-cli",
             "--port", str(self.options.port),
             self.options.host,
-            "--debug", "9999",
             "--verbose"
         ]
 
+        if self.options.debug:
+            cmd_line.extend(["--debug", "9999"])
+
         if self.options.cert and self.options.key:
             cmd_line.extend(["--x509certfile", self.options.cert])
             cmd_line.extend(["--x509keyfile", self.options.key])
@@ -761,10 +837,12 @@ class GnuTLS(Provider):
         cmd_line = [
             "gnutls-serv",
             f"--port={self.options.port}",
-            "--echo",
-            "--debug=9999"
+            "--echo"
         ]
 
+        if self.options.debug:
+            cmd_line.append("--debug=9999")
+
         if self.options.cert is not None:
             cmd_line.extend(["--x509certfile", self.options.cert])
         if self.options.key is not None:
@@ -799,3 +877,77 @@ class GnuTLS(Provider):
     @classmethod
     def supports_signature(cls, signature):
         return GnuTLS.sigalg_to_priority_str(signature) is not None
+
+
+class PythonSSL(Provider):
+    """
+    A TLS peer which runs inside the test process, using Python's ssl module on the
+    worker's event loop (see python_ssl.py). No process is started for each
+    connection, so handshakes against s2n cost only the handshake itself.
+
+    The command line describes the peer in logs, but is never executed.
+    """
+
+    # Run by the managed_process fixture as a PythonSSLPeer, not a ManagedProcess
+    in_process = True
+
+    def __init__(self, options: ProviderOptions):
+        Provider.__init__(self, options)
+
+    @classmethod
+    def get_send_marker(cls):
+        return python_ssl.HANDSHAKE_COMPLETE_MARKER
+
+    @classmethod
+    def supports_protocol(cls, protocol, with_cert=None):
+        version = python_ssl.ssl_version(protocol)
+        if version is None:
+            return False
+
+        return getattr(ssl, "HAS_" + version.name) is True
+
+    @classmethod
+    def supports_cipher(cls, cipher, with_curve=None):
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        if with_curve is not None:
+            try:
+                context.set_ecdh_curve(python_ssl.curve_name(with_curve))
+            except ValueError:
+                return False
+
+        # The ssl module can't choose which TLS1.3 ciphersuites are offered, so
+        # the peer would pick one rather than the cipher under test.
+        if cipher.min_version >= Protocols.TLS13:
+            return False
+
+        try:
+            context.set_ciphers(cipher.name + ":@SECLEVEL=0")
+        except ssl.SSLError:
+            return False
+        return True
+
+    @classmethod
+    def supports_signature(cls, signature):
+        # The ssl module can't restrict the signature algorithms
+        return False
+
+    def _describe(self):
+        cmd_line = ['python-ssl', self.options.mode,
+                    '{}:{}'.format(self.options.host, self.options.port)]
+        if self.options.protocol is not None:
+            cmd_line.append(str(self.options.protocol))
+        if self.options.cipher is not None:
+            cmd_line.append(str(self.options.cipher))
+        return cmd_line
+
+    def setup_client(self):
+        # Clients are always ready to connect
+        self.set_provider_ready()
+
+        return self._describe()
+
+    def setup_server(self):
+        self.ready_to_test_marker = python_ssl.LISTENING_MARKER
+        self.connection_closed_marker = python_ssl.CONNECTION_CLOSED_MARKER
+
+        return self._describe()
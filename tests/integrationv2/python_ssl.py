@@ -0,0 +1,378 @@
+import asyncio
+import concurrent.futures
+import ssl
+
+from common import ProcessTimestamps, Protocols, Results, TimeoutException
+from event_log import log_event
+from processes import KILL_GRACE_PERIOD, format_output, get_event_loop, marker_bytes
+from time import monotonic as _time
+
+
+# Maps the value of each Protocol to the ssl module's version
+_SSL_VERSIONS = {
+    Protocols.TLS13.value: ssl.TLSVersion.TLSv1_3,
+    Protocols.TLS12.value: ssl.TLSVersion.TLSv1_2,
+    Protocols.TLS11.value: ssl.TLSVersion.TLSv1_1,
+    Protocols.TLS10.value: ssl.TLSVersion.TLSv1,
+}
+
+# The ssl module names curves the way OpenSSL does internally
+_CURVE_NAMES = {
+    "P-256": "prime256v1",
+    "P-384": "secp384r1",
+    "P-521": "secp521r1",
+}
+
+# Printed once the handshake is complete. Clients send their data after this.
+HANDSHAKE_COMPLETE_MARKER = "Handshake complete"
+
+# Printed by servers once they are accepting connections
+LISTENING_MARKER = "Listening on"
+
+# Printed by servers after each connection is closed
+CONNECTION_CLOSED_MARKER = "Connection closed"
+
+_READ_SIZE = 65536
+
+
+def ssl_version(protocol):
+    return _SSL_VERSIONS.get(protocol.value)
+
+
+def curve_name(curve):
+    return _CURVE_NAMES.get(str(curve), str(curve))
+
+
+def create_context(options):
+    """
+    Build an SSLContext from ProviderOptions.
+    """
+    from providers import Provider
+
+    if options.mode == Provider.ServerMode:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        if options.cert is not None:
+            context.load_cert_chain(options.cert, options.key)
+        if options.use_client_auth:
+            context.verify_mode = ssl.CERT_REQUIRED
+            context.load_verify_locations(options.trust_store or options.cert)
+    else:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        if options.insecure:
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+        else:
+            context.check_hostname = options.verify_hostname is not None
+            context.load_verify_locations(options.trust_store or options.cert)
+        if options.use_client_auth and options.cert is not None:
+            context.load_cert_chain(options.cert, options.key)
+
+    if options.protocol is not None:
+        context.minimum_version = ssl_version(options.protocol)
+        context.maximum_version = ssl_version(options.protocol)
+
+    # With OpenSSL 1.1.0 and later, this limits the supported groups to the one curve
+    if options.curve is not None:
+        context.set_ecdh_curve(curve_name(options.curve))
+
+    # TLS1.3 ciphersuites can't be configured through the ssl module, so they
+    # are left as they are. PythonSSL doesn't claim to support them.
+    cipher = options.cipher
+    ciphers = None
+    if cipher is not None and cipher.min_version < Protocols.TLS13:
+        ciphers = cipher.name
+        if cipher.parameters is not None and options.mode == Provider.ServerMode:
+            context.load_dh_params(cipher.parameters)
+
+    # Recent OpenSSL versions only allow TLS1.1 and earlier at security level 0
+    if options.protocol is not None and options.protocol < Protocols.TLS12:
+        ciphers = (ciphers or "DEFAULT") + ":@SECLEVEL=0"
+
+    if ciphers is not None:
+        context.set_ciphers(ciphers)
+
+    return context
+
+
+class PythonSSLPeer(object):
+    """
+    Runs a PythonSSL client or server on the worker's event loop, in place of a
+    ManagedProcess. It has the same interface, so tests and fixtures don't need to
+    know whether a peer is a process.
+
+    The peer writes the same kind of output a TLS command line tool would: a line
+    when the handshake is complete, the negotiated protocol and cipher, and any
+    application data received. Send, close and kill markers are matched against
+    that output, just like they are for processes.
+    """
+
+    def __init__(self, provider, send_marker_list=None, close_marker=None, timeout=5, data_source=None,
+                 kill_marker=None, send_with_newline=False):
+        self.provider = provider
+        self.options = provider.options
+        self.cmd_line = provider.get_cmd_line()
+        self.timeout = timeout
+        self.close_marker = marker_bytes(close_marker)
+        self.kill_marker = marker_bytes(kill_marker)
+        self.send_with_newline = send_with_newline
+        self.expect_stderr = False
+
+        if data_source is not None and type(data_source) is not list:
+            data_source = [data_source]
+        self.data_source = data_source or []
+
+        if send_marker_list is not None and type(send_marker_list) is not list:
+            send_marker_list = [send_marker_list]
+        self.send_marker_list = [marker_bytes(m)
+                                 for m in send_marker_list or []]
+
+        # There is no process, but fixtures check for one
+        self.proc = None
+        self.results = None
+        self._future = None
+        self._task = None
+        self._ready = concurrent.futures.Future()
+
+        # Output is only written and read on the event loop
+        self._stdout = bytearray()
+        self._stderr = bytearray()
+        self.spawn_time = None
+        self.ready_time = None
+        self.first_byte_time = None
+        self.exit_time = None
+
+    def _write(self, output, data):
+        if self.first_byte_time is None:
+            self.first_byte_time = _time()
+        output += data
+
+    def _print(self, line):
+        self._write(self._stdout, line.encode("utf-8") + b"\n")
+
+    def _seen(self, marker, start):
+        return marker is not None and self._stdout.find(marker, start) != -1
+
+    async def run(self):
+        from providers import Provider
+
+        self.spawn_time = _time()
+        log_event('spawn', pid=None, cmd_line=self.cmd_line)
+
+        exit_code = 0
+        exception = None
+        try:
+            context = create_context(self.options)
+            if self.options.mode == Provider.ServerMode:
+                await asyncio.wait_for(self._serve(context), self.timeout)
+            else:
+                await asyncio.wait_for(self._connect(context), self.timeout)
+        except asyncio.TimeoutError:
+            exception = TimeoutException(Exception("{} timed out after {} seconds".format(
+                " ".join(self.cmd_line), self.timeout)))
+            exit_code = None
+        except asyncio.CancelledError:
+            exit_code = -1
+        except (OSError, EOFError) as ex:
+            message = "{}: {}\n".format(type(ex).__name__, ex)
+            self._write(self._stderr, message.encode("utf-8"))
+            exit_code = 1
+        except Exception as ex:
+            # e.g. a cipher string the ssl module doesn't support. The caller
+            # gets the exception from the results, like a process which
+            # couldn't be started.
+            exception = ex
+            exit_code = None
+        finally:
+            self.exit_time = _time()
+            if not self._ready.done():
+                self._ready.set_exception(exception or RuntimeError(
+                    "Peer exited before it was ready: {}".format(" ".join(self.cmd_line))))
+
+        self.results = Results(
+            bytes(self._stdout), bytes(self._stderr), exit_code, exception,
+            expect_nonzero_exit=self.kill_marker is not None, timestamps=self.timestamps)
+        log_event('exit', pid=None, exit_code=exit_code,
+                  exception=repr(exception) if exception else None,
+                  stdout_bytes=len(self._stdout), stderr_bytes=len(self._stderr),
+                  timestamps=self.timestamps.as_dict())
+
+    def _set_ready(self):
+        self.ready_time = _time()
+        log_event('ready', pid=None, startup_latency=self.startup_latency)
+        self._ready.set_result(self)
+        self.provider.set_provider_ready()
+
+    async def _connect(self, context):
+        self._set_ready()
+        server_hostname = self.options.server_name or self.options.host
+        reader, writer = await asyncio.open_connection(
+            self.options.host, int(self.options.port), ssl=context, server_hostname=server_hostname)
+        await self._exchange(reader, writer)
+
+    async def _serve(self, context):
+        connections = int(self.options.reconnects_before_exit or 1)
+        finished = asyncio.Queue()
+
+        # When asyncio runs the handshake for start_server, a failed handshake is
+        # only logged, and the server would wait for the connection until it times
+        # out. Where streams support it, the handshake is run here instead, so its
+        # error ends the server like it would end s2nd.
+        start_tls = hasattr(asyncio.StreamWriter, 'start_tls')
+
+        async def _handle(reader, writer):
+            try:
+                if start_tls:
+                    try:
+                        await writer.start_tls(context)
+                    except Exception:
+                        writer.close()
+                        raise
+                await self._exchange(reader, writer)
+                finished.put_nowait(None)
+            except Exception as ex:
+                finished.put_nowait(ex)
+
+        server = await asyncio.start_server(
+            _handle, host=None, port=int(self.options.port), ssl=None if start_tls else context,
+            reuse_address=True)
+        try:
+            self._print("{} {}".format(LISTENING_MARKER, self.options.port))
+            self._set_ready()
+
+            for _ in range(connections):
+                error = await finished.get()
+                self._print(CONNECTION_CLOSED_MARKER)
+                if error is not None:
+                    raise error
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    async def _exchange(self, reader, writer):
+        """
+        Send each message once its send marker appears in the output, then close the
+        connection once everything has been sent and the close marker was seen. If
+        nothing is to be sent, read until the peer closes the connection.
+        """
+        start = len(self._stdout)
+        ssl_object = writer.get_extra_info('ssl_object')
+        self._print(HANDSHAKE_COMPLETE_MARKER)
+        self._print("Protocol: {}".format(ssl_object.version()))
+        self._print("Cipher: {}".format(ssl_object.cipher()[0]))
+
+        messages = list(self.data_source)
+        markers = list(self.send_marker_list)
+        sent_any = False
+
+        try:
+            while True:
+                while markers and self._seen(markers[0], start):
+                    markers.pop(0)
+                    sent_any = True
+                    if messages:
+                        writer.write(self._message_bytes(messages.pop(0)))
+                        await writer.drain()
+
+                if self._seen(self.kill_marker, start):
+                    writer.transport.abort()
+                    return
+
+                done_sending = sent_any and not messages
+                if done_sending and (self.close_marker is None or self._seen(self.close_marker, start)):
+                    break
+
+                data = await reader.read(_READ_SIZE)
+                if not data:
+                    break
+                self._write(self._stdout, data)
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+    def _message_bytes(self, message):
+        if isinstance(message, str):
+            message = message.encode("utf-8")
+        message = bytes(message)
+        if self.send_with_newline:
+            message += b"\n"
+        return message
+
+    @property
+    def timestamps(self):
+        return ProcessTimestamps(spawn=self.spawn_time, ready=self.ready_time,
+                                 first_byte=self.first_byte_time, exit=self.exit_time)
+
+    @property
+    def startup_latency(self):
+        return self.timestamps.startup_latency
+
+    def start(self):
+        loop = get_event_loop()
+        started = concurrent.futures.Future()
+
+        def _start():
+            self._task = loop.create_task(self.run())
+            self._future = concurrent.futures.Future()
+            self._task.add_done_callback(self._run_finished)
+            started.set_result(None)
+
+        loop.call_soon_threadsafe(_start)
+        started.result()
+
+    def _run_finished(self, task):
+        if task.cancelled() or task.exception() is None:
+            self._future.set_result(self.results)
+        else:
+            self._future.set_exception(task.exception())
+
+    async def ready(self):
+        return await asyncio.wrap_future(self._ready)
+
+    async def result(self):
+        await asyncio.wrap_future(self._future)
+        return self.results
+
+    def wait_ready(self, timeout=None):
+        try:
+            self._ready.result(timeout=timeout)
+        except Exception:
+            return False
+
+        return True
+
+    def join(self, timeout=None):
+        if self._future is not None:
+            concurrent.futures.wait([self._future], timeout=timeout)
+
+    def running(self):
+        return self._future is not None and not self._future.done()
+
+    def kill(self):
+        if self._task is not None:
+            get_event_loop().call_soon_threadsafe(self._task.cancel)
+
+    def terminate(self, grace_period=KILL_GRACE_PERIOD):
+        """
+        There is no process to signal, so the peer is stopped straight away.
+        """
+        self.kill()
+        future = concurrent.futures.Future()
+        future.set_result(None)
+        return future
+
+    def get_cmd_line(self):
+        return self.cmd_line
+
+    def format_output(self):
+        return format_output(self.cmd_line, self.results)
+
+    def get_results(self, send_data=None):
+        self.join()
+
+        if self.results is None:
+            raise Exception("Timeout")
+
+        yield self.results
@@ -0,0 +1,654 @@
+import hashlib
+import os
+import hmac
+import struct
+
+from packet_capture import CHANGE_CIPHER_SPEC, HANDSHAKE, APPLICATION_DATA, CLIENT, SERVER
+
+try:
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+except ImportError:
+    AESGCM = None
+
+
+# The phases of a connection, by the keys which protect its records
+PLAINTEXT = "plaintext"
+EARLY_DATA = "early_data"
+HANDSHAKE_KEYS = "handshake"
+APPLICATION_KEYS = "application"
+PHASES = (PLAINTEXT, EARLY_DATA, HANDSHAKE_KEYS, APPLICATION_KEYS)
+
+# The names of the handshake messages, by type
+HANDSHAKE_TYPES = {
+    0: "hello_request",
+    1: "client_hello",
+    2: "server_hello",
+    4: "new_session_ticket",
+    5: "end_of_early_data",
+    8: "encrypted_extensions",
+    11: "certificate",
+    12: "server_key_exchange",
+    13: "certificate_request",
+    14: "server_hello_done",
+    15: "certificate_verify",
+    16: "client_key_exchange",
+    20: "finished",
+    22: "certificate_status",
+    24: "key_update",
+}
+
+# A ServerHello with this random is a HelloRetryRequest (RFC 8446, section 4.1.3)
+HELLO_RETRY_REQUEST_RANDOM = hashlib.sha256(b"HelloRetryRequest").digest()
+
+TLS12 = 0x0303
+TLS13 = 0x0304
+_SUPPORTED_VERSIONS_EXTENSION = 43
+
+# The labels s2n writes to the key log, before the client random and the secret
+CLIENT_RANDOM = "CLIENT_RANDOM"
+CLIENT_EARLY_TRAFFIC_SECRET = "CLIENT_EARLY_TRAFFIC_SECRET"
+CLIENT_HANDSHAKE_TRAFFIC_SECRET = "CLIENT_HANDSHAKE_TRAFFIC_SECRET"
+SERVER_HANDSHAKE_TRAFFIC_SECRET = "SERVER_HANDSHAKE_TRAFFIC_SECRET"
+CLIENT_TRAFFIC_SECRET_0 = "CLIENT_TRAFFIC_SECRET_0"
+SERVER_TRAFFIC_SECRET_0 = "SERVER_TRAFFIC_SECRET_0"
+
+_AEAD_TAG_SIZE = 16
+
+
+def decryption_supported():
+    """
+    Whether records can be decrypted, which needs the cryptography package
+    """
+    return AESGCM is not None
+
+
+class _CipherSuite(object):
+    """
+    An AEAD cipher suite: how to make its cipher, the length of its key, the hash of
+    its key schedule, and for TLS1.2 the length of the IV from the key block. TLS1.2
+    AES-GCM records start with the rest of their nonce.
+    """
+
+    def __init__(self, aead, key_length, hash_name, tls12_iv_length=12):
+        self.aead = aead
+        self.key_length = key_length
+        self.hash_name = hash_name
+        self.tls12_iv_length = tls12_iv_length
+
+    @property
+    def explicit_nonce_length(self):
+        return 12 - self.tls12_iv_length
+
+
+def _cipher_suites():
+    if AESGCM is None:
+        return {}
+
+    aes128_gcm = _CipherSuite(AESGCM, 16, "sha256", tls12_iv_length=4)
+    aes256_gcm = _CipherSuite(AESGCM, 32, "sha384", tls12_iv_length=4)
+    chacha20_poly1305 = _CipherSuite(ChaCha20Poly1305, 32, "sha256")
+    return {
+        0x1301: aes128_gcm,
+        0x1302: aes256_gcm,
+        0x1303: chacha20_poly1305,
+        0x009c: aes128_gcm,
+        0x009d: aes256_gcm,
+        0x009e: aes128_gcm,
+        0x009f: aes256_gcm,
+        0xc02b: aes128_gcm,
+        0xc02c: aes256_gcm,
+        0xc02f: aes128_gcm,
+        0xc030: aes256_gcm,
+        0xcca8: chacha20_poly1305,
+        0xcca9: chacha20_poly1305,
+        0xccaa: chacha20_poly1305,
+    }
+
+
+# The cipher suites whose records can be decrypted, by their IANA value. CBC and RC4
+# suites aren't decrypted, so only their plaintext handshake messages are traced.
+CIPHER_SUITES = _cipher_suites()
+
+
+def hkdf_expand_label(hash_name, secret, label, context, length):
+    """
+    HKDF-Expand-Label from RFC 8446, section 7.1
+    """
+    label = b"tls13 " + label
+    info = (struct.pack("!HB", length, len(label)) + label +
+            struct.pack("!B", len(context)) + context)
+    output = b""
+    block = b""
+    counter = 1
+    while len(output) < length:
+        message = block + info + struct.pack("!B", counter)
+        block = hmac.new(secret, message, hash_name).digest()
+        output += block
+        counter += 1
+    return output[:length]
+
+
+def tls12_prf(hash_name, secret, label, seed, length):
+    """
+    The TLS1.2 PRF from RFC 5246, section 5
+    """
+    seed = label + seed
+    output = b""
+    a = seed
+    while len(output) < length:
+        a = hmac.new(secret, a, hash_name).digest()
+        output += hmac.new(secret, a + seed, hash_name).digest()
+    return output[:length]
+
+
+class KeyLog(object):
+    """
+    The secrets in key log files (--key-log), in the NSS key log format: a label, the
+    client random and the secret on each line, in hex.
+    """
+
+    def __init__(self, paths=()):
+        self.secrets = {}
+        for path in paths:
+            with open(path) as f:
+                self.add(f.read())
+
+    def add(self, text):
+        for line in text.splitlines():
+            pieces = line.split()
+            if len(pieces) == 3 and not line.startswith("#"):
+                label, client_random, secret = pieces
+                key = (label, bytes.fromhex(client_random))
+                self.secrets[key] = bytes.fromhex(secret)
+
+    def get(self, label, client_random):
+        return self.secrets.get((label, client_random))
+
+    def secrets_for(self, label):
+        """
+        Every secret with the label, for any client random
+        """
+        return [secret for (secret_label, _), secret in self.secrets.items() if secret_label == label]
+
+
+class _RecordKey(object):
+    """
+    The key one side protects its records with, in one phase, and the sequence number
+    of its next record.
+    """
+
+    def __init__(self, suite, phase, key, iv, secret=None):
+        self.suite = suite
+        self.phase = phase
+        self.aead = suite.aead(key)
+        self.iv = iv
+        # The TLS1.3 traffic secret, which a KeyUpdate replaces
+        self.secret = secret
+        self.seq = 0
+
+    @classmethod
+    def from_tls13_secret(cls, suite, phase, secret):
+        key = hkdf_expand_label(suite.hash_name, secret,
+                                b"key", b"", suite.key_length)
+        iv = hkdf_expand_label(suite.hash_name, secret, b"iv", b"", 12)
+        return cls(suite, phase, key, iv, secret)
+
+    def updated(self):
+        """
+        Return the key which follows this one after a KeyUpdate
+        """
+        secret = hkdf_expand_label(self.suite.hash_name, self.secret, b"traffic upd", b"",
+                                   hashlib.new(self.suite.hash_name).digest_size)
+        return _RecordKey.from_tls13_secret(self.suite, self.phase, secret)
+
+    def _nonce(self):
+        nonce = bytearray(self.iv)
+        for i, byte in enumerate(struct.pack("!Q", self.seq)):
+            nonce[len(nonce) - 8 + i] ^= byte
+        return bytes(nonce)
+
+    def decrypt_tls13(self, record):
+        """
+        Return the content type and plaintext of a TLS1.3 record, or None if this key
+        didn't encrypt it, or it has no content type.
+        """
+        header = struct.pack("!BHH", record.content_type,
+                             record.version, record.length)
+        try:
+            plaintext = self.aead.decrypt(self._nonce(), record.payload, header)
+        except InvalidTag:
+            return None
+
+        self.seq += 1
+        plaintext = plaintext.rstrip(b"\x00")
+        if not plaintext:
+            # Only padding, which a peer must reject (RFC 8446, section 5.4)
+            return None
+        return plaintext[-1], plaintext[:-1]
+
+    def decrypt_tls12(self, record):
+        explicit_length = self.suite.explicit_nonce_length
+        if explicit_length:
+            nonce = self.iv + record.payload[:explicit_length]
+        else:
+            nonce = self._nonce()
+        ciphertext = record.payload[explicit_length:]
+        additional_data = struct.pack("!QBHH", self.seq, record.content_type, record.version,
+                                      len(ciphertext) - _AEAD_TAG_SIZE)
+        try:
+            plaintext = self.aead.decrypt(nonce, ciphertext, additional_data)
+        except InvalidTag:
+            return None
+
+        self.seq += 1
+        return record.content_type, plaintext
+
+
+class TraceRecord(object):
+    """
+    A record of a connection. size is its size on the wire, header included.
+    content_type is the type of its content, once decrypted, and messages are the names
+    of the handshake messages it completed. phase is None for encrypted records which
+    couldn't be decrypted.
+    """
+
+    def __init__(self, time, sender, content_type, size, phase, plaintext_length=None):
+        self.time = time
+        self.sender = sender
+        self.content_type = content_type
+        self.size = size
+        self.phase = phase
+        self.plaintext_length = plaintext_length
+        self.messages = []
+
+    @property
+    def decrypted(self):
+        return self.phase is not None
+
+
+class HandshakeMessage(object):
+    def __init__(self, time, sender, name, length):
+        self.time = time
+        self.sender = sender
+        self.name = name
+        self.length = length
+
+
+class Flight(object):
+    """
+    The handshake records one side sent before hearing from the other
+    """
+
+    def __init__(self, sender):
+        self.sender = sender
+        self.records = []
+
+    @property
+    def messages(self):
+        return [message for record in self.records for message in record.messages]
+
+    @property
+    def size(self):
+        return sum(record.size for record in self.records)
+
+    @property
+    def start(self):
+        return self.records[0].time
+
+    @property
+    def end(self):
+        return self.records[-1].time
+
+
+class _Side(object):
+    """
+    What the analyzer knows about one side of a connection
+    """
+
+    def __init__(self, sender):
+        self.sender = sender
+        # The keys this side may encrypt its next record with, in the order it uses them
+        self.keys = []
+        self.handshake_buffer = bytearray()
+        self.changed_cipher_spec = False
+        self.finished = False
+        # Records sent before the keys to decrypt them were known
+        self.waiting = []
+
+
+class ConnectionTrace(object):
+    """
+    The records of one connection, decrypted with the secrets from a key log, and what
+    they show about its handshake. Times are in seconds since the epoch.
+    """
+
+    def __init__(self, records, key_log):
+        self.key_log = key_log
+        self.records = []
+        self.messages = []
+        self.client_random = None
+        self.server_random = None
+        self.version = None
+        self.cipher_suite = None
+        self.hello_retry = False
+        self._suite = None
+        self._sides = {CLIENT: _Side(CLIENT), SERVER: _Side(SERVER)}
+
+        for record in records:
+            self._add(record)
+
+        # Records which arrived before a ServerHello which never came
+        for side in self._sides.values():
+            for record in side.waiting:
+                self._add_trace_record(record, None)
+        self.records.sort(key=lambda record: record.time)
+
+    def _add(self, record):
+        side = self._sides[record.sender]
+        # TLS1.3 only encrypts application data records, and TLS1.2 every record after
+        # ChangeCipherSpec
+        if not side.changed_cipher_spec and record.content_type != APPLICATION_DATA:
+            self._add_trace_record(
+                record, PLAINTEXT, record.content_type, record.payload)
+            if record.content_type == CHANGE_CIPHER_SPEC and self.version == TLS12:
+                side.changed_cipher_spec = True
+                side.keys = self._tls12_keys(side.sender)
+        elif side.keys:
+            self._decrypt(side, record)
+        elif self.version is None:
+            # Early data, which can be decrypted once the ServerHello gives the cipher suite
+            side.waiting.append(record)
+        else:
+            self._add_trace_record(record, None)
+
+    def _add_trace_record(self, record, phase, content_type=None, plaintext=None):
+        trace_record = TraceRecord(record.time, record.sender, content_type or record.content_type,
+                                   record.length + 5, phase, None if plaintext is None else len(plaintext))
+        self.records.append(trace_record)
+        if content_type == HANDSHAKE:
+            self._add_handshake_bytes(trace_record, plaintext)
+
+    def _decrypt(self, side, record):
+        decrypt = _RecordKey.decrypt_tls13 if self.version == TLS13 else _RecordKey.decrypt_tls12
+        for index, key in enumerate(side.keys):
+            decrypted = decrypt(key, record)
+            if decrypted is None and key.phase == APPLICATION_KEYS and index == len(side.keys) - 1 and key.secret:
+                # The sender may have updated its key
+                key = key.updated()
+                decrypted = decrypt(key, record)
+            if decrypted is None:
+                continue
+
+            # Later records can't use the keys before this one. The other TLS1.2 keys
+            # were made from the wrong master secret.
+            if self.version == TLS13:
+                side.keys = [key] + side.keys[index + 1:]
+            else:
+                side.keys = [key]
+            phase = key.phase
+            if self.version == TLS12 and not side.finished:
+                phase = HANDSHAKE_KEYS
+            content_type, plaintext = decrypted
+            self._add_trace_record(record, phase, content_type, plaintext)
+            return
+
+        # Without the secrets, or rejected early data which the client didn't log
+        self._add_trace_record(record, None)
+
+    def _add_handshake_bytes(self, trace_record, plaintext):
+        buffer = self._sides[trace_record.sender].handshake_buffer
+        buffer += plaintext
+        while len(buffer) >= 4:
+            message_type, length_high, length_low = struct.unpack_from(
+                "!BBH", buffer)
+            length = (length_high << 16) | length_low
+            if len(buffer) < 4 + length:
+                break
+            body = bytes(buffer[4:4 + length])
+            del buffer[:4 + length]
+            self._add_message(trace_record, message_type, body)
+
+    def _add_message(self, trace_record, message_type, body):
+        name = HANDSHAKE_TYPES.get(
+            message_type, "unknown_{}".format(message_type))
+        if message_type == 1 and self.client_random is None:
+            self.client_random = body[2:34]
+        elif message_type == 2:
+            if body[2:34] == HELLO_RETRY_REQUEST_RANDOM:
+                name = "hello_retry_request"
+                self.hello_retry = True
+            else:
+                self._server_hello(body)
+        elif message_type == 20:
+            self._sides[trace_record.sender].finished = True
+
+        trace_record.messages.append(name)
+        self.messages.append(HandshakeMessage(
+            trace_record.time, trace_record.sender, name, len(body)))
+
+    def _server_hello(self, body):
+        version, = struct.unpack_from("!H", body)
+        self.server_random = body[2:34]
+        offset = 35 + body[34]
+        self.cipher_suite, = struct.unpack_from("!H", body, offset)
+        # Skip the cipher suite and the compression method
+        offset += 3
+        if offset + 2 <= len(body):
+            extensions_length, = struct.unpack_from("!H", body, offset)
+            extensions_end = offset + 2 + extensions_length
+            offset += 2
+            while offset + 4 <= extensions_end:
+                extension_type, extension_length = struct.unpack_from(
+                    "!HH", body, offset)
+                if extension_type == _SUPPORTED_VERSIONS_EXTENSION:
+                    version, = struct.unpack_from("!H", body, offset + 4)
+                offset += 4 + extension_length
+        self.version = version
+        self._suite = CIPHER_SUITES.get(self.cipher_suite)
+
+        if self.version == TLS13:
+            self._sides[CLIENT].keys = self._tls13_keys([
+                (EARLY_DATA, CLIENT_EARLY_TRAFFIC_SECRET),
+                (HANDSHAKE_KEYS, CLIENT_HANDSHAKE_TRAFFIC_SECRET),
+                (APPLICATION_KEYS, CLIENT_TRAFFIC_SECRET_0),
+            ])
+            self._sides[SERVER].keys = self._tls13_keys([
+                (HANDSHAKE_KEYS, SERVER_HANDSHAKE_TRAFFIC_SECRET),
+                (APPLICATION_KEYS, SERVER_TRAFFIC_SECRET_0),
+            ])
+
+        client = self._sides[CLIENT]
+        waiting, client.waiting = client.waiting, []
+        for record in waiting:
+            self._add(record)
+
+    def _tls13_keys(self, phases):
+        if self._suite is None:
+            return []
+
+        keys = []
+        for phase, label in phases:
+            secret = self.key_log.get(label, self.client_random)
+            if secret is not None:
+                keys.append(_RecordKey.from_tls13_secret(
+                    self._suite, phase, secret))
+        return keys
+
+    def _tls12_keys(self, sender):
+        suite = self._suite
+        if suite is None:
+            return []
+
+        # s2n only logs the master secret of full handshakes, so a resumed session uses
+        # the secret of an earlier connection. Every one is tried, and the first record
+        # shows which.
+        master_secrets = self.key_log.secrets_for(CLIENT_RANDOM)
+        exact = self.key_log.get(CLIENT_RANDOM, self.client_random)
+        if exact is not None:
+            master_secrets = [exact]
+
+        keys = []
+        for master_secret in master_secrets:
+            # The key block has no MAC keys for AEAD cipher suites
+            key_block = tls12_prf(suite.hash_name, master_secret, b"key expansion",
+                                  self.server_random + self.client_random,
+                                  2 * (suite.key_length + suite.tls12_iv_length))
+            write_keys = [key_block[:suite.key_length],
+                          key_block[suite.key_length:2 * suite.key_length]]
+            ivs = key_block[2 * suite.key_length:]
+            ivs = [ivs[:suite.tls12_iv_length], ivs[suite.tls12_iv_length:]]
+            index = 0 if sender == CLIENT else 1
+            keys.append(_RecordKey(
+                suite, APPLICATION_KEYS, write_keys[index], ivs[index]))
+        return keys
+
+    @property
+    def decrypted(self):
+        """
+        Whether every record could be decrypted
+        """
+        return all(record.decrypted for record in self.records)
+
+    @property
+    def start(self):
+        return self.records[0].time if self.records else None
+
+    def message_names(self, sender=None):
+        return [message.name for message in self.messages if sender in (None, message.sender)]
+
+    @property
+    def resumed(self):
+        """
+        Whether the handshake skipped the server's certificate, by resuming a session
+        """
+        return "finished" in self.message_names(SERVER) and "certificate" not in self.message_names(SERVER)
+
+    @property
+    def early_data_accepted(self):
+        return "end_of_early_data" in self.message_names(CLIENT)
+
+    @property
+    def early_data(self):
+        """
+        How many bytes of application data the client sent as early data
+        """
+        return sum(record.plaintext_length for record in self.records
+                   if record.phase == EARLY_DATA and record.content_type == APPLICATION_DATA)
+
+    @property
+    def flights(self):
+        """
+        The flights of the handshake: the records each side sent, up to the end of the
+        handshake, before the other side replied
+        """
+        flights = []
+        for record in self.records:
+            if record.phase == APPLICATION_KEYS:
+                continue
+            if record.phase == EARLY_DATA and not self.early_data_accepted:
+                continue
+            if not flights or flights[-1].sender != record.sender:
+                flights.append(Flight(record.sender))
+            flights[-1].records.append(record)
+        return flights
+
+    @property
+    def round_trips(self):
+        """
+        How many round trips the client waited for before it sent application data,
+        or finished the handshake if it sent none. Each flight the client sent in
+        answer to the server took one: a second ClientHello after a HelloRetryRequest,
+        and its Finished. So did waiting for the server's Finished after sending its
+        own, as in a full TLS1.2 handshake. None if the handshake couldn't be followed.
+
+        Only the order of the client's own records is relied on. On a busy machine the
+        capture can show the server's first flight before early data the client sent
+        without reading it.
+        """
+        trips = 0
+        hellos = 0
+        client_finished = server_finished = False
+        for record in self.records:
+            if record.sender == CLIENT:
+                if record.content_type == APPLICATION_DATA and (
+                        record.phase == APPLICATION_KEYS or
+                        record.phase == EARLY_DATA and self.early_data_accepted):
+                    return trips
+                for name in record.messages:
+                    if name == "client_hello":
+                        hellos += 1
+                        if hellos > 1:
+                            trips += 1
+                    elif name == "finished":
+                        trips += 1
+                        client_finished = True
+            elif "finished" in record.messages:
+                server_finished = True
+                if client_finished:
+                    # The server waited for the client's Finished, and the client for this
+                    trips += 1
+
+            if client_finished and server_finished:
+                return trips
+        return None
+
+    def bytes_per_phase(self, sender=None):
+        """
+        The bytes of records on the wire, headers included, in each phase. Records which
+        couldn't be decrypted are counted under None.
+        """
+        sizes = {}
+        for record in self.records:
+            if sender in (None, record.sender):
+                sizes[record.phase] = sizes.get(record.phase, 0) + record.size
+        return sizes
+
+    def timeline(self, sender=None):
+        """
+        The size of each record, with when it was sent in seconds since the first record
+        """
+        return [(record.time - self.start, record.size) for record in self.records
+                if sender in (None, record.sender)]
+
+    def format_summary(self):
+        """
+        Return a line for each flight of the handshake, and the bytes in each phase
+        """
+        cipher_suite = None
+        if self.cipher_suite:
+            cipher_suite = "{:#06x}".format(self.cipher_suite)
+        lines = ["version {:#06x}, cipher suite {}, round trips {}, bytes per phase {}".format(
+            self.version or 0, cipher_suite, self.round_trips, self.bytes_per_phase())]
+        for flight in self.flights:
+            lines.append("  {:>6.1f}ms {} {} bytes: {}".format(
+                (flight.start - self.start) * 1000, flight.sender, flight.size, ", ".join(flight.messages)))
+        return "\n".join(lines)
+
+
+def analyze(packet_trace, key_log):
+    """
+    Return a ConnectionTrace for each connection in a PacketTrace, in the order they
+    were made. The trace must have kept the payloads of its records.
+    """
+    return [ConnectionTrace(records, key_log) for records in packet_trace.connections]
+
+
+class RecordTraceCapture(object):
+    """
+    A packet capture, and the key log the peers write their secrets to. Pass
+    ["--key-log", capture.key_log] to s2nc or s2nd, then stop the capture once they
+    have finished.
+    """
+
+    def __init__(self, packet_capture, key_log):
+        self.packet_capture = packet_capture
+        self.key_log = key_log
+
+    def stop(self):
+        """
+        Stop capturing, and return a ConnectionTrace for each connection
+        """
+        trace = self.packet_capture.stop()
+        paths = [self.key_log] if os.path.exists(self.key_log) else []
+        return analyze(trace, KeyLog(paths))
@@ -0,0 +1,220 @@
+import functools
+import glob
+import hashlib
+import json
+import os
+import re
+import shutil
+import sqlite3
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+
+from global_flags import get_flag, S2N_FIPS_MODE, S2N_NO_PQ, S2N_PROVIDER_VERSION
+
+
+HARNESS_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+REPOSITORY_ROOT = os.path.abspath(os.path.join(HARNESS_DIRECTORY, "..", ".."))
+
+# Shared libraries listed by ldd, e.g. "libs2n.so => /path/to/libs2n.so (0x...)"
+_LDD_PATH = re.compile(r"(/\S+) \(0x")
+
+
+@functools.lru_cache(maxsize=None)
+def _file_digest(path, mtime, size):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def file_digest(path):
+    """
+    The SHA-256 of a file's contents. Digests are remembered until the file's size
+    or modification time changes, so each binary is only read once per session.
+    """
+    st = os.stat(path)
+    return _file_digest(os.path.realpath(path), st.st_mtime_ns, st.st_size)
+
+
+@functools.lru_cache(maxsize=None)
+def _shared_libraries(executable):
+    try:
+        output = subprocess.check_output(
+            ["ldd", executable], stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return ()
+    return tuple(sorted(set(_LDD_PATH.findall(output.decode("utf-8", "replace")))))
+
+
+def _is_input_file(path):
+    """
+    Arguments which are files in the repository, like certificates and keys, are
+    inputs to the test. Temporary files are written by the test, and are gone once
+    it's finished.
+    """
+    if not os.path.isfile(path):
+        return False
+    path = os.path.realpath(path)
+    return path.startswith(REPOSITORY_ROOT + os.sep) and \
+        not path.startswith(os.path.realpath(tempfile.gettempdir()) + os.sep)
+
+
+def command_digests(cmd_line, env_overrides=None):
+    """
+    Everything a command's behaviour depends on, besides the data it's sent: the
+    command line, the executable and the shared libraries it loads, and any files
+    from the repository it reads.
+    """
+    digests = {"cmd_line": [str(arg) for arg in cmd_line],
+               "env": env_overrides or {}, "files": {}}
+
+    path = (env_overrides or {}).get("PATH")
+    executable = shutil.which(str(cmd_line[0]), path=path) if cmd_line else None
+    if executable is not None:
+        digests["files"][executable] = file_digest(executable)
+        for library in _shared_libraries(executable):
+            if os.path.isfile(library):
+                digests["files"][library] = file_digest(library)
+
+    for arg in cmd_line[1:]:
+        # Options are often given as --name=value
+        for value in str(arg).split("=", 1)[-1:]:
+            if _is_input_file(value):
+                digests["files"][value] = file_digest(value)
+
+    return digests
+
+
+@functools.lru_cache(maxsize=None)
+def harness_digest():
+    """
+    A digest of the test harness (every module which isn't a test) and of the
+    environment the tests run in. A change to either invalidates every result.
+    """
+    digest = hashlib.sha256()
+    for path in sorted(glob.glob(os.path.join(HARNESS_DIRECTORY, "*.py"))):
+        if not os.path.basename(path).startswith("test_"):
+            digest.update(path.encode("utf-8"))
+            digest.update(file_digest(path).encode("ascii"))
+
+    environment = [sys.version, ssl.OPENSSL_VERSION, os.environ.get("PATH", ""),
+                   os.environ.get("LD_LIBRARY_PATH", ""), os.environ.get("DYLD_LIBRARY_PATH", "")]
+    digest.update(json.dumps(environment).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _fingerprint(module_path, commands):
+    flags = [get_flag(S2N_PROVIDER_VERSION), get_flag(S2N_FIPS_MODE),
+             get_flag(S2N_NO_PQ)]
+    content = {
+        "harness": harness_digest(),
+        "flags": flags,
+        "module": file_digest(module_path),
+        "commands": [command_digests(cmd_line, env) for cmd_line, env in commands],
+    }
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class ResultCache(object):
+    """
+    A SQLite database of tests which passed, and a fingerprint of everything their
+    result depends on: the test module, the harness, and the executables, shared
+    libraries and repository files used by each command the test ran.
+
+    Before a test runs, its fingerprint is computed again from the commands it ran
+    last time. If nothing changed, it would run the same commands with the same
+    inputs, so it passes without running them.
+
+    Each xdist worker writes the results of its own tests at the end of the session.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._results = None
+        self._pending = {}
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "nodeid TEXT PRIMARY KEY, fingerprint TEXT NOT NULL, commands TEXT NOT NULL, updated REAL NOT NULL)")
+        return connection
+
+    @property
+    def results(self):
+        if self._results is None:
+            self._results = {}
+            if os.path.exists(self.path):
+                connection = self._connect()
+                try:
+                    for nodeid, fingerprint, commands in connection.execute(
+                            "SELECT nodeid, fingerprint, commands FROM results"):
+                        self._results[nodeid] = (
+                            fingerprint, json.loads(commands))
+                finally:
+                    connection.close()
+        return self._results
+
+    def passed_before(self, nodeid, module_path):
+        """
+        Whether the test passed in an earlier run, and nothing it depends on has
+        changed since.
+        """
+        cached = self.results.get(nodeid)
+        if cached is None:
+            return False
+
+        fingerprint, commands = cached
+        try:
+            return _fingerprint(module_path, commands) == fingerprint
+        except OSError:
+            # An executable or input file is gone
+            return False
+
+    def record(self, nodeid, module_path, commands, passed):
+        """
+        Record the result of a test which ran the commands, a list of
+        (cmd_line, env_overrides). Only passing tests are cached.
+        """
+        if passed and commands:
+            try:
+                fingerprint = _fingerprint(module_path, commands)
+                self._pending[nodeid] = (fingerprint, commands)
+            except OSError:
+                self._pending[nodeid] = None
+        else:
+            self._pending[nodeid] = None
+
+    def flush(self):
+        if not self._pending:
+            return
+
+        now = time.time()
+        connection = self._connect()
+        try:
+            with connection:
+                for nodeid, result in self._pending.items():
+                    if result is None:
+                        connection.execute(
+                            "DELETE FROM results WHERE nodeid = ?", (nodeid,))
+                    else:
+                        fingerprint, commands = result
+                        connection.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                                           (nodeid, fingerprint, json.dumps(commands), now))
+        finally:
+            connection.close()
+        self._pending = {}
+
+
+def record_command(node, cmd_line, env_overrides=None):
+    """
+    Note that the test running as node ran a command, so its result can be cached.
+    """
+    if not hasattr(node, "result_cache_commands"):
+        node.result_cache_commands = []
+    node.result_cache_commands.append(
+        ([str(arg) for arg in cmd_line], dict(env_overrides or {})))
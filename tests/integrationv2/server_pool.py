@@ -0,0 +1,224 @@
+import collections
+import copy
+import threading
+
+from common import Results, TimeoutException
+from configuration import available_ports
+from processes import ManagedProcess, terminate_all
+from providers import Provider
+
+
+# Connections a pooled server accepts before it exits. The pool retires a
+# server before it reaches this limit.
+POOL_MAX_CONNECTIONS = 1000
+
+# Number of idle servers kept by the pool. The least recently used server is
+# stopped when another one is needed.
+POOL_SIZE = 16
+
+
+class PooledServerLease(object):
+    """
+    A single connection to a pooled server, handed to one test.
+
+    The output of a pooled server covers every connection it has handled. A lease
+    remembers where the server's output was when the test started, and where the
+    connection's closed marker was printed, so get_results() only includes the
+    output from this test's connection.
+    """
+
+    def __init__(self, pool, server, timeout):
+        self.pool = pool
+        self.server = server
+        self.port = server.port
+        self.timeout = timeout
+        self._start = server.process.output_lengths()
+        self._closed = server.process.watch_for(
+            server.connection_closed_marker, start=self._start['stdout'])
+        self._results = None
+
+    def _collect(self):
+        process = self.server.process
+        exception = None
+
+        try:
+            end = self._closed.result(timeout=self.timeout)
+        except Exception as ex:
+            # The server exited or never finished the connection, so it can't
+            # be reused. Whatever output it printed is still returned.
+            self.server.broken = True
+            process.kill()
+            process.join()
+            end = {stream: None for stream in self._start}
+            if process.results is not None and process.results.exception is not None:
+                exception = process.results.exception
+            elif not isinstance(ex, EOFError):
+                exception = TimeoutException(ex)
+
+        exit_code = 0
+        if self.server.broken:
+            exit_code = process.proc.returncode if process.proc else None
+
+        return Results(
+            process.get_output('stdout', self._start['stdout'], end['stdout']),
+            process.get_output('stderr', self._start['stderr'], end['stderr']),
+            exit_code,
+            exception,
+            expect_stderr=process.expect_stderr)
+
+    def get_results(self):
+        """
+        Block until the connection is closed, and yield the Results of this
+        connection only.
+        """
+        if self._results is None:
+            self._results = self._collect()
+
+        yield self._results
+
+    def get_cmd_line(self):
+        return self.server.process.get_cmd_line()
+
+    def kill(self):
+        self.server.broken = True
+        self.server.process.kill()
+
+    def release(self):
+        """
+        Wait for the connection to finish, then return the server to the pool.
+        """
+        if self._results is None:
+            self._results = self._collect()
+        self.pool._release(self.server)
+
+
+class _PooledServer(object):
+    def __init__(self, key, provider, process, port):
+        self.key = key
+        self.process = process
+        self.port = port
+        self.connection_closed_marker = provider.connection_closed_marker
+        self.connections = 0
+        self.leased = False
+        self.broken = False
+
+    def usable(self):
+        return not self.broken and self.process.results is None and \
+            self.connections < POOL_MAX_CONNECTIONS - 1
+
+    def stop(self):
+        self.process.kill()
+        self.process.join()
+
+
+class ServerPool(object):
+    """
+    Keeps long-lived servers running so tests don't pay for process startup and
+    certificate loading on every parametrization.
+
+    Servers are keyed by their provider class, command line (without the port),
+    and environment. Each server is started with a large connection limit, and
+    handles the connections of many tests, one at a time.
+    """
+
+    def __init__(self, size=POOL_SIZE):
+        self.size = size
+        self._servers = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _pool_options(options):
+        options = copy.copy(options)
+        options.reconnects_before_exit = POOL_MAX_CONNECTIONS
+        options.mark_closed_connections = True
+        return options
+
+    @classmethod
+    def supports(cls, provider_class, options):
+        """
+        A server can only be pooled if it marks the end of each connection, and
+        the test doesn't need to write to its stdin.
+        """
+        if options.mode != Provider.ServerMode or options.data_to_send is not None:
+            return False
+
+        # In-process servers don't cost a process launch, so there is nothing to save
+        if provider_class.in_process:
+            return False
+
+        provider = provider_class(cls._pool_options(options))
+        return provider.connection_closed_marker is not None
+
+    def _key(self, provider_class, options):
+        options = self._pool_options(options)
+        options.port = None
+        provider = provider_class(options)
+        env = tuple(sorted(options.env_overrides.items()))
+        return (provider_class, tuple(map(str, provider.get_cmd_line())), env)
+
+    def _launch(self, key, provider_class, options, timeout):
+        options = self._pool_options(options)
+        options.port = str(next(available_ports))
+        provider = provider_class(options)
+
+        process = ManagedProcess(
+            provider.get_cmd_line(),
+            provider.set_provider_ready,
+            wait_for_marker=provider.ready_to_test_marker,
+            timeout=None,
+            env_overrides=options.env_overrides,
+            expect_stderr=provider.expect_stderr,
+        )
+        process.start()
+
+        if not process.wait_ready(timeout):
+            process.kill()
+            process.join()
+            raise TimeoutException(Exception("Pooled server was not ready: {}".format(
+                " ".join(process.get_cmd_line()))))
+
+        return _PooledServer(key, provider, process, options.port)
+
+    def lease(self, provider_class, options, timeout=5):
+        """
+        Return a PooledServerLease for a server matching options, starting a new
+        server if there isn't an idle one.
+        """
+        key = self._key(provider_class, options)
+
+        with self._lock:
+            server = self._servers.get(key)
+            if server is not None and not server.leased and not server.usable():
+                server.stop()
+                server = None
+
+            # If the matching server is already in use, a second one replaces it
+            # in the pool. The first is stopped when its lease is released.
+            if server is None or server.leased:
+                server = self._launch(key, provider_class, options, timeout)
+                self._servers[key] = server
+
+            self._servers.move_to_end(key)
+            server.leased = True
+            server.connections += 1
+            self._evict()
+
+        return PooledServerLease(self, server, timeout)
+
+    def _release(self, server):
+        with self._lock:
+            server.leased = False
+            if self._servers.get(server.key) is not server or not server.usable():
+                if self._servers.get(server.key) is server:
+                    del self._servers[server.key]
+                server.stop()
+
+    def _evict(self):
+        idle = [key for key, server in self._servers.items() if not server.leased]
+        while len(self._servers) > self.size and idle:
+            self._servers.pop(idle.pop(0)).stop()
+
+    def shutdown(self):
+        with self._lock:
+            terminate_all([server.process for server in self._servers.values()])
+            self._servers.clear()
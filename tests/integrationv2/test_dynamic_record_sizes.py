@@ -1,41 +1,23 @@
 import copy
-import os
 import pytest
-import subprocess
-import time
 
 from configuration import available_ports, ALL_TEST_CIPHERS, ALL_TEST_CURVES, ALL_TEST_CERTS, PROVIDERS, PROTOCOLS
 from common import ProviderOptions, data_bytes, Protocols
-from fixtures import managed_process, custom_mtu
-from providers import Provider, S2N, OpenSSL, Tcpdump
+from fixtures import managed_process, custom_mtu, packet_capture
+from packet_capture import CLIENT, APPLICATION_DATA
+from providers import Provider, S2N, OpenSSL
 from utils import invalid_test_parameters, get_parameter_name, get_expected_s2n_version, to_bytes
 
 
-def find_fragmented_packet(results):
-    """
-    This function searches Tcpdump's standard output and looks for packets
-    that have a length larger than the MTU(hardcoded to 1500) of the device.
+# The MTU custom_mtu gives the loopback
+MTU = 1500
 
-    When traffic goes over a known port, such as 8080, the protocol is appended
-    to the output line. This happens even when using `-nn` on the command line.
-    That is why we need two ways to detect the length of the packet.
-    """
-    for line in results.decode('utf-8').split('\n'):
-        pieces = line.split(' ')
-        if len(pieces) < 3:
-            continue
+# The largest record s2n sends below the dynamic record threshold, header included,
+# so it fits in one TCP segment (S2N_SMALL_RECORD_LENGTH)
+SMALL_RECORD_SIZE = MTU - 20 - 20 - 20
 
-        packet_len = 0
-        if pieces[-2] == 'length':
-            packet_len = int(pieces[-1])
-        elif pieces[-3] == 'length':
-            # In this case the length has a colon `1234:`, so we must trim it.
-            packet_len = int(pieces[-2][:-1])
-
-        if packet_len > 1500:
-            return True
-
-    return False
+# How many bytes s2nc sends in small records, before it sends full records
+DYNAMIC_THRESHOLD = 4096
 
 
 @pytest.mark.uncollect_if(func=invalid_test_parameters)
@@ -45,11 +27,11 @@ def find_fragmented_packet(results):
 @pytest.mark.parametrize("other_provider", [S2N], ids=get_parameter_name)
 @pytest.mark.parametrize("protocol", PROTOCOLS, ids=get_parameter_name)
 @pytest.mark.parametrize("certificate", ALL_TEST_CERTS, ids=get_parameter_name)
-def test_s2n_client_dynamic_record(custom_mtu, managed_process, cipher, curve, provider, other_provider, protocol,
-                                   certificate):
+def test_s2n_client_dynamic_record(custom_mtu, managed_process, packet_capture, cipher, curve, provider,
+                                   other_provider, protocol, certificate):
     port = next(available_ports)
 
-    # 16384 bytes is enough to reliably get a packet that will exceed the MTU
+    # 16384 bytes is enough to reliably get records that will exceed the MTU
     bytes_to_send = data_bytes(16384)
     client_options = ProviderOptions(
         mode=Provider.ClientMode,
@@ -57,19 +39,20 @@ def test_s2n_client_dynamic_record(custom_mtu, managed_process, cipher, curve, p
         cipher=cipher,
         data_to_send=bytes_to_send,
         insecure=True,
-        protocol=protocol)
+        protocol=protocol,
+        extra_flags=["--dynamic", str(DYNAMIC_THRESHOLD), "--timeout", "1"])
 
     server_options = copy.copy(client_options)
     server_options.data_to_send = None
     server_options.mode = Provider.ServerMode
     server_options.key = certificate.key
     server_options.cert = certificate.cert
+    server_options.extra_flags = None
 
     expected_version = get_expected_s2n_version(protocol, provider)
 
-    # This test shouldn't last longer than 5 seconds, even though
-    # Tcpdump tends to take a second to startup.
-    tcpdump = managed_process(Tcpdump, client_options, timeout=5)
+    # Capture the whole connection, from before the client connects
+    capture = packet_capture(port)
     server = managed_process(provider, server_options, timeout=5)
     client = managed_process(S2N, client_options, timeout=5)
 
@@ -81,11 +64,19 @@ def test_s2n_client_dynamic_record(custom_mtu, managed_process, cipher, curve, p
     for results in server.get_results():
         results.assert_success()
 
-    # The Tcpdump provider only captures 12 packets. This is enough
-    # to detect a packet larger than the MTU, but less than the
-    # total packets sent. This is important because it lets Tcpdump
-    # exit cleanly, which means all the output is available for us
-    # to examine.
-    for results in tcpdump.get_results():
-        assert results.exit_code == 0
-        assert find_fragmented_packet(results.stdout) is True
+    trace = capture.stop()
+    assert trace.complete, trace.format_summary()
+
+    # Encrypted records all look like application data, so in TLS1.3 these include
+    # the client's Finished. It's small, so every record sent before the client
+    # has sent DYNAMIC_THRESHOLD bytes must fit in one segment.
+    record_sizes = trace.record_sizes(CLIENT, APPLICATION_DATA)
+    sent = 0
+    for size in record_sizes:
+        if sent >= DYNAMIC_THRESHOLD:
+            break
+        assert size <= SMALL_RECORD_SIZE, trace.format_summary()
+        sent += size
+
+    # After the threshold the records are larger than the MTU
+    assert max(record_sizes) > MTU, trace.format_summary()
@@ -6,8 +6,8 @@ from enum import Enum
 from collections import namedtuple
 
 from configuration import available_ports, ALL_TEST_CIPHERS, ALL_TEST_CURVES, ALL_TEST_CERTS, PROTOCOLS, TLS13_CIPHERS
-from common import ProviderOptions, Protocols, Curves, data_bytes
-from fixtures import managed_process
+from common import BatchConnection, Certificates, ProviderOptions, Protocols, Curves, data_bytes
+from fixtures import managed_process, packet_capture, record_trace
 from providers import Provider, S2N as S2NBase, OpenSSL as OpenSSLBase
 from utils import invalid_test_parameters, get_parameter_name, to_bytes
 
@@ -19,9 +19,14 @@ EARLY_DATA_FILE = 'early_data'
 MAX_EARLY_DATA = 500  # Arbitrary largish number
 DATA_TO_SEND = data_bytes(500)  # Arbitrary large number
 
-NUM_RESUMES = 5  # Hardcoded for s2nc --reconnect
+NUM_RESUMES = 5
 NUM_CONNECTIONS = NUM_RESUMES + 1  # resumes + initial
 
+# The S2N client makes the initial connection, then resumes each connection's session in the next one
+S2N_CLIENT_BATCH = [BatchConnection(id="initial")] + \
+    [BatchConnection(id="resume-{}".format(i), resume=True)
+     for i in range(NUM_RESUMES)]
+
 S2N_DEFAULT_CURVE = Curves.X25519
 # We have no plans to support this curve any time soon
 S2N_UNSUPPORTED_CURVE = 'X448'
@@ -210,7 +215,7 @@ def test_s2n_server_with_early_data(managed_process, tmp_path, cipher, curve, ce
 """
 Basic S2N client happy case.
 
-The S2N client tests session resumption by repeatedly reconnecting.
+The S2N client tests session resumption by making every connection from one batch-mode process.
 That means we don't need to manually perform the initial full connection, and there is no external ticket file.
 """
 
@@ -233,7 +238,7 @@ def test_s2n_client_with_early_data(managed_process, tmp_path, cipher, certifica
         protocol=protocol,
         insecure=True,
         use_session_ticket=True,
-        reconnect=True,
+        batch=S2N_CLIENT_BATCH,
     )
     options.ticket_file = None
     options.early_data_file = early_data_file
@@ -254,14 +259,88 @@ def test_s2n_client_with_early_data(managed_process, tmp_path, cipher, certifica
     for results in s2n_client.get_results():
         results.assert_success()
         assert S2N_EARLY_DATA_MARKER in results.stdout
-        assert results.stdout.count(
-            to_bytes(S2N_EARLY_DATA_ACCEPTED_MARKER)) == NUM_RESUMES
+
+        connections = results.split_batch()
+        assert len(connections) == NUM_CONNECTIONS
+        assert connections[0].batch_result["early_data"] == "NOT REQUESTED"
+        for connection in connections[1:]:
+            assert connection.batch_result["resumed"]
+            assert connection.batch_result["early_data"] == "ACCEPTED"
 
     for results in server.get_results():
         results.assert_success()
         assert results.stdout.count(early_data) == NUM_RESUMES
 
 
+"""
+Measure the round trips early data saves.
+
+The initial connection waits one round trip before the client sends application data.
+Each resumed connection sends its early data before answering the server, so the client
+doesn't wait at all.
+"""
+
+
+@pytest.mark.uncollect_if(func=invalid_test_parameters)
+@pytest.mark.parametrize("cipher", TLS13_CIPHERS, ids=get_parameter_name)
+@pytest.mark.parametrize("protocol", [Protocols.TLS13], ids=get_parameter_name)
+@pytest.mark.parametrize("provider", SERVER_PROVIDERS, ids=get_parameter_name)
+@pytest.mark.parametrize("other_provider", [S2N], ids=get_parameter_name)
+def test_s2n_client_early_data_round_trips(managed_process, record_trace, tmp_path, cipher, protocol, provider,
+                                           other_provider):
+    early_data_file = str(tmp_path / EARLY_DATA_FILE)
+    early_data = get_early_data_bytes(early_data_file, MAX_EARLY_DATA)
+
+    port = next(available_ports)
+    capture = record_trace(port)
+
+    options = ProviderOptions(
+        port=port,
+        cipher=cipher,
+        protocol=protocol,
+        insecure=True,
+        use_session_ticket=True,
+        batch=S2N_CLIENT_BATCH,
+    )
+    options.ticket_file = None
+    options.early_data_file = early_data_file
+    options.max_early_data = MAX_EARLY_DATA
+
+    client_options = copy.copy(options)
+    client_options.mode = Provider.ClientMode
+    client_options.extra_flags = ["--key-log", capture.key_log]
+
+    server_options = copy.copy(options)
+    server_options.mode = Provider.ServerMode
+    server_options.key = Certificates.RSA_2048_SHA256.key
+    server_options.cert = Certificates.RSA_2048_SHA256.cert
+    server_options.reconnects_before_exit = NUM_CONNECTIONS
+
+    server = managed_process(provider, server_options, timeout=10)
+    s2n_client = managed_process(S2N, client_options, timeout=10)
+
+    for results in s2n_client.get_results():
+        results.assert_success()
+
+    for results in server.get_results():
+        results.assert_success()
+
+    connections = capture.stop()
+    assert len(connections) == NUM_CONNECTIONS
+
+    initial = connections[0]
+    assert initial.decrypted, initial.format_summary()
+    assert initial.round_trips == 1, initial.format_summary()
+
+    for connection in connections[1:]:
+        assert connection.decrypted, connection.format_summary()
+        assert connection.early_data_accepted
+        assert connection.early_data == len(early_data)
+        # The client's early data goes before its Finished, so it doesn't wait for the
+        # round trip the initial connection did
+        assert initial.round_trips - connection.round_trips == 1, connection.format_summary()
+
+
 """
 Verify that the S2N client doesn't request early data when a server doesn't support early data.
 
@@ -287,7 +366,7 @@ def test_s2n_client_without_early_data(managed_process, tmp_path, cipher, certif
         protocol=protocol,
         insecure=True,
         use_session_ticket=True,
-        reconnect=True,
+        batch=S2N_CLIENT_BATCH,
     )
     options.ticket_file = None
     options.early_data_file = early_data_file
@@ -312,8 +391,11 @@ def test_s2n_client_without_early_data(managed_process, tmp_path, cipher, certif
     for results in s2n_client.get_results():
         results.assert_success()
         assert S2N_EARLY_DATA_MARKER not in results.stdout
-        assert results.stdout.count(
-            to_bytes(S2N_EARLY_DATA_NOT_REQUESTED_MARKER)) == NUM_CONNECTIONS
+
+        connections = results.split_batch()
+        assert len(connections) == NUM_CONNECTIONS
+        for connection in connections:
+            assert connection.batch_result["early_data"] == "NOT REQUESTED"
 
 
 """
@@ -409,7 +491,7 @@ def test_s2n_client_with_early_data_rejected_via_hrr(managed_process, tmp_path,
         protocol=protocol,
         insecure=True,
         use_session_ticket=True,
-        reconnect=True,
+        batch=S2N_CLIENT_BATCH,
     )
     options.ticket_file = None
     options.early_data_file = early_data_file
@@ -431,8 +513,11 @@ def test_s2n_client_with_early_data_rejected_via_hrr(managed_process, tmp_path,
         results.assert_success()
         assert S2N_EARLY_DATA_MARKER not in results.stdout
         assert S2N_HRR_MARKER in results.stdout
-        assert results.stdout.count(
-            to_bytes(S2N_EARLY_DATA_REJECTED_MARKER)) == NUM_RESUMES
+
+        connections = results.split_batch()
+        assert len(connections) == NUM_CONNECTIONS
+        for connection in connections[1:]:
+            assert connection.batch_result["early_data"] == "REJECTED"
 
     for results in server.get_results():
         results.assert_success()
@@ -3,21 +3,20 @@ import pytest
 
 from configuration import available_ports, ALL_TEST_CIPHERS, ALL_TEST_CURVES, ALL_TEST_CERTS, PROVIDERS, PROTOCOLS
 from common import ProviderOptions, Protocols, data_bytes
-from fixtures import managed_process
-from providers import Provider, S2N, OpenSSL, JavaSSL, GnuTLS
+from fixtures import managed_process, pooled_server, server_pool
+from providers import Provider, S2N, OpenSSL, JavaSSL, GnuTLS, PythonSSL
 from utils import invalid_test_parameters, get_parameter_name, get_expected_s2n_version, to_bytes
 
 
 @pytest.mark.uncollect_if(func=invalid_test_parameters)
 @pytest.mark.parametrize("cipher", ALL_TEST_CIPHERS, ids=get_parameter_name)
-@pytest.mark.parametrize("provider", [S2N, OpenSSL, GnuTLS, JavaSSL])
+@pytest.mark.parametrize("provider", [S2N, OpenSSL, GnuTLS, JavaSSL, PythonSSL])
 @pytest.mark.parametrize("other_provider", [S2N], ids=get_parameter_name)
 @pytest.mark.parametrize("curve", ALL_TEST_CURVES, ids=get_parameter_name)
 @pytest.mark.parametrize("protocol", PROTOCOLS, ids=get_parameter_name)
 @pytest.mark.parametrize("certificate", ALL_TEST_CERTS, ids=get_parameter_name)
-def test_s2n_server_happy_path(managed_process, cipher, provider, other_provider, curve, protocol, certificate):
-    port = next(available_ports)
-
+def test_s2n_server_happy_path(managed_process, pooled_server, cipher, provider, other_provider, curve, protocol,
+                               certificate):
     # s2nd can receive large amounts of data because all the data is
     # echo'd to stdout unmodified. This lets us compare received to
     # expected easily.
@@ -26,7 +25,6 @@ def test_s2n_server_happy_path(managed_process, cipher, provider, other_provider
     random_bytes = data_bytes(65519)
     client_options = ProviderOptions(
         mode=Provider.ClientMode,
-        port=port,
         cipher=cipher,
         cert=certificate.cert,
         curve=curve,
@@ -43,7 +41,10 @@ def test_s2n_server_happy_path(managed_process, cipher, provider, other_provider
 
     # Passing the type of client and server as a parameter will
     # allow us to use a fixture to enumerate all possibilities.
-    server = managed_process(S2N, server_options, timeout=5)
+    # The server is reused across tests with the same configuration, so
+    # the client must connect to whichever port the fixture chose.
+    server = pooled_server(S2N, server_options, timeout=5)
+    client_options.port = server_options.port
     client = managed_process(provider, client_options, timeout=5)
 
     # The client will be one of all supported providers. We
@@ -69,7 +70,7 @@ def test_s2n_server_happy_path(managed_process, cipher, provider, other_provider
 
 @pytest.mark.uncollect_if(func=invalid_test_parameters)
 @pytest.mark.parametrize("cipher", ALL_TEST_CIPHERS, ids=get_parameter_name)
-@pytest.mark.parametrize("provider", [S2N, OpenSSL, GnuTLS])
+@pytest.mark.parametrize("provider", [S2N, OpenSSL, GnuTLS, PythonSSL])
 @pytest.mark.parametrize("other_provider", [S2N], ids=get_parameter_name)
 @pytest.mark.parametrize("curve", ALL_TEST_CURVES, ids=get_parameter_name)
 @pytest.mark.parametrize("protocol", PROTOCOLS, ids=get_parameter_name)
@@ -5,8 +5,8 @@ import re
 import time
 
 from configuration import available_ports, TLS13_CIPHERS, ALL_TEST_CURVES, ALL_TEST_CERTS
-from common import ProviderOptions, Protocols, data_bytes, Curves
-from fixtures import managed_process
+from common import ProviderOptions, Protocols, data_bytes, Curves, Certificates
+from fixtures import managed_process, packet_capture, record_trace
 from providers import Provider, S2N, OpenSSL
 from utils import invalid_test_parameters, get_parameter_name, to_bytes
 
@@ -86,6 +86,57 @@ def test_hrr_with_s2n_as_client(managed_process, cipher, provider, other_provide
         assert random_bytes in results.stdout
 
 
+@pytest.mark.uncollect_if(func=invalid_test_parameters)
+@pytest.mark.parametrize("cipher", TLS13_CIPHERS, ids=get_parameter_name)
+@pytest.mark.parametrize("provider", [OpenSSL])
+@pytest.mark.parametrize("other_provider", [S2N], ids=get_parameter_name)
+@pytest.mark.parametrize("curve", ALL_TEST_CURVES, ids=get_parameter_name)
+@pytest.mark.parametrize("protocol", [Protocols.TLS13], ids=get_parameter_name)
+def test_hrr_round_trips(managed_process, record_trace, cipher, provider, other_provider, curve, protocol):
+    """
+    A HelloRetryRequest costs the client a round trip. The s2n client sends a key share
+    for its default curve, so only a server which needs another curve asks for a retry.
+    """
+    port = next(available_ports)
+    capture = record_trace(port)
+
+    client_options = ProviderOptions(
+        mode=Provider.ClientMode,
+        port=port,
+        cipher=cipher,
+        data_to_send=data_bytes(64),
+        insecure=True,
+        extra_flags=["--key-log", capture.key_log],
+        protocol=protocol)
+
+    server_options = copy.copy(client_options)
+    server_options.data_to_send = None
+    server_options.mode = Provider.ServerMode
+    server_options.key = Certificates.RSA_2048_SHA256.key
+    server_options.cert = Certificates.RSA_2048_SHA256.cert
+    server_options.extra_flags = None
+    server_options.curve = curve
+
+    server = managed_process(provider, server_options, timeout=5)
+    client = managed_process(S2N, client_options, timeout=5)
+
+    for results in client.get_results():
+        results.assert_success()
+
+    for results in server.get_results():
+        results.assert_success()
+
+    connection, = capture.stop()
+    assert connection.decrypted, connection.format_summary()
+    if curve == S2N_DEFAULT_CURVE:
+        assert not connection.hello_retry
+        assert connection.round_trips == 1, connection.format_summary()
+    else:
+        assert connection.hello_retry
+        assert connection.message_names().count("client_hello") == 2
+        assert connection.round_trips == 2, connection.format_summary()
+
+
 @pytest.mark.uncollect_if(func=invalid_test_parameters)
 @pytest.mark.parametrize("cipher", TLS13_CIPHERS, ids=get_parameter_name)
 @pytest.mark.parametrize("provider", [OpenSSL])
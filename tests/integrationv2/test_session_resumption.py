@@ -4,11 +4,20 @@ import pytest
 import time
 
 from configuration import available_ports, ALL_TEST_CIPHERS, ALL_TEST_CURVES, ALL_TEST_CERTS, PROTOCOLS, TLS13_CIPHERS
-from common import ProviderOptions, Protocols, data_bytes
-from fixtures import managed_process
+from common import BatchConnection, Certificates, Cipher, ProviderOptions, Protocols, data_bytes
+from fixtures import managed_process, packet_capture, record_trace
+from packet_capture import SERVER
 from providers import Provider, S2N, OpenSSL
+from record_trace import HANDSHAKE_KEYS, PLAINTEXT
 from utils import invalid_test_parameters, get_parameter_name, get_expected_s2n_version, to_bytes
 
+# Security policies which only negotiate AEAD cipher suites, so record_trace can
+# decrypt the handshakes
+TLS13_AEAD_POLICY = Cipher(
+    "default_tls13", Protocols.TLS10, False, False, s2n=True)
+TLS12_AEAD_POLICY = Cipher(
+    "20190214_gcm", Protocols.TLS10, False, False, s2n=True)
+
 
 @pytest.mark.uncollect_if(func=invalid_test_parameters)
 @pytest.mark.parametrize("cipher", ALL_TEST_CIPHERS, ids=get_parameter_name)
@@ -192,9 +201,8 @@ def test_tls13_session_resumption_s2n_client(managed_process, cipher, curve, cer
                                              other_provider):
     port = str(next(available_ports))
 
-    # The reconnect option for s2nc allows the client to reconnect automatically
-    # five times. In this test we expect one full connection and five resumption
-    # connections.
+    # s2nc makes every connection from one batch-mode process. In this test we
+    # expect one full connection and five resumption connections.
     num_full_connections = 1
     num_resumed_connections = 5
 
@@ -205,7 +213,8 @@ def test_tls13_session_resumption_s2n_client(managed_process, cipher, curve, cer
         curve=curve,
         insecure=True,
         use_session_ticket=True,
-        reconnect=True,
+        batch=[BatchConnection(id="full")] + [BatchConnection(id="resume-{}".format(i), resume=True)
+                                              for i in range(num_resumed_connections)],
         protocol=protocol)
 
     server_options = copy.copy(client_options)
@@ -219,13 +228,15 @@ def test_tls13_session_resumption_s2n_client(managed_process, cipher, curve, cer
 
     s2n_version = get_expected_s2n_version(protocol, provider)
 
-    # s2nc indicates the number of resumed connections in its output
+    # s2nc reports whether each connection was resumed
     for results in client.get_results():
         results.assert_success()
-        assert results.stdout.count(
-            b'Resumed session') == num_resumed_connections
-        assert to_bytes("Actual protocol version: {}".format(
-            s2n_version)) in results.stdout
+        connections = results.split_batch()
+        assert [connection.batch_result["resumed"] for connection in connections] == \
+            [False] + [True] * num_resumed_connections
+        for connection in connections:
+            assert to_bytes("Actual protocol version: {}".format(
+                s2n_version)) in connection.stdout
 
     server_accepts_str = str(
         num_resumed_connections + num_full_connections) + " server accepts that finished"
@@ -321,3 +332,60 @@ def test_s2nd_falls_back_to_full_connection(managed_process, tmp_path, cipher, c
         assert b'Resumed session' not in results.stdout
         assert to_bytes("Actual protocol version: {}".format(
             s2n_version)) in results.stdout
+
+
+@pytest.mark.uncollect_if(func=invalid_test_parameters)
+@pytest.mark.parametrize("protocol", [Protocols.TLS13, Protocols.TLS12], ids=get_parameter_name)
+@pytest.mark.parametrize("provider", [S2N], ids=get_parameter_name)
+@pytest.mark.parametrize("other_provider", [S2N], ids=get_parameter_name)
+def test_session_resumption_round_trips(managed_process, record_trace, protocol, provider, other_provider):
+    """
+    Resuming a TLS1.2 session saves the client a round trip. A TLS1.3 handshake takes
+    one round trip either way, but the resumed one is smaller, without the server's
+    certificate.
+    """
+    port = next(available_ports)
+    capture = record_trace(port)
+
+    client_options = ProviderOptions(
+        mode=Provider.ClientMode,
+        port=port,
+        cipher=TLS13_AEAD_POLICY if protocol is Protocols.TLS13 else TLS12_AEAD_POLICY,
+        insecure=True,
+        use_session_ticket=True,
+        batch=[BatchConnection(id="full"),
+               BatchConnection(id="resumed", resume=True)],
+        extra_flags=["--key-log", capture.key_log],
+        protocol=protocol)
+
+    server_options = copy.copy(client_options)
+    server_options.mode = Provider.ServerMode
+    server_options.key = Certificates.RSA_2048_SHA256.key
+    server_options.cert = Certificates.RSA_2048_SHA256.cert
+    server_options.reconnects_before_exit = 2
+    server_options.batch = None
+    server_options.extra_flags = None
+
+    server = managed_process(provider, server_options, timeout=5)
+    client = managed_process(S2N, client_options, timeout=5)
+
+    for results in client.get_results():
+        results.assert_success()
+
+    for results in server.get_results():
+        results.assert_success()
+
+    full, resumed = capture.stop()
+    summaries = full.format_summary() + "\n" + resumed.format_summary()
+    assert full.decrypted and resumed.decrypted, summaries
+    assert not full.resumed and resumed.resumed
+
+    full_bytes = full.bytes_per_phase(SERVER)
+    resumed_bytes = resumed.bytes_per_phase(SERVER)
+    if protocol is Protocols.TLS13:
+        assert full.round_trips == resumed.round_trips == 1
+        assert resumed_bytes[HANDSHAKE_KEYS] < full_bytes[HANDSHAKE_KEYS]
+    else:
+        assert full.round_trips == 2
+        assert resumed.round_trips == 1
+        assert resumed_bytes[PLAINTEXT] < full_bytes[PLAINTEXT]
@@ -10,6 +10,10 @@ from providers import S2N
 from utils import get_parameter_name, invalid_test_parameters
 from global_flags import get_flag, S2N_PROVIDER_VERSION, S2N_FIPS_MODE
 
+
+# sslyze runs in this process, so its version isn't part of the commands the tests run
+pytestmark = pytest.mark.no_result_cache
+
 HOST = "127.0.0.1"
 
 PROTOCOLS_TO_TEST = [
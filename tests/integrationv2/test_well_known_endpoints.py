@@ -9,6 +9,10 @@ from providers import Provider, S2N
 from utils import invalid_test_parameters, get_parameter_name, to_bytes
 
 
+# These tests connect to servers on the internet, which change without notice
+pytestmark = pytest.mark.no_result_cache
+
+
 ENDPOINTS = [
     "www.akamai.com",
     "www.amazon.com",
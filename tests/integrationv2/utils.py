@@ -1,3 +1,4 @@
+from capabilities import get_capabilities
 from common import Protocols, Curves, Ciphers
 from providers import S2N, OpenSSL
 from global_flags import get_flag, S2N_FIPS_MODE, S2N_PROVIDER_VERSION
@@ -47,79 +48,142 @@ def get_parameter_name(item):
     return str(item)
 
 
-def invalid_test_parameters(*args, **kwargs):
+def _constraint(*names):
     """
-    Determine if the parameters chosen for a test makes sense.
-    This function returns True or False, indicating whether a
-    test should be "deselected" based on the arguments.
+    Register a check for invalid_test_parameters. names are the parameters the
+    check reads, so test generation can run it as soon as they are all chosen.
     """
-    protocol = kwargs.get('protocol')
-    provider = kwargs.get('provider')
-    other_provider = kwargs.get('other_provider')
-    certificate = kwargs.get('certificate')
-    client_certificate = kwargs.get('client_certificate')
-    cipher = kwargs.get('cipher')
-    curve = kwargs.get('curve')
-    signature = kwargs.get('signature')
+    def _register(check):
+        check.requires = names
+        _CONSTRAINTS.append(check)
+        return check
+    return _register
+
+
+_CONSTRAINTS = []
+
 
-    providers = [provider_ for provider_ in [provider, other_provider] if provider_]
+def _providers(kwargs):
+    return [provider_ for provider_ in [kwargs.get('provider'), kwargs.get('other_provider')] if provider_]
 
+
+@_constraint('protocol', 'certificate', 'client_certificate')
+def _rsa_pss_certificate_needs_tls13(**kwargs):
     # Only TLS1.3 supports RSA-PSS-PSS certificates
     # (Earlier versions support RSA-PSS signatures, just via RSA-PSS-RSAE)
+    protocol = kwargs.get('protocol')
     if protocol and protocol is not Protocols.TLS13:
-        if client_certificate and client_certificate.algorithm == 'RSAPSS':
-            return True
-        if certificate and certificate.algorithm == 'RSAPSS':
-            return True
-
-    for provider_ in providers:
-        if not provider_.supports_protocol(protocol):
-            return True
-
-    if cipher is not None:
-        # If the selected protocol doesn't allow the cipher, don't test
-        if protocol is not None:
-            if cipher.min_version > protocol:
+        for certificate in [kwargs.get('client_certificate'), kwargs.get('certificate')]:
+            if certificate and certificate.algorithm == 'RSAPSS':
                 return True
+    return False
 
-            # Ciphersuites prior to TLS13 can not be used with TLS13
-            # https://wiki.openssl.org/index.php/TLS1.3#Differences_with_TLS1.2_and_below
-            if protocol is Protocols.TLS13 and cipher.min_version < protocol:
-                return True
 
-        for provider_ in providers:
-            if not provider_.supports_cipher(cipher, with_curve=curve):
-                return True
+@_constraint('protocol', 'provider', 'other_provider')
+def _unsupported_protocol(**kwargs):
+    capabilities = get_capabilities()
+    return any(not capabilities.supports_protocol(provider_, kwargs.get('protocol'))
+               for provider_ in _providers(kwargs))
 
-        if get_flag(S2N_FIPS_MODE):
-            if not cipher.fips:
-                return True
 
+@_constraint('cipher', 'protocol')
+def _cipher_not_allowed_by_protocol(**kwargs):
+    cipher = kwargs.get('cipher')
+    protocol = kwargs.get('protocol')
+    if cipher is None or protocol is None:
+        return False
+
+    # If the selected protocol doesn't allow the cipher, don't test
+    if cipher.min_version > protocol:
+        return True
+
+    # Ciphersuites prior to TLS13 can not be used with TLS13
+    # https://wiki.openssl.org/index.php/TLS1.3#Differences_with_TLS1.2_and_below
+    return protocol is Protocols.TLS13 and cipher.min_version < protocol
+
+
+@_constraint('cipher', 'curve', 'provider', 'other_provider')
+def _unsupported_cipher(**kwargs):
+    cipher = kwargs.get('cipher')
+    if cipher is None:
+        return False
+
+    capabilities = get_capabilities()
+    return any(not capabilities.supports_cipher(provider_, cipher, with_curve=kwargs.get('curve'))
+               for provider_ in _providers(kwargs))
+
+
+@_constraint('cipher')
+def _cipher_not_fips(**kwargs):
+    cipher = kwargs.get('cipher')
+    return cipher is not None and bool(get_flag(S2N_FIPS_MODE)) and not cipher.fips
+
+
+@_constraint('certificate', 'protocol', 'provider', 'other_provider')
+def _unsupported_certificate(**kwargs):
     # If we are using a cipher that depends on a specific certificate algorithm
     # deselect the test if the wrong certificate is used.
-    if certificate is not None:
-        if protocol is not None:
-            for provider_ in providers:
-                if provider_.supports_protocol(protocol, with_cert=certificate) is False:
-                    return True
-        if cipher is not None and certificate.compatible_with_cipher(cipher) is False:
-            return True
+    certificate = kwargs.get('certificate')
+    protocol = kwargs.get('protocol')
+    if certificate is None or protocol is None:
+        return False
+
+    capabilities = get_capabilities()
+    return any(capabilities.supports_protocol(provider_, protocol, with_cert=certificate) is False
+               for provider_ in _providers(kwargs))
+
+
+@_constraint('certificate', 'cipher')
+def _certificate_incompatible_with_cipher(**kwargs):
+    certificate = kwargs.get('certificate')
+    cipher = kwargs.get('cipher')
+    return certificate is not None and cipher is not None and certificate.compatible_with_cipher(cipher) is False
 
+
+@_constraint('curve', 'certificate', 'client_certificate')
+def _certificate_incompatible_with_curve(**kwargs):
     # If the curve is specified, then all signatures must use that curve
-    if curve:
-        if certificate and not certificate.compatible_with_curve(curve):
-            return True
-        if client_certificate and not client_certificate.compatible_with_curve(curve):
-            return True
+    curve = kwargs.get('curve')
+    if not curve:
+        return False
+
+    return any(certificate and not certificate.compatible_with_curve(curve)
+               for certificate in [kwargs.get('certificate'), kwargs.get('client_certificate')])
+
 
+@_constraint('curve', 'protocol')
+def _curve_not_allowed_by_protocol(**kwargs):
     # Prevent situations like using X25519 with TLS1.2
-    if curve is not None:
-        if protocol is not None and curve.min_protocol > protocol:
-            return True
+    curve = kwargs.get('curve')
+    protocol = kwargs.get('protocol')
+    return curve is not None and protocol is not None and curve.min_protocol > protocol
 
-    if signature is not None:
-        for provider_ in providers:
-            if provider_.supports_signature(signature) is False:
-                return True
 
-    return False
+@_constraint('signature', 'provider', 'other_provider')
+def _unsupported_signature(**kwargs):
+    signature = kwargs.get('signature')
+    if signature is None:
+        return False
+
+    capabilities = get_capabilities()
+    return any(capabilities.supports_signature(provider_, signature) is False
+               for provider_ in _providers(kwargs))
+
+
+def invalid_test_parameters(*args, **kwargs):
+    """
+    Determine if the parameters chosen for a test makes sense.
+    This function returns True or False, indicating whether a
+    test should be "deselected" based on the arguments.
+
+    What each provider supports is looked up in the session's
+    CapabilityTable, so it's only computed once per combination.
+
+    Each check is registered with the parameters it reads, see
+    invalid_test_parameters.constraints. Test generation uses them to
+    skip invalid combinations without listing them, see parametrization.py.
+    """
+    return any(check(**kwargs) for check in _CONSTRAINTS)
+
+
+invalid_test_parameters.constraints = _CONSTRAINTS